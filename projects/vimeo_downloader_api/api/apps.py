@@ -4,3 +4,18 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        from django.conf import settings
+        from django.db.backends.signals import connection_created
+        from django.db.models.signals import post_delete, post_save
+        from .authentication import invalidate_cached_user
+        from .metrics import install_query_wrapper, register_process_metrics
+
+        # Time and count every query for the metrics endpoint
+        connection_created.connect(install_query_wrapper)
+        register_process_metrics()
+
+        # Drop cached users when their account changes
+        post_save.connect(invalidate_cached_user, sender=settings.AUTH_USER_MODEL)
+        post_delete.connect(invalidate_cached_user, sender=settings.AUTH_USER_MODEL)
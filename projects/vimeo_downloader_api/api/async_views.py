@@ -0,0 +1,394 @@
+import asyncio
+import json
+import logging
+
+import aiohttp
+from django.conf import settings
+from django.http import HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from django.views import View
+from rest_framework.exceptions import AuthenticationFailed
+
+from . import metrics, upstream
+from .authentication import AsyncJWTAuthentication
+from .cache import segment_cache
+from .coalesce import coalescer
+from .db import database_sync_to_async
+from .events import FINAL_STATUSES, hub, parse_etag, progress_snapshot
+from .models import VideoDownload
+from .fmp4 import Fmp4Error, FragmentedMuxer
+from .playlist import aget_playlist_index
+from .prefetch import PrefetchedSegment, prefetcher
+from .progress import reporters
+from .relay import buffer_pool
+from .sendfile import serve_file
+from .views import (
+    CHUNK_TYPES,
+    DEFERRED_VIDEO_FIELDS,
+    download_progress_data,
+    merged_fragments,
+    open_local_chunk,
+    range_to_end,
+)
+
+logger = logging.getLogger(__name__)
+
+
+async def read_file_range(file, start, length):
+    """
+    Read part of a local file off the event loop, through a pooled buffer
+    """
+    pool = buffer_pool()
+    buffer = pool.acquire()
+    view = memoryview(buffer)
+    try:
+        await asyncio.to_thread(file.seek, start)
+        while length > 0:
+            target = view if length >= len(view) else view[:length]
+            count = await asyncio.to_thread(file.readinto, target)
+            if not count:
+                break
+            length -= count
+            yield view[:count]
+    finally:
+        pool.release(buffer)
+        file.close()
+
+
+async def relay(response):
+    """
+    Relay an upstream aiohttp response
+    """
+    try:
+        async for chunk in response.content.iter_chunked(settings.RELAY_CHUNK_SIZE):
+            yield chunk
+    finally:
+        response.release()
+
+
+async def iterate_in_thread(iterator):
+    """
+    Drive a blocking iterator from the event loop, one item at a time on a
+    worker thread
+    """
+    done = object()
+    try:
+        while True:
+            item = await asyncio.to_thread(next, iterator, done)
+            if item is done:
+                return
+            yield item
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            await asyncio.to_thread(close)
+
+
+async def amark_when_served(chunks, download, kind, index, length=None, size=None):
+    """
+    views.mark_when_served() for async bodies
+    """
+    sent = 0
+    async for chunk in chunks:
+        sent += len(chunk)
+        yield chunk
+    if length is not None and sent != length:
+        return
+    reporter = reporters.get(download)
+    await reporter.amark_segment(kind, index, sent if size is None else size)
+    if kind == "video":
+        await reporter.aset_chunks(reporter.bitmaps["video"].count())
+
+
+class AsyncAPIView(View):
+    """
+    Async class-based view authenticated with the project's JWTs
+
+    DRF views are sync only, so this covers the bits the streaming
+    endpoints need: bearer authentication and JSON error bodies.
+    """
+
+    authentication = AsyncJWTAuthentication()
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            auth = await self.authentication.aauthenticate(request)
+        except AuthenticationFailed as e:
+            return self.unauthorized(e.detail)
+        if auth is None:
+            return self.unauthorized("Authentication credentials were not provided.")
+
+        request.user, request.auth = auth
+        return await super().dispatch(request, *args, **kwargs)
+
+    def unauthorized(self, detail):
+        body = detail if isinstance(detail, dict) else {"detail": detail}
+        response = JsonResponse(body, status=401)
+        response["WWW-Authenticate"] = self.authentication.authenticate_header(None)
+        return response
+
+    @staticmethod
+    @database_sync_to_async
+    def get_download(request, download_id):
+        try:
+            return (
+                VideoDownload.objects.select_related("video")
+                .defer(*DEFERRED_VIDEO_FIELDS)
+                .get(id=download_id, user=request.user)
+            )
+        except VideoDownload.DoesNotExist:
+            return None
+
+
+class AsyncStreamChunkView(AsyncAPIView):
+    async def get(self, request, download_id):
+        """
+        Stream a specific chunk of the video
+        GET /api/stream-chunk/{download_id}/?chunk=0&type=video
+        """
+        download = await self.get_download(request, download_id)
+        if download is None:
+            return JsonResponse(
+                {"error": "Download not found or access denied"}, status=404
+            )
+
+        if download.status not in ["downloading", "processing"]:
+            return JsonResponse({"error": "Download not in progress"}, status=400)
+
+        chunk_number = request.GET.get("chunk", "0")
+        chunk_type = request.GET.get("type", "video")  # 'video' or 'audio'
+
+        try:
+            chunk_number = int(chunk_number)
+        except ValueError:
+            return JsonResponse({"error": "Invalid chunk number"}, status=400)
+        if chunk_type not in CHUNK_TYPES:
+            return JsonResponse({"error": "Invalid chunk type"}, status=400)
+
+        index = await aget_playlist_index(download.video)
+        track = index.track(chunk_type, download.resolution) if index else None
+        segment_url = track.segment_url(chunk_number) if track else None
+        if segment_url is None:
+            return JsonResponse({"error": "Chunk not found"}, status=404)
+
+        cache = segment_cache()
+        prefetcher.advance(download, chunk_type, chunk_number, track, cache)
+
+        content_type = "video/mp4" if chunk_type == "video" else "audio/mp4"
+        byte_range = request.META.get("HTTP_RANGE")
+        local = open_local_chunk(download, segment_url, chunk_number, chunk_type, cache)
+
+        if local is not None:
+            metrics.CHUNK_REQUESTS.labels("local").inc()
+            response = serve_file(request, local, content_type, reader=read_file_range)
+            response["Cache-Control"] = "private, max-age=86400, immutable"
+        elif byte_range:
+            metrics.CHUNK_REQUESTS.labels("range").inc()
+            # Resume a partially received chunk with a ranged upstream request
+            upstream_response = await self.get_chunk_range(segment_url, byte_range)
+            if upstream_response is None:
+                return JsonResponse({"error": "Chunk not found"}, status=404)
+            body = relay(upstream_response)
+            if upstream_response.status == 200:
+                # Range ignored upstream: this is the whole chunk
+                body = amark_when_served(body, download, chunk_type, chunk_number)
+            else:
+                resumed = range_to_end(upstream_response.headers)
+                if resumed is not None:
+                    body = amark_when_served(
+                        body, download, chunk_type, chunk_number, *resumed
+                    )
+            response = StreamingHttpResponse(
+                body, content_type=content_type, status=upstream_response.status
+            )
+            if "Content-Range" in upstream_response.headers:
+                response["Content-Range"] = upstream_response.headers["Content-Range"]
+        else:
+            stream = await self.get_chunk_data(segment_url, cache)
+            if stream is None:
+                return JsonResponse({"error": "Chunk not found"}, status=404)
+
+            response = StreamingHttpResponse(
+                amark_when_served(
+                    stream.aiter_chunks(),
+                    download,
+                    chunk_type,
+                    chunk_number,
+                    stream.length,
+                ),
+                content_type=content_type,
+            )
+            if stream.length is not None:
+                response["Content-Length"] = str(stream.length)
+        response["Content-Disposition"] = (
+            f'attachment; filename="chunk_{chunk_number}.mp4"'
+        )
+        response["X-Chunk-Number"] = str(chunk_number)
+        response["X-Total-Chunks"] = str(download.total_chunks)
+        return response
+
+    async def get_chunk_data(self, segment_url, cache):
+        """
+        Fetch a chunk from Vimeo as a SegmentReader
+        """
+        with metrics.CHUNK_OPEN_SECONDS.time():
+            prefetched = prefetcher.take(segment_url)
+            if prefetched is not None:
+                metrics.CHUNK_REQUESTS.labels("prefetch").inc()
+                return PrefetchedSegment(prefetched)
+
+            # Share the fetch with concurrent requests for the same segment
+            metrics.CHUNK_REQUESTS.labels("upstream").inc()
+            return await coalescer.aopen(segment_url, cache)
+
+    async def get_chunk_range(self, segment_url, byte_range):
+        """
+        Fetch part of a chunk from Vimeo for a client resuming a download
+        """
+        try:
+            response = await upstream.aget(segment_url, headers={"Range": byte_range})
+            if response.status in (200, 206):
+                return response
+            response.release()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning("Error downloading chunk range: %s", e)
+
+        return None
+
+
+class AsyncDownloadProgressView(AsyncAPIView):
+    async def get(self, request, download_id):
+        """
+        Get download progress, long-polling with If-None-Match
+        GET /api/download-progress/{download_id}/
+        """
+        client_etag = parse_etag(request.headers.get("If-None-Match"))
+        entry = hub.current(download_id, request.user.pk)
+        download = None
+        if entry is None:
+            download = await self.get_download(request, download_id)
+            if download is None:
+                return JsonResponse(
+                    {"error": "Download not found or access denied"}, status=404
+                )
+            entry = hub.seed(
+                download.pk, progress_snapshot(download), owner=download.user_id
+            )
+
+        if client_etag is not None and client_etag == entry.etag:
+            entry = await hub.await_change(
+                download_id, client_etag, settings.PROGRESS_LONG_POLL_TIMEOUT
+            )
+            if entry is not None and entry.etag == client_etag:
+                response = HttpResponseNotModified()
+                response["ETag"] = f'W/"{entry.etag}"'
+                return response
+            download = None
+
+        if download is None:
+            download = await self.get_download(request, download_id)
+            if download is None:
+                return JsonResponse(
+                    {"error": "Download not found or access denied"}, status=404
+                )
+            entry = hub.seed(download.pk, progress_snapshot(download))
+
+        index = await aget_playlist_index(download.video)
+        data = download_progress_data(download, index)
+        data.update(entry.snapshot)
+        response = JsonResponse(data)
+        response["ETag"] = f'W/"{entry.etag}"'
+        return response
+
+
+class AsyncStreamMergedVideoView(AsyncAPIView):
+    async def get(self, request, download_id):
+        """
+        Stream the merged video as a fragmented MP4 while segments arrive,
+        or the merged file once the download has completed
+        GET /api/stream-video/{download_id}/
+        """
+        download = await self.get_download(request, download_id)
+        if download is None:
+            return JsonResponse(
+                {"error": "Download not found or access denied"}, status=404
+            )
+
+        if download.status == "error":
+            return JsonResponse({"error": "Download failed"}, status=400)
+
+        # A finished merge is served from disk, with Range and ETag support
+        if download.status == "completed" and download.output_path:
+            try:
+                output = await asyncio.to_thread(open, download.output_path, "rb")
+            except FileNotFoundError:
+                pass
+            else:
+                return serve_file(
+                    request,
+                    output,
+                    "video/mp4",
+                    filename=f"video_{download.resolution}.mp4",
+                    reader=read_file_range,
+                )
+
+        index = await aget_playlist_index(download.video)
+        video_track = index.video(download.resolution) if index else None
+        audio_track = index.audio if index else None
+        if not video_track or not audio_track:
+            return JsonResponse({"error": "Video or audio track not found"}, status=404)
+
+        try:
+            muxer = FragmentedMuxer(video_track.init_segment, audio_track.init_segment)
+        except (ValueError, Fmp4Error) as e:
+            return JsonResponse({"error": f"Unsupported init segment: {e}"}, status=502)
+
+        # Segments are fetched by blocking code; keep it off the event loop
+        # rather than have Django buffer a sync body
+        response = StreamingHttpResponse(
+            iterate_in_thread(merged_fragments(muxer, video_track, audio_track)),
+            content_type="video/mp4",
+        )
+        response["Content-Disposition"] = (
+            f'attachment; filename="video_{download.resolution}.mp4"'
+        )
+        return response
+
+
+class DownloadEventsView(AsyncAPIView):
+    async def get(self, request, download_id):
+        """
+        Stream download progress as server-sent events
+        GET /api/download-progress/{download_id}/events/
+
+        An event is sent whenever the progress changes, with a comment line
+        every PROGRESS_SSE_KEEPALIVE seconds in between; the stream ends
+        once the download completes or fails.
+        """
+        download = await self.get_download(request, download_id)
+        if download is None:
+            return JsonResponse(
+                {"error": "Download not found or access denied"}, status=404
+            )
+
+        hub.seed(download.pk, progress_snapshot(download), owner=download.user_id)
+        last_event_id = parse_etag(request.headers.get("Last-Event-ID"))
+        response = StreamingHttpResponse(
+            self.events(download.pk, last_event_id),
+            content_type="text/event-stream",
+        )
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+    async def events(self, pk, etag):
+        while True:
+            entry = await hub.await_change(pk, etag, settings.PROGRESS_SSE_KEEPALIVE)
+            if entry is None or entry.etag == etag:
+                yield b": keep-alive\n\n"
+                continue
+
+            etag = entry.etag
+            data = json.dumps({"id": str(pk), **entry.snapshot})
+            yield f"id: {etag}\nevent: progress\ndata: {data}\n\n".encode()
+            if entry.snapshot["status"] in FINAL_STATUSES:
+                return
@@ -0,0 +1,200 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+from . import metrics
+from .db import database_sync_to_async
+
+
+def token_version(validated_token):
+    """
+    The version of the user's credentials a token was issued for
+
+    With CHECK_REVOKE_TOKEN tokens carry a hash of the password they were
+    issued under, so a password change gives later tokens a new version.
+    Without it all of a user's tokens share one version.
+    """
+    if api_settings.CHECK_REVOKE_TOKEN:
+        return validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) or ""
+    return ""
+
+
+class UserCache:
+    """
+    Users loaded by JWT authentication, by user id and token version
+
+    Entries live for AUTH_USER_CACHE_TTL seconds in a per-process LRU of
+    AUTH_USER_CACHE_SIZE users, backed by the AUTH_USER_SHARED_CACHE cache
+    alias when one is set. The shared cache holds one copy per user, which
+    the authentication checks the token version against. Saving or
+    deleting a user evicts it from this process and the shared cache;
+    other processes drop their copy within the TTL. Bulk update() calls
+    send no signals, so code deactivating users that way must call
+    invalidate() itself.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def shared(self):
+        alias = settings.AUTH_USER_SHARED_CACHE
+        return caches[alias] if alias else None
+
+    def key(self, user_id):
+        return f"auth-user:{user_id}"
+
+    def get(self, user_id, version, shared=True):
+        """
+        The cached user, or None; shared=False only looks in this process
+        """
+        if settings.AUTH_USER_CACHE_SIZE <= 0:
+            return None
+        key = (str(user_id), version)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                user, expires = entry
+                if expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    metrics.AUTH_USER_CACHE.labels("hit").inc()
+                    return user
+                del self._entries[key]
+        if not shared:
+            return None
+
+        cache = self.shared()
+        if cache is not None:
+            user = cache.get(self.key(user_id))
+            if user is not None:
+                metrics.AUTH_USER_CACHE.labels("shared_hit").inc()
+                self._store(key, user)
+                return user
+        metrics.AUTH_USER_CACHE.labels("miss").inc()
+        return None
+
+    def set(self, user_id, version, user):
+        if settings.AUTH_USER_CACHE_SIZE <= 0:
+            return
+        self._store((str(user_id), version), user)
+        shared = self.shared()
+        if shared is not None:
+            shared.set(self.key(user_id), user, settings.AUTH_USER_SHARED_CACHE_TTL)
+
+    def _store(self, key, user):
+        with self._lock:
+            self._entries[key] = (user, time.monotonic() + settings.AUTH_USER_CACHE_TTL)
+            self._entries.move_to_end(key)
+            while len(self._entries) > settings.AUTH_USER_CACHE_SIZE:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        """
+        Forget a user whose account changed
+        """
+        user_id = str(user_id)
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == user_id]:
+                del self._entries[key]
+        shared = self.shared()
+        if shared is not None:
+            shared.delete(self.key(user_id))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+user_cache = UserCache()
+
+
+def invalidate_cached_user(sender, instance, **kwargs):
+    """
+    post_save/post_delete handler for the user model
+    """
+    user_cache.invalidate(instance.pk)
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication that reuses recently loaded users
+
+    Streaming clients make hundreds of requests per video with the same
+    token; only the first in AUTH_USER_CACHE_TTL seconds loads the user
+    from the database. The is_active and revoked-token checks still run on
+    every request, against the cached user.
+    """
+
+    def get_user(self, validated_token):
+        user = self.get_cached_user(validated_token)
+        if user is None:
+            user = self.load_user(validated_token)
+        return user
+
+    def load_user(self, validated_token):
+        """
+        Load the user from the database and cache it
+        """
+        user = super().get_user(validated_token)
+        user_cache.set(
+            validated_token[api_settings.USER_ID_CLAIM],
+            token_version(validated_token),
+            user,
+        )
+        return user
+
+    def get_cached_user(self, validated_token, shared=True):
+        """
+        The token's user if cached, checked as get_user() would
+        """
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError as e:
+            raise InvalidToken(
+                "Token contained no recognizable user identification"
+            ) from e
+
+        user = user_cache.get(user_id, token_version(validated_token), shared)
+        if user is None:
+            return None
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed("User is inactive", code="user_inactive")
+        if api_settings.CHECK_REVOKE_TOKEN and token_version(
+            validated_token
+        ) != get_md5_hash_password(user.password):
+            raise AuthenticationFailed(
+                "The user's password has been changed.", code="password_changed"
+            )
+        return user
+
+
+class AsyncJWTAuthentication(CachedJWTAuthentication):
+    """
+    JWTAuthentication usable from async views
+
+    Token validation is pure computation and stays on the event loop, as
+    do hits in the process's user cache; the shared cache and the database
+    are left to the database pool.
+    """
+
+    async def aauthenticate(self, request):
+        header = self.get_header(request)
+        if header is None:
+            return None
+
+        raw_token = self.get_raw_token(header)
+        if raw_token is None:
+            return None
+
+        validated_token = self.get_validated_token(raw_token)
+        user = self.get_cached_user(validated_token, shared=False)
+        if user is None:
+            user = await database_sync_to_async(self.get_user)(validated_token)
+        return user, validated_token
@@ -0,0 +1,239 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .relay import copy_stream
+
+
+class SegmentCache:
+    """
+    Content cache for upstream segments, stored on local disk
+
+    Entries are keyed by a hash of the resolved segment URL and evicted in
+    least-recently-used order once the cache grows past max_bytes. Files
+    are written to a temporary name and renamed into place, so readers
+    only ever see complete segments, and an evicted file stays readable
+    for anyone who already has it open.
+
+    Each process keeps its own LRU index, seeded from the files on disk at
+    start-up; file modification times are bumped on every hit so that a
+    restarted process evicts in roughly the same order. Temporary files
+    older than `temp_max_age` seconds, left by a process that died while
+    writing, are deleted then too.
+    """
+
+    temp_max_age = 600
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        found = []
+        stale = time.time() - self.temp_max_age
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if name.startswith("."):
+                    # .tmp-/.link- files still being written are left alone
+                    if stat.st_mtime < stale:
+                        try:
+                            os.remove(path)
+                        except FileNotFoundError:
+                            pass
+                    continue
+                found.append((stat.st_mtime, name, stat.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._size += size
+        self._evict()
+
+    def key(self, url):
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def open(self, url):
+        """
+        Open a cached segment for reading, or return None on a miss
+        """
+        key = self.key(url)
+        path = self.path(key)
+        try:
+            file = open(path, "rb")
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+                size = self._entries.pop(key, None)
+                if size is not None:
+                    # Evicted by another process
+                    self._size -= size
+            return None
+
+        with self._lock:
+            self.hits += 1
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            else:
+                size = os.fstat(file.fileno()).st_size
+                self._entries[key] = size
+                self._size += size
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return file
+
+    def has(self, url):
+        return os.path.exists(self.path(self.key(url)))
+
+    def get(self, url):
+        file = self.open(url)
+        if file is None:
+            return None
+        with file:
+            return file.read()
+
+    def put(self, url, data):
+        writer = self.writer(url)
+        writer.write(data)
+        writer.commit()
+
+    def put_file(self, url, path):
+        """
+        Add a file already on disk, hard-linking it when possible
+        """
+        key = self.key(url)
+        target = self.path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        link_path = os.path.join(
+            os.path.dirname(target), f".link-{os.getpid()}-{threading.get_ident()}"
+        )
+        try:
+            os.link(path, link_path)
+        except OSError:
+            writer = self.writer(url)
+            with open(path, "rb") as file:
+                writer.size = copy_stream(file, writer.file)
+            writer.commit()
+            return
+        os.replace(link_path, target)
+        self._add(key, os.path.getsize(target))
+
+    def copy_to(self, url, path):
+        """
+        Copy a cached segment to path, returning False on a miss
+        """
+        file = self.open(url)
+        if file is None:
+            return False
+        temp_path = path + ".cache"
+        with file, open(temp_path, "wb") as output:
+            copy_stream(file, output)
+        os.replace(temp_path, path)
+        return True
+
+    def writer(self, url):
+        """
+        Start writing a segment; nothing is visible until commit()
+        """
+        return CacheWriter(self, self.key(url))
+
+    def _add(self, key, size):
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= previous
+            self._entries[key] = size
+            self._size += size
+            self._evict()
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "entries": len(self._entries),
+                "size_bytes": self._size,
+                "max_bytes": self.max_bytes,
+            }
+
+
+class CacheWriter:
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        self.size = 0
+        directory = os.path.dirname(cache.path(key))
+        os.makedirs(directory, exist_ok=True)
+        fd, self.temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        os.fchmod(fd, 0o644)
+        self.file = os.fdopen(fd, "wb")
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def commit(self):
+        self.file.close()
+        os.replace(self.temp_path, self.cache.path(self.key))
+        self.cache._add(self.key, self.size)
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def segment_cache():
+    """
+    Get the process-wide segment cache, or None when caching is disabled
+    """
+    global _cache
+
+    if settings.SEGMENT_CACHE_MAX_BYTES <= 0:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = SegmentCache(
+                    settings.SEGMENT_CACHE_DIR, settings.SEGMENT_CACHE_MAX_BYTES
+                )
+    return _cache
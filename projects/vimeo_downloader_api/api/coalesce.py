@@ -0,0 +1,393 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from . import upstream
+from .relay import iter_readinto, raw_body
+from .throughput import throughput
+
+logger = logging.getLogger(__name__)
+
+
+class SegmentStream:
+    """
+    One upstream fetch of a segment, read by every client that wants it
+
+    Chunks are handed to readers as they arrive. Each reader walks the
+    chunk list at its own pace, so a slow client never holds up the others
+    or the fetch. Chunks every reader has passed are dropped, so memory
+    grows with how far the slowest reader lags the fetch, not with the
+    segment size. Nothing is dropped before the first reader subscribes.
+    A client still has to start from the first byte, so once a chunk has
+    been dropped the stream takes no new readers and a later request
+    starts a fetch of its own.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.status = None
+        self.length = None
+        self.chunks = []
+        # Chunks dropped from the front of self.chunks
+        self.dropped = 0
+        self.received = 0
+        self.readers = set()
+        self.done = False
+        self.failed = False
+        self.task = None
+        self.started = time.monotonic()
+        self._changed = threading.Condition()
+        self._futures = set()
+
+    def subscribe(self):
+        """
+        A SegmentReader from the first byte, or None if that is gone
+        """
+        with self._changed:
+            if self.dropped:
+                return None
+            reader = SegmentReader(self)
+            self.readers.add(reader)
+            return reader
+
+    def unsubscribe(self, reader):
+        with self._changed:
+            self.readers.discard(reader)
+            self._trim()
+
+    def _trim(self):
+        if self.readers:
+            low = min(reader.position for reader in self.readers)
+        elif self.dropped:
+            # Nobody left who could read the rest
+            low = self.dropped + len(self.chunks)
+        else:
+            return
+        if low > self.dropped:
+            del self.chunks[: low - self.dropped]
+            self.dropped = low
+
+    def start(self, status, length):
+        with self._changed:
+            self.status = status
+            self.length = length
+            self._notify()
+
+    def feed(self, chunk):
+        with self._changed:
+            self.chunks.append(chunk)
+            self.received += len(chunk)
+            self._notify()
+
+    def finish(self, failed=False):
+        with self._changed:
+            self.done = True
+            self.failed = failed
+            self._notify()
+
+    def _notify(self):
+        self._changed.notify_all()
+        for loop, future in self._futures:
+            loop.call_soon_threadsafe(_wake, future)
+        self._futures.clear()
+
+    def _ready(self):
+        return self.status is not None or self.done
+
+    def _available(self, index):
+        return self.dropped + len(self.chunks) > index or self.done
+
+    def _waiter(self):
+        loop = asyncio.get_running_loop()
+        waiter = (loop, loop.create_future())
+        self._futures.add(waiter)
+        return waiter[1]
+
+    def wait_ready(self):
+        """
+        Block until the upstream status is known
+        """
+        with self._changed:
+            self._changed.wait_for(self._ready)
+        return self.status
+
+    async def await_ready(self):
+        while True:
+            with self._changed:
+                if self._ready():
+                    return self.status
+                future = self._waiter()
+            await future
+
+    def wait_done(self):
+        """
+        Block until the fetch has ended, returning whether it succeeded
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: self.done)
+        return not self.failed
+
+    def _take(self, reader):
+        """
+        Chunks past the reader's position, and whether the stream has ended
+        after them; the reader is moved past them
+        """
+        if self.done and self.failed:
+            raise ConnectionError(f"Upstream fetch failed: {self.url}")
+        chunks = self.chunks[reader.position - self.dropped :]
+        reader.position += len(chunks)
+        self._trim()
+        return chunks, self.done
+
+
+class SegmentReader:
+    """
+    One client's position in a SegmentStream
+
+    Reading to the end, or closing the iterator early, unsubscribes it.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.position = 0
+
+    @property
+    def length(self):
+        return self.stream.length
+
+    def close(self):
+        self.stream.unsubscribe(self)
+
+    def iter_chunks(self):
+        stream = self.stream
+        try:
+            while True:
+                with stream._changed:
+                    stream._changed.wait_for(lambda: stream._available(self.position))
+                    chunks, done = stream._take(self)
+                yield from chunks
+                if done:
+                    return
+        finally:
+            self.close()
+
+    async def aiter_chunks(self):
+        stream = self.stream
+        try:
+            while True:
+                with stream._changed:
+                    if stream._available(self.position):
+                        chunks, done = stream._take(self)
+                        future = None
+                    else:
+                        future = stream._waiter()
+                if future is not None:
+                    await future
+                    continue
+                for chunk in chunks:
+                    yield chunk
+                if done:
+                    return
+        finally:
+            self.close()
+
+
+class SegmentCoalescer:
+    """
+    Share one upstream fetch between concurrent requests for a segment
+
+    The first request for a URL starts the fetch. Requests arriving while
+    it runs join the same SegmentStream, as long as it still holds the
+    first byte. The fetch runs independently of any one client, so a
+    client disconnecting does not cut off the others. Sync views fetch on
+    a pool of COALESCE_FETCH_WORKERS threads and async views on an event
+    loop task; either kind of request can read either kind of fetch. A
+    completed fetch is committed to the segment cache before it is
+    dropped, so later requests are served from disk.
+
+    Ranged requests are not coalesced.
+    """
+
+    def __init__(self):
+        self._streams = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self.fetches = 0
+        self.joined = 0
+
+    def executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        settings.COALESCE_FETCH_WORKERS,
+                        thread_name_prefix="coalesce",
+                    )
+        return self._executor
+
+    def _join(self, url, subscribe=True):
+        """
+        The stream fetching the URL, a reader of it (if subscribing) and
+        whether the caller has to start the fetch
+        """
+        with self._lock:
+            stream = self._streams.get(url)
+            if stream is not None:
+                reader = stream.subscribe() if subscribe else None
+                if reader is not None or not subscribe:
+                    self.joined += 1
+                    return stream, reader, False
+            # Nothing in flight, or past the point a new reader can join
+            stream = self._streams[url] = SegmentStream(url)
+            self.fetches += 1
+            return stream, stream.subscribe() if subscribe else None, True
+
+    def _release(self, stream):
+        with self._lock:
+            if self._streams.get(stream.url) is stream:
+                del self._streams[stream.url]
+
+    def open(self, url, cache=None, flow=None):
+        """
+        Join or start the fetch of a segment, returning a SegmentReader, or
+        None if upstream did not answer with the segment
+
+        A fetch started here is paced by `flow`'s scheduler share, if any.
+        """
+        stream, reader, leader = self._join(url)
+        if leader:
+            self.executor().submit(self._fetch, stream, cache, flow)
+        if stream.wait_ready() == 200:
+            return reader
+        reader.close()
+        return None
+
+    async def aopen(self, url, cache=None):
+        stream, reader, leader = self._join(url)
+        if leader:
+            stream.task = asyncio.get_running_loop().create_task(
+                self._afetch(stream, cache)
+            )
+        if await stream.await_ready() == 200:
+            return reader
+        reader.close()
+        return None
+
+    def fetch(self, url, cache, flow=None):
+        """
+        Fetch a segment into the cache without reading it, sharing the
+        fetch with any requests for it; returns the finished SegmentStream,
+        or None if the fetch failed
+        """
+        stream, _, leader = self._join(url, subscribe=False)
+        if leader:
+            self.executor().submit(self._fetch, stream, cache, flow)
+        if stream.wait_done() and stream.status == 200:
+            return stream
+        return None
+
+    def _fetch(self, stream, cache, flow=None):
+        writer = None
+        complete = False
+        try:
+            with upstream.get(stream.url, stream=True) as response:
+                length = response.headers.get("Content-Length")
+                stream.start(response.status_code, int(length) if length else None)
+                if response.status_code == 200:
+                    writer = cache.writer(stream.url) if cache else None
+                    if flow is None:
+                        chunks = response.iter_content(
+                            chunk_size=settings.RELAY_CHUNK_SIZE
+                        )
+                    else:
+                        # Charged to the flow as it is read, which paces
+                        # the transfer itself
+                        chunks = map(
+                            bytes, iter_readinto(flow.reader(raw_body(response)))
+                        )
+                    for chunk in chunks:
+                        if writer:
+                            writer.write(chunk)
+                        stream.feed(chunk)
+            complete = True
+        except Exception as e:
+            logger.warning("Error downloading chunk: %s", e)
+        finally:
+            self._end(stream, writer, complete)
+        try:
+            if complete and stream.status == 200:
+                self._record(stream)
+        finally:
+            # Pool threads outlive the fetch; don't hold a connection open
+            close_old_connections()
+
+    async def _afetch(self, stream, cache):
+        writer = None
+        complete = False
+        try:
+            response = await upstream.aget(stream.url)
+            try:
+                stream.start(response.status, response.content_length)
+                if response.status == 200:
+                    if cache:
+                        writer = await asyncio.to_thread(cache.writer, stream.url)
+                    async for chunk in response.content.iter_chunked(
+                        settings.RELAY_CHUNK_SIZE
+                    ):
+                        # Disk writes off the event loop, one at a time
+                        if writer:
+                            await asyncio.to_thread(writer.write, chunk)
+                        stream.feed(chunk)
+            finally:
+                response.release()
+            complete = True
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning("Error downloading chunk: %s", e)
+        finally:
+            await asyncio.to_thread(self._end, stream, writer, complete)
+        if complete and stream.status == 200:
+            # No database writes on the event loop
+            self._record(stream, flush=False)
+
+    def _record(self, stream, flush=True):
+        throughput.record(
+            stream.url,
+            stream.received,
+            time.monotonic() - stream.started,
+            flush=flush,
+        )
+
+    def _end(self, stream, writer, complete):
+        if writer and complete:
+            writer.commit()
+        elif writer:
+            writer.abort()
+        stream.finish(failed=not complete)
+        self._release(stream)
+
+    def stats(self):
+        with self._lock:
+            requests = self.fetches + self.joined
+            return {
+                "upstream_fetches": self.fetches,
+                "joined": self.joined,
+                "in_flight": len(self._streams),
+                "coalesced_ratio": (
+                    round(self.joined / requests, 4) if requests else 0.0
+                ),
+            }
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+coalescer = SegmentCoalescer()
@@ -0,0 +1,40 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.ASYNC_DB_THREADS, thread_name_prefix="async-db"
+        )
+    return _executor
+
+
+def database_sync_to_async(func):
+    """
+    Wrap ORM code for async views, running it on a small shared pool
+
+    Django's own async ORM gives every concurrent request a thread of its
+    own; a fixed pool keeps thread count (and database connections) flat
+    however many clients are streaming.
+    """
+
+    def run(*args, **kwargs):
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    async def wrapper(*args, **kwargs):
+        return await sync_to_async(
+            run, thread_sensitive=False, executor=_get_executor()
+        )(*args, **kwargs)
+
+    return wrapper
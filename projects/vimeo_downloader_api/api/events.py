@@ -0,0 +1,291 @@
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .models import VideoDownload
+from .throughput import eta_seconds
+
+logger = logging.getLogger(__name__)
+
+# Download fields pushed to progress subscribers, along with the ETA
+SNAPSHOT_FIELDS = (
+    "status",
+    "progress",
+    "downloaded_chunks",
+    "total_chunks",
+    "downloaded_bytes",
+    "bytes_per_second",
+)
+
+# Statuses after which a download's progress no longer changes
+FINAL_STATUSES = ("completed", "error")
+
+ProgressEntry = namedtuple("ProgressEntry", "etag snapshot updated")
+
+
+def snapshot_etag(snapshot):
+    encoded = json.dumps(snapshot, sort_keys=True, default=str).encode()
+    return hashlib.md5(encoded).hexdigest()[:16]
+
+
+def progress_snapshot(download):
+    snapshot = {field: getattr(download, field) for field in SNAPSHOT_FIELDS}
+    return with_eta(snapshot, download.file_size)
+
+
+def with_eta(snapshot, file_size):
+    snapshot["eta_seconds"] = eta_seconds(
+        snapshot["status"],
+        file_size,
+        snapshot["downloaded_bytes"],
+        snapshot["bytes_per_second"],
+    )
+    return snapshot
+
+
+def parse_etag(header):
+    """
+    The first entity tag of an If-None-Match / Last-Event-ID header
+    """
+    if not header:
+        return None
+    etag = header.split(",")[0].strip()
+    if etag.startswith("W/"):
+        etag = etag[2:]
+    return etag.strip('"') or None
+
+
+class ProgressHub:
+    """
+    Fan download progress out to clients waiting on SSE or long-poll
+
+    Progress reported in this process (chunk streaming) is published as it
+    happens. Progress written by other processes, such as the job workers,
+    is picked up by one background query per PROGRESS_POLL_INTERVAL_MS
+    covering every download someone is waiting on, or has asked about in
+    the last `interest` seconds, however many clients that is. Those
+    downloads' entries are current, and with the owner recorded when they
+    were seeded, answer repeated polls without touching the database.
+    """
+
+    interest = 30
+
+    def __init__(self):
+        self._entries = {}
+        self._owners = {}
+        self._interested = {}
+        self._watchers = {}
+        self._futures = {}
+        self._local_updates = {}
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._poller = None
+
+    def get(self, pk):
+        with self._lock:
+            return self._entries.get(pk)
+
+    def seed(self, pk, snapshot, owner=None):
+        """
+        Record a snapshot read from the database unless a newer one is known
+
+        The known one is only newer while the poller keeps it up to date
+        for clients interested in it, or when it was reported in this
+        process. `owner` is the id of the user the download belongs to.
+        """
+        with self._lock:
+            entry = self._entries.get(pk)
+            if entry is None or (
+                entry.snapshot != snapshot
+                and not self._polled(pk)
+                and not self._reported_locally(pk)
+            ):
+                entry = self._store(pk, snapshot)
+            if owner is not None:
+                self._owners[pk] = owner
+            self._show_interest(pk)
+            return entry
+
+    def current(self, pk, owner):
+        """
+        The entry for a download of `owner`'s if it is known to be up to
+        date, or None if the database has to be read
+        """
+        with self._lock:
+            entry = self._entries.get(pk)
+            if (
+                entry is None
+                or self._owners.get(pk) != owner
+                or not (self._polled(pk) or self._reported_locally(pk))
+            ):
+                return None
+            self._show_interest(pk)
+            return entry
+
+    def publish(self, pk, snapshot, local=True):
+        """
+        Record a new snapshot and wake the clients waiting on it
+
+        Database snapshots for downloads that are being reported in this
+        process are ignored, since they can lag behind by a flush.
+        """
+        with self._lock:
+            if local:
+                self._local_updates[pk] = time.monotonic()
+            elif self._reported_locally(pk):
+                return
+            entry = self._entries.get(pk)
+            if entry is not None and entry.snapshot == snapshot:
+                return
+            self._store(pk, snapshot)
+            self._changed.notify_all()
+            for loop, future in self._futures.pop(pk, ()):
+                loop.call_soon_threadsafe(_wake, future)
+
+    def _reported_locally(self, pk):
+        """
+        Whether this process published progress for the download recently
+        enough that the database may not have caught up
+        """
+        return time.monotonic() - self._local_updates.get(pk, float("-inf")) < (
+            2 * settings.PROGRESS_FLUSH_INTERVAL_MS / 1000
+        )
+
+    def _store(self, pk, snapshot):
+        entry = ProgressEntry(snapshot_etag(snapshot), snapshot, time.monotonic())
+        self._entries[pk] = entry
+        return entry
+
+    def _polled(self, pk):
+        """
+        Whether the poller keeps the download's entry up to date
+        """
+        return (
+            pk in self._watchers
+            or self._interested.get(pk, float("-inf")) > time.monotonic()
+        )
+
+    def _show_interest(self, pk):
+        self._interested[pk] = time.monotonic() + self.interest
+        self._start_poller()
+
+    def _watch(self, pk, delta):
+        count = self._watchers.get(pk, 0) + delta
+        if count > 0:
+            self._watchers[pk] = count
+        else:
+            self._watchers.pop(pk, None)
+        self._start_poller()
+
+    def _start_poller(self):
+        if self._poller is None:
+            self._poller = threading.Thread(target=self._run, daemon=True)
+            self._poller.start()
+
+    def wait(self, pk, etag, timeout):
+        """
+        Block until the snapshot's etag differs from `etag` or the timeout
+        passes, and return the current entry
+        """
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            self._watch(pk, 1)
+            try:
+                while True:
+                    entry = self._entries.get(pk)
+                    remaining = deadline - time.monotonic()
+                    if (entry and entry.etag != etag) or remaining <= 0:
+                        return entry
+                    self._changed.wait(remaining)
+            finally:
+                self._watch(pk, -1)
+
+    async def await_change(self, pk, etag, timeout):
+        """
+        Async counterpart of wait()
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        with self._lock:
+            self._watch(pk, 1)
+        try:
+            while True:
+                with self._lock:
+                    entry = self._entries.get(pk)
+                    remaining = deadline - loop.time()
+                    if (entry and entry.etag != etag) or remaining <= 0:
+                        return entry
+                    waiter = (loop, loop.create_future())
+                    self._futures.setdefault(pk, set()).add(waiter)
+                try:
+                    await asyncio.wait_for(waiter[1], remaining)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    with self._lock:
+                        self._futures.get(pk, set()).discard(waiter)
+        finally:
+            with self._lock:
+                self._watch(pk, -1)
+
+    def _run(self):
+        interval = settings.PROGRESS_POLL_INTERVAL_MS / 1000
+        while True:
+            time.sleep(interval)
+            try:
+                self.poll()
+            except Exception:
+                logger.exception("Error polling download progress")
+
+    def poll(self):
+        """
+        Publish database progress for every watched download in one query
+        """
+        with self._lock:
+            now = time.monotonic()
+            for pk, until in list(self._interested.items()):
+                if until <= now:
+                    del self._interested[pk]
+            watched = list(self._watchers.keys() | self._interested.keys())
+            self._prune()
+        if not watched:
+            return
+
+        close_old_connections()
+        rows = VideoDownload.objects.filter(pk__in=watched).values(
+            "pk", "file_size", *SNAPSHOT_FIELDS
+        )
+        found = set()
+        for row in rows:
+            pk = row.pop("pk")
+            found.add(pk)
+            file_size = row.pop("file_size")
+            self.publish(pk, with_eta(row, file_size), local=False)
+        with self._lock:
+            # Deleted downloads are read from the database again, to 404
+            for pk in set(watched) - found:
+                self._entries.pop(pk, None)
+                self._owners.pop(pk, None)
+
+    def _prune(self, max_age=60):
+        cutoff = time.monotonic() - max_age
+        for pk, entry in list(self._entries.items()):
+            if not self._polled(pk) and entry.updated < cutoff:
+                del self._entries[pk]
+                self._owners.pop(pk, None)
+                self._local_updates.pop(pk, None)
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+hub = ProgressHub()
@@ -0,0 +1,134 @@
+import json
+from typing import List, TypedDict
+
+from django.conf import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+def backend():
+    """
+    JSON library in use
+
+    JSON_BACKEND=auto picks orjson, then msgspec, then the standard
+    library; a library that is asked for but not installed falls back to
+    the standard library.
+    """
+    name = settings.JSON_BACKEND
+    if name == "auto":
+        if orjson is not None:
+            return "orjson"
+        if msgspec is not None:
+            return "msgspec"
+        return "stdlib"
+    if (name == "orjson" and orjson is None) or (name == "msgspec" and msgspec is None):
+        return "stdlib"
+    return name
+
+
+def loads(data):
+    """
+    Decode JSON from bytes or str; malformed input raises ValueError
+    """
+    name = backend()
+    if name == "orjson":
+        return orjson.loads(data)
+    if name == "msgspec":
+        return _msgspec_decoder.decode(data)
+    return json.loads(data)
+
+
+def dumps(data, default=None):
+    """
+    Compact UTF-8 encoded JSON
+
+    `default` is called for objects the library cannot encode, as with
+    json.dumps. orjson also hands it datetimes, to format them the same
+    way as the standard library path; msgspec writes them itself.
+    """
+    name = backend()
+    if name == "orjson":
+        return orjson.dumps(
+            data,
+            default=default,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME,
+        )
+    if name == "msgspec":
+        return msgspec.json.encode(data, enc_hook=_msgspec_hook(default))
+    return json.dumps(
+        data, default=default, ensure_ascii=False, separators=(",", ":")
+    ).encode()
+
+
+def _msgspec_hook(default):
+    def hook(obj):
+        # msgspec only encodes the exact builtin types
+        if isinstance(obj, str):
+            return str(obj)
+        if isinstance(obj, dict):
+            return dict(obj)
+        if isinstance(obj, (list, tuple)):
+            return list(obj)
+        if default is None:
+            raise TypeError(
+                f"Object of type {type(obj).__name__} is not JSON serializable"
+            )
+        return default(obj)
+
+    return hook
+
+
+# The parts of a playlist.json that PlaylistIndex and the processing task
+# read; keys missing from the manifest stay missing
+class _Segment(TypedDict, total=False):
+    url: str
+    size: int
+    length: int
+    start: float
+    end: float
+    duration: float
+
+
+class _Track(TypedDict, total=False):
+    height: int
+    width: int
+    bitrate: int
+    duration: float
+    base_url: str
+    init_segment: str
+    segments: List[_Segment]
+
+
+class _Playlist(TypedDict, total=False):
+    base_url: str
+    video: List[_Track]
+    audio: List[_Track]
+
+
+if msgspec is not None:
+    _msgspec_decoder = msgspec.json.Decoder()
+    _playlist_decoder = msgspec.json.Decoder(_Playlist)
+
+
+def loads_playlist(data):
+    """
+    Decode a playlist.json for building a PlaylistIndex
+
+    With msgspec only the fields the index uses are decoded, skipping the
+    rest of the manifest; a manifest that does not fit their types is
+    decoded in full. Other backends decode everything.
+    """
+    if backend() == "msgspec":
+        try:
+            return _playlist_decoder.decode(data)
+        except msgspec.ValidationError:
+            pass
+    return loads(data)
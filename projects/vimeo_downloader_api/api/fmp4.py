@@ -0,0 +1,178 @@
+import struct
+
+
+class Fmp4Error(Exception):
+    pass
+
+
+def iter_boxes(data, start=0, end=None):
+    """
+    Yield (box_type, box_start, payload_start, box_end) for each ISO BMFF box
+    """
+    end = len(data) if end is None else end
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", data, offset)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", data, offset + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header or offset + size > end:
+            raise Fmp4Error(f"Truncated {box_type!r} box at offset {offset}")
+        yield box_type.decode("latin-1"), offset, offset + header, offset + size
+        offset += size
+
+
+def make_box(box_type, payload):
+    return struct.pack(">I4s", 8 + len(payload), box_type.encode("latin-1")) + payload
+
+
+def find_box(data, box_type, start=0, end=None):
+    for found, box_start, payload_start, box_end in iter_boxes(data, start, end):
+        if found == box_type:
+            return box_start, payload_start, box_end
+    raise Fmp4Error(f"Missing {box_type} box")
+
+
+def tkhd_track_id_offset(data, payload_start):
+    # Full box: version determines the width of the two timestamps before it
+    version = data[payload_start]
+    return payload_start + (20 if version == 1 else 12)
+
+
+class FragmentedMuxer:
+    """
+    Combine a single-track video fMP4 and a single-track audio fMP4 into one
+    two-track fragmented MP4 without touching the media samples
+
+    Vimeo serves each track as an init segment (ftyp + moov) followed by
+    moof/mdat fragments. The merged init segment carries both traks, and
+    every fragment is rewritten in place: the audio track id is remapped
+    and fragment sequence numbers are renumbered across both tracks.
+    """
+
+    def __init__(self, video_init, audio_init):
+        self.sequence_number = 0
+        self.position = 0
+        self.audio_track_ids = {}
+        self._init = self._build_init(bytes(video_init), bytes(audio_init))
+
+    def _build_init(self, video_init, audio_init):
+        ftyp_start, _, ftyp_end = find_box(video_init, "ftyp")
+        _, video_moov, video_moov_end = find_box(video_init, "moov")
+        _, audio_moov, audio_moov_end = find_box(audio_init, "moov")
+
+        video_children = list(iter_boxes(video_init, video_moov, video_moov_end))
+        video_track_ids = []
+        for box_type, start, payload, end in video_children:
+            if box_type == "trak":
+                _, tkhd_payload, _ = find_box(video_init, "tkhd", payload, end)
+                offset = tkhd_track_id_offset(video_init, tkhd_payload)
+                video_track_ids.append(struct.unpack_from(">I", video_init, offset)[0])
+        if not video_track_ids:
+            raise Fmp4Error("Video init segment has no track")
+        next_track_id = max(video_track_ids) + 1
+
+        audio_traks = []
+        audio_trex = []
+        for box_type, start, payload, end in iter_boxes(
+            audio_init, audio_moov, audio_moov_end
+        ):
+            if box_type == "trak":
+                trak = bytearray(audio_init[start:end])
+                _, tkhd_payload, _ = find_box(trak, "tkhd", payload - start)
+                offset = tkhd_track_id_offset(trak, tkhd_payload)
+                old_id = struct.unpack_from(">I", trak, offset)[0]
+                self.audio_track_ids[old_id] = next_track_id
+                struct.pack_into(">I", trak, offset, next_track_id)
+                audio_traks.append(bytes(trak))
+                next_track_id += 1
+            elif box_type == "mvex":
+                for child_type, c_start, c_payload, c_end in iter_boxes(
+                    audio_init, payload, end
+                ):
+                    if child_type == "trex":
+                        audio_trex.append(bytearray(audio_init[c_start:c_end]))
+        if not audio_traks:
+            raise Fmp4Error("Audio init segment has no track")
+        for trex in audio_trex:
+            old_id = struct.unpack_from(">I", trex, 12)[0]
+            struct.pack_into(">I", trex, 12, self.audio_track_ids.get(old_id, old_id))
+
+        last_trak = max(
+            i for i, child in enumerate(video_children) if child[0] == "trak"
+        )
+        moov = bytearray()
+        for index, (box_type, start, payload, end) in enumerate(video_children):
+            if box_type == "mvhd":
+                mvhd = bytearray(video_init[start:end])
+                struct.pack_into(">I", mvhd, len(mvhd) - 4, next_track_id)
+                moov += mvhd
+            elif box_type == "mvex":
+                moov += make_box("mvex", video_init[payload:end] + b"".join(audio_trex))
+            else:
+                moov += video_init[start:end]
+            if index == last_trak:
+                moov += b"".join(audio_traks)
+
+        return video_init[ftyp_start:ftyp_end] + make_box("moov", bytes(moov))
+
+    def init_segment(self):
+        self.position = len(self._init)
+        return self._init
+
+    def video_fragment(self, data):
+        return self._rewrite(data, {})
+
+    def audio_fragment(self, data):
+        return self._rewrite(data, self.audio_track_ids)
+
+    def _rewrite(self, data, track_ids):
+        """
+        Keep only moof/mdat boxes, remapping track ids and sequence numbers
+        """
+        data = bytearray(data)
+        output = bytearray()
+        for box_type, start, payload, end in iter_boxes(data):
+            if box_type == "moof":
+                moof_position = self.position + len(output)
+                for child, c_start, c_payload, c_end in iter_boxes(data, payload, end):
+                    if child == "mfhd":
+                        self.sequence_number += 1
+                        struct.pack_into(
+                            ">I", data, c_payload + 4, self.sequence_number
+                        )
+                    elif child == "traf":
+                        self._rewrite_tfhd(
+                            data, c_payload, c_end, track_ids, moof_position
+                        )
+            elif box_type != "mdat":
+                # styp/sidx/prft describe the original single-track file
+                continue
+            output += data[start:end]
+        self.position += len(output)
+        return bytes(output)
+
+    def _rewrite_tfhd(self, data, start, end, track_ids, moof_position):
+        _, payload, _ = find_box(data, "tfhd", start, end)
+        flags = struct.unpack_from(">I", data, payload)[0] & 0xFFFFFF
+        track_id = struct.unpack_from(">I", data, payload + 4)[0]
+        struct.pack_into(">I", data, payload + 4, track_ids.get(track_id, track_id))
+        if flags & 0x000001:
+            # Explicit base-data-offset is absolute, so point it at the moof
+            # in the merged stream
+            struct.pack_into(">Q", data, payload + 8, moof_position)
+
+
+def interleave_order(video_starts, audio_starts):
+    """
+    Order (track, index) pairs by segment start time so both tracks advance
+    together
+    """
+    order = [(start, 0, "video", i) for i, start in enumerate(video_starts)] + [
+        (start, 1, "audio", i) for i, start in enumerate(audio_starts)
+    ]
+    order.sort()
+    return [(track, index) for _, _, track, index in order]
@@ -0,0 +1,268 @@
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import timedelta
+from importlib import import_module
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.db.models import Count, F
+from django.utils import timezone
+
+from . import metrics
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+_handlers = {}
+
+
+def job(kind):
+    """
+    Register a function as the handler for a job kind
+
+    Handlers receive the job payload as keyword arguments.
+    """
+
+    def register(func):
+        _handlers[kind] = func
+        return func
+
+    return register
+
+
+def enqueue(kind, priority=0, owner=None, **payload):
+    """
+    Queue a job for the worker pool
+
+    `owner` is the user the job runs for, so that a pool can share its
+    threads fairly between users.
+    """
+    return Job.objects.create(
+        kind=kind,
+        priority=priority,
+        owner="" if owner is None else str(owner),
+        payload=payload,
+    )
+
+
+def autodiscover():
+    """
+    Import the modules that register job handlers
+    """
+    import_module("api.views")
+
+
+def requeue_stale_jobs():
+    """
+    Put jobs whose worker stopped sending heartbeats back in the queue
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.JOB_STALE_AFTER)
+    return Job.objects.filter(status="running", heartbeat_at__lt=cutoff).update(
+        status="queued", worker=""
+    )
+
+
+def has_pending_job(kind, **payload):
+    lookups = {f"payload__{key}": value for key, value in payload.items()}
+    return Job.objects.filter(
+        kind=kind, status__in=["queued", "running"], **lookups
+    ).exists()
+
+
+def recover_orphans():
+    """
+    Queue work for rows left mid-task without a job to finish them, such
+    as those started by a process that crashed or was restarted
+    """
+    from .models import VimeoVideo, VideoDownload
+
+    recovered = 0
+    orphans = [
+        (
+            "process_video",
+            "video_id",
+            VimeoVideo.objects.filter(status__in=["pending", "processing"]),
+        ),
+        (
+            "download_video",
+            "download_id",
+            VideoDownload.objects.filter(status="downloading"),
+        ),
+        (
+            "merge_video",
+            "download_id",
+            VideoDownload.objects.filter(status="processing"),
+        ),
+    ]
+    for kind, key, queryset in orphans:
+        for pk, user_id in queryset.values_list("pk", "user_id"):
+            if not has_pending_job(kind, **{key: str(pk)}):
+                enqueue(kind, owner=user_id, **{key: str(pk)})
+                recovered += 1
+    return recovered
+
+
+class WorkerPool:
+    """
+    Run queued jobs on a fixed number of threads
+
+    Jobs are claimed with a conditional UPDATE, so any number of pools
+    (in one or many processes) can share the queue without a broker.
+    JOB_CONCURRENCY caps how many jobs of each kind this pool runs at once,
+    JOB_CONCURRENCY_PER_USER how many jobs of one user.
+    """
+
+    def __init__(self, size=None, limits=None, poll_interval=None):
+        self.size = size or settings.JOB_WORKERS
+        self.limits = settings.JOB_CONCURRENCY if limits is None else limits
+        self.poll_interval = poll_interval or settings.JOB_POLL_INTERVAL
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self.running = {}
+        self.owners = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def available_kinds(self):
+        with self._lock:
+            counts = {}
+            for kind in self.running.values():
+                counts[kind] = counts.get(kind, 0) + 1
+        return [
+            kind
+            for kind in _handlers
+            if counts.get(kind, 0) < self.limits.get(kind, self.size)
+        ]
+
+    def busy_owners(self):
+        """
+        Users already running as many jobs here as they may
+        """
+        with self._lock:
+            counts = {}
+            for owner in self.owners.values():
+                counts[owner] = counts.get(owner, 0) + 1
+        return [
+            owner
+            for owner, count in counts.items()
+            if owner and count >= settings.JOB_CONCURRENCY_PER_USER
+        ]
+
+    def claim(self):
+        """
+        Claim the highest-priority runnable job, or return None
+        """
+        kinds = self.available_kinds()
+        if not kinds:
+            return None
+
+        now = timezone.now()
+        candidates = (
+            Job.objects.filter(status="queued", run_after__lte=now, kind__in=kinds)
+            .exclude(owner__in=self.busy_owners())
+            .values_list("pk", flat=True)[:10]
+        )
+        for pk in candidates:
+            claimed = Job.objects.filter(pk=pk, status="queued").update(
+                status="running",
+                worker=self.name,
+                started_at=now,
+                heartbeat_at=now,
+                attempts=F("attempts") + 1,
+            )
+            if claimed:
+                return Job.objects.get(pk=pk)
+        return None
+
+    def execute(self, job):
+        metrics.JOBS_RUNNING.labels(job.kind).inc()
+        try:
+            _handlers[job.kind](**job.payload)
+        except Exception as e:
+            logger.exception("Error running job %s (%s)", job.pk, job.kind)
+            if job.attempts < job.max_attempts:
+                delay = settings.JOB_RETRY_DELAY * 2 ** (job.attempts - 1)
+                Job.objects.filter(pk=job.pk).update(
+                    status="queued",
+                    worker="",
+                    error=str(e),
+                    run_after=timezone.now() + timedelta(seconds=delay),
+                )
+            else:
+                Job.objects.filter(pk=job.pk).update(
+                    status="failed", error=str(e), finished_at=timezone.now()
+                )
+        else:
+            Job.objects.filter(pk=job.pk).update(
+                status="done", finished_at=timezone.now()
+            )
+        finally:
+            with self._lock:
+                self.running.pop(job.pk, None)
+                self.owners.pop(job.pk, None)
+            metrics.JOBS_RUNNING.labels(job.kind).dec()
+            connection.close()
+
+    def heartbeat(self):
+        with self._lock:
+            running = list(self.running)
+        if running:
+            Job.objects.filter(pk__in=running).update(heartbeat_at=timezone.now())
+
+    def start_job(self, job):
+        with self._lock:
+            self.running[job.pk] = job.kind
+            self.owners[job.pk] = job.owner
+        thread = threading.Thread(
+            target=self.execute, args=(job,), name=f"job-{job.pk}", daemon=True
+        )
+        thread.start()
+
+    def run(self):
+        """
+        Process jobs until stop() is called, then wait for running jobs
+        """
+        autodiscover()
+        requeue_stale_jobs()
+        recover_orphans()
+
+        last_heartbeat = time.monotonic()
+        while not self._stopping.is_set():
+            close_old_connections()
+            if time.monotonic() - last_heartbeat >= settings.JOB_HEARTBEAT_INTERVAL:
+                self.heartbeat()
+                requeue_stale_jobs()
+                last_heartbeat = time.monotonic()
+
+            job = None
+            if len(self.running) < self.size:
+                job = self.claim()
+            if job is not None:
+                self.start_job(job)
+            else:
+                self._stopping.wait(self.poll_interval)
+
+        while self.running:
+            time.sleep(self.poll_interval)
+            self.heartbeat()
+
+    def stop(self):
+        self._stopping.set()
+
+
+def queue_stats():
+    """
+    Job counts by kind and status
+    """
+    stats = {}
+    rows = (
+        Job.objects.filter(status__in=["queued", "running"])
+        .values("kind", "status")
+        .annotate(count=Count("pk"))
+        .order_by()
+    )
+    for row in rows:
+        stats.setdefault(row["kind"], {})[row["status"]] = row["count"]
+    return stats
@@ -0,0 +1,42 @@
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api import metrics
+from api.jobs import WorkerPool
+
+
+class Command(BaseCommand):
+    help = "Run the background job worker pool"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, help="Number of jobs to run at once")
+        parser.add_argument(
+            "--poll-interval", type=float, help="Seconds to wait when idle"
+        )
+        parser.add_argument(
+            "--metrics-port", type=int, help="Serve Prometheus metrics on this port"
+        )
+
+    def handle(self, *args, **options):
+        pool = WorkerPool(
+            size=options["workers"], poll_interval=options["poll_interval"]
+        )
+
+        def shutdown(signum, frame):
+            self.stdout.write("Stopping workers, waiting for running jobs...")
+            pool.stop()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+
+        metrics_port = options["metrics_port"] or settings.METRICS_PORT
+        if metrics_port:
+            metrics.serve(metrics_port)
+            self.stdout.write(
+                f"Serving metrics on {settings.METRICS_HOST}:{metrics_port}"
+            )
+
+        self.stdout.write(f"Worker pool {pool.name} started with {pool.size} workers")
+        pool.run()
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from api.manifests import save_manifest
+from api.models import VimeoVideo
+
+
+class Command(BaseCommand):
+    help = "Move inline playlist/master JSON off VimeoVideo into VideoManifest rows"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=200, help="Videos moved per transaction"
+        )
+
+    def handle(self, *args, **options):
+        inline = VimeoVideo.objects.filter(
+            Q(playlist_json__isnull=False) | Q(master_json__isnull=False)
+        )
+        moved = 0
+        while True:
+            with transaction.atomic():
+                batch = list(
+                    inline.order_by("pk").values(
+                        "pk", "original_url", "playlist_json", "master_json"
+                    )[: options["batch_size"]]
+                )
+                if not batch:
+                    break
+                for row in batch:
+                    # A row of its own, with no URL key or expiry: kept for
+                    # this video, never shared with other videos of the URL
+                    manifest = save_manifest(
+                        row["original_url"],
+                        playlist=row["playlist_json"],
+                        master=row["master_json"],
+                        shared=False,
+                    )
+                    VimeoVideo.objects.filter(pk=row["pk"]).update(
+                        manifest=manifest, playlist_json=None, master_json=None
+                    )
+            moved += len(batch)
+            self.stdout.write(f"Moved {moved} manifests")
+
+        self.stdout.write(self.style.SUCCESS(f"Done, {moved} videos moved"))
@@ -0,0 +1,207 @@
+import gzip
+import hashlib
+import re
+from datetime import datetime, timedelta, timezone as dt_timezone
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import fastjson, upstream
+from .models import VideoManifest
+from .singleflight import SingleFlight
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def compression():
+    """
+    Encoding for newly stored manifests
+
+    MANIFEST_COMPRESSION=zstd falls back to gzip when the zstandard
+    package is not installed.
+    """
+    encoding = settings.MANIFEST_COMPRESSION
+    if encoding == "zstd" and zstandard is None:
+        return "gzip"
+    return encoding
+
+
+def encode(data, encoding):
+    """
+    Compress a manifest, given as data or as the JSON bytes fetched
+    """
+    raw = data if isinstance(data, bytes) else fastjson.dumps(data)
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=9).compress(raw)
+    if encoding == "gzip":
+        return gzip.compress(raw, compresslevel=6)
+    return raw
+
+
+def decode(blob, encoding, loads=fastjson.loads):
+    if not blob:
+        return None
+    blob = bytes(blob)
+    if encoding == "zstd":
+        blob = zstandard.ZstdDecompressor().decompress(blob)
+    elif encoding == "gzip":
+        blob = gzip.decompress(blob)
+    return loads(blob)
+
+
+# Query parameters and path segments that carry a URL signature rather
+# than identify the manifest
+SIGNATURE_PARAMS = {"exp", "expires", "hmac", "s", "sig", "signature", "token"}
+SIGNED_SEGMENT = re.compile(r"^(exp=\d+~.*|\d{9,}-0x[0-9a-f]+)$")
+EXPIRY = re.compile(r"(?:^|[/~?&])exp(?:ires)?=(\d{9,})|/(\d{9,})-0x[0-9a-f]+/")
+
+_fetches = SingleFlight()
+
+
+def normalize_url(url):
+    """
+    The URL with signing tokens stripped and query parameters sorted, so
+    differently signed links to one manifest compare equal
+    """
+    parts = urlsplit(url.strip())
+    path = "/".join(
+        segment
+        for segment in parts.path.split("/")
+        if not SIGNED_SEGMENT.match(segment)
+    )
+    query = sorted(
+        (key, value)
+        for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key.lower() not in SIGNATURE_PARAMS
+    )
+    return urlunsplit(
+        (parts.scheme.lower(), parts.netloc.lower(), path, urlencode(query), "")
+    )
+
+
+def manifest_key(url):
+    return hashlib.sha256(normalize_url(url).encode()).hexdigest()
+
+
+def signed_url_expiry(url):
+    """
+    When a signed Vimeo URL stops working, or None if it is not signed
+    """
+    match = EXPIRY.search(url)
+    if match is None:
+        return None
+    timestamp = int(match.group(1) or match.group(2))
+    return datetime.fromtimestamp(timestamp, tz=dt_timezone.utc)
+
+
+def manifest_expiry(url, now=None):
+    """
+    How long a manifest fetched from `url` may be shared: at most
+    MANIFEST_CACHE_TTL, and never past the URL's own signature expiry
+    """
+    now = now or timezone.now()
+    expires_at = now + timedelta(seconds=settings.MANIFEST_CACHE_TTL)
+    signed_until = signed_url_expiry(url)
+    if signed_until is not None:
+        expires_at = min(expires_at, signed_until)
+    return expires_at
+
+
+def save_manifest(url, playlist=None, master=None, expires_at=None, shared=True):
+    """
+    Store raw playlist/master JSON in a new manifest row
+
+    Each manifest is given as decoded data or as the JSON bytes fetched.
+    With shared=True the row takes over the URL's key from the one stored
+    before it, which stays as it is for the videos already pointing at it.
+    """
+    encoding = compression()
+    key = manifest_key(url) if shared else None
+    with transaction.atomic():
+        if key is not None:
+            VideoManifest.objects.filter(url_key=key).update(url_key=None)
+        return VideoManifest.objects.create(
+            url_key=key,
+            source_url=url,
+            encoding=encoding,
+            playlist=encode(playlist, encoding) if playlist is not None else b"",
+            master=encode(master, encoding) if master is not None else b"",
+            fetched_at=timezone.now(),
+            expires_at=expires_at,
+        )
+
+
+def fetch_manifest(url):
+    """
+    Get the playlist JSON for a URL as (VideoManifest, data)
+
+    `data` has the fields needed to index the playlist, which may be all
+    of them (see fastjson.loads_playlist). A stored manifest that has not
+    expired is reused. Otherwise it is fetched from Vimeo, with concurrent
+    requests for the same manifest in this process waiting on a single
+    fetch.
+    """
+    key = manifest_key(url)
+    cached = _fresh_manifest(key)
+    if cached is not None:
+        return cached
+    return _fetches.do(key, _fetch_manifest, url, key)
+
+
+def _fresh_manifest(key):
+    manifest = (
+        VideoManifest.objects.filter(url_key=key, expires_at__gt=timezone.now())
+        .exclude(playlist=b"")
+        .first()
+    )
+    if manifest is None:
+        return None
+    return manifest, decode(
+        manifest.playlist, manifest.encoding, loads=fastjson.loads_playlist
+    )
+
+
+def _fetch_manifest(url, key):
+    # Another process may have stored it while we waited for our turn
+    cached = _fresh_manifest(key)
+    if cached is not None:
+        return cached
+
+    response = upstream.get(url)
+    if response.status_code != 200:
+        raise Exception(f"Failed to fetch playlist: {response.status_code}")
+
+    # Stored as fetched, without decoding and encoding it again
+    data = fastjson.loads_playlist(response.content)
+    manifest = save_manifest(
+        url, playlist=response.content, expires_at=manifest_expiry(url)
+    )
+    return manifest, data
+
+
+def load_manifest(video, kind="playlist"):
+    """
+    Load and decode one of a video's raw manifests ("playlist" or "master")
+
+    Videos that have not been moved by `manage.py split_manifests` yet
+    still have the manifest inline.
+    """
+    if video.manifest_id is not None:
+        row = (
+            VideoManifest.objects.filter(pk=video.manifest_id)
+            .values_list("encoding", kind)
+            .first()
+        )
+        if row is not None:
+            encoding, blob = row
+            return decode(blob, encoding)
+
+    legacy = (
+        type(video).objects.filter(pk=video.pk).values_list(f"{kind}_json", flat=True)
+    )
+    return legacy.first()
@@ -0,0 +1,466 @@
+import bisect
+import contextvars
+import hmac
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Default histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+JOB_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+# Bytes per second, 64 KB/s to 256 MB/s
+RATE_BUCKETS = tuple(2**i * 64 * 1024 for i in range(0, 13))
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+
+class Registry:
+    """
+    The metrics of this process, written out in Prometheus text format
+
+    Values live in this process's memory only and start from zero when it
+    starts. Nothing is shared between the processes of a gunicorn server,
+    so a scrape of /metrics reports whichever worker answered it; see
+    README_DEPLOYMENT.md for scraping each process.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self.metrics.append(metric)
+        return metric
+
+    def exposition(self):
+        lines = []
+        for metric in list(self.metrics):
+            try:
+                samples = list(metric.samples())
+            except Exception:
+                logger.exception("Error collecting metric %s", metric.name)
+                continue
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, labels, value in samples:
+                lines.append(
+                    f"{metric.name}{suffix}{format_labels(labels)} {format_value(value)}"
+                )
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{escape(value)}"' for name, value in labels.items())
+    return "{" + pairs + "}"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Metric:
+    """
+    A named metric, optionally split by labels
+
+    Metrics without labels are updated directly (`metric.inc()`), labelled
+    ones through a child (`metric.labels("video").inc()`). A `collect`
+    function makes the metric read its value when scraped instead: it
+    returns a value, or a dict of label value tuples to values.
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labels=(), collect=None):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.collect = collect
+        self._children = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def labels(self, *values):
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.get(key)
+                if child is None:
+                    child = self._children[key] = self.new_child()
+        return child
+
+    def new_child(self):
+        raise NotImplementedError
+
+    def samples(self):
+        if self.collect is not None:
+            values = self.collect()
+            if not isinstance(values, dict):
+                values = {(): values}
+            for key, value in values.items():
+                yield "", dict(zip(self.label_names, key)), value
+            return
+        for key, child in list(self._children.items()):
+            labels = dict(zip(self.label_names, key))
+            for suffix, extra, value in child.samples():
+                yield suffix, {**labels, **extra}, value
+
+
+class Value:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        yield "", {}, self.value
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def new_child(self):
+        return Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def new_child(self):
+        return Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = 0
+        for bound, count in zip((*self.buckets, math.inf), counts):
+            cumulative += count
+            yield "_bucket", {"le": format_value(float(bound))}, cumulative
+        yield "_sum", {}, total
+        yield "_count", {}, cumulative
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labels)
+
+    def new_child(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+
+# Upstream segment fetches
+UPSTREAM_SEGMENT_SECONDS = Histogram(
+    "vimeo_upstream_segment_seconds", "Time to fetch one segment from upstream"
+)
+UPSTREAM_SEGMENT_RATE = Histogram(
+    "vimeo_upstream_segment_bytes_per_second",
+    "Throughput of single upstream segment fetches",
+    buckets=RATE_BUCKETS,
+)
+UPSTREAM_SEGMENT_BYTES = Counter(
+    "vimeo_upstream_segment_bytes_total", "Segment bytes received from upstream"
+)
+UPSTREAM_SEGMENT_ERRORS = Counter(
+    "vimeo_upstream_segment_errors_total",
+    "Failed upstream segment fetch attempts, by whether they were retried",
+    labels=("outcome",),
+)
+
+# Tasks
+MANIFEST_FETCH_SECONDS = Histogram(
+    "vimeo_manifest_fetch_seconds", "Time to fetch and decode a playlist manifest"
+)
+TASK_SECONDS = Histogram(
+    "vimeo_task_seconds",
+    "Duration of background tasks",
+    labels=("task", "outcome"),
+    buckets=JOB_BUCKETS,
+)
+MERGE_STAGE_SECONDS = Histogram(
+    "vimeo_merge_stage_seconds",
+    "Duration of each stage of a merge",
+    labels=("stage",),
+    buckets=JOB_BUCKETS,
+)
+MERGE_STAGE_WAITING_SECONDS = Histogram(
+    "vimeo_merge_stage_waiting_seconds",
+    "Time each merge stage spent blocked on its queues",
+    labels=("stage",),
+    buckets=JOB_BUCKETS,
+)
+JOBS_RUNNING = Gauge(
+    "vimeo_jobs_running", "Jobs running in this worker process", labels=("kind",)
+)
+
+# Chunk streaming
+CHUNK_REQUESTS = Counter(
+    "vimeo_chunk_requests_total",
+    "Chunk requests by where the chunk was served from",
+    labels=("source",),
+)
+CHUNK_OPEN_SECONDS = Histogram(
+    "vimeo_chunk_open_seconds",
+    "Time for get_chunk_data to return a stream for a chunk",
+)
+
+# Requests and the database
+AUTH_USER_CACHE = Counter(
+    "vimeo_auth_user_cache_total",
+    "User lookups by JWT authentication, by where the user was found",
+    labels=("result",),
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "vimeo_http_request_seconds",
+    "Time to produce a response (headers only for streamed responses)",
+    labels=("view", "method"),
+)
+HTTP_REQUEST_DB_QUERIES = Histogram(
+    "vimeo_http_request_db_queries",
+    "Database queries run per request",
+    labels=("view",),
+    buckets=COUNT_BUCKETS,
+)
+DB_QUERY_SECONDS = Histogram(
+    "vimeo_db_query_seconds", "Time taken by single database queries"
+)
+
+
+# Queries run for the current request, for HTTP_REQUEST_DB_QUERIES. The
+# list is shared with the threads async views run their queries on.
+_request_queries = contextvars.ContextVar("request_queries", default=None)
+
+
+def count_queries(execute, sql, params, many, context):
+    """
+    Database execute wrapper timing every query
+    """
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        DB_QUERY_SECONDS.observe(time.perf_counter() - start)
+        queries = _request_queries.get()
+        if queries is not None:
+            queries[0] += 1
+
+
+def install_query_wrapper(sender, connection, **kwargs):
+    """
+    connection_created handler adding count_queries to every connection
+    """
+    if count_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_queries)
+
+
+@contextmanager
+def track_request(request):
+    """
+    Record the time and database queries taken to answer a request
+    """
+    queries = [0]
+    token = _request_queries.set(queries)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        _request_queries.reset(token)
+        match = getattr(request, "resolver_match", None)
+        view = match.url_name if match and match.url_name else "unmatched"
+        HTTP_REQUEST_SECONDS.labels(view, request.method).observe(elapsed)
+        HTTP_REQUEST_DB_QUERIES.labels(view).observe(queries[0])
+
+
+def register_process_metrics():
+    """
+    Metrics read from the rest of the app when scraped, so they cost
+    nothing until then
+    """
+    from .cache import segment_cache
+    from .coalesce import coalescer
+    from .jobs import queue_stats
+    from .scheduler import scheduler
+
+    def cache_stat(name):
+        def collect():
+            cache = segment_cache()
+            return cache.stats()[name] if cache else 0
+
+        return collect
+
+    def job_queue():
+        return {
+            (kind, status): count
+            for kind, statuses in queue_stats().items()
+            for status, count in statuses.items()
+        }
+
+    Gauge(
+        "vimeo_threads", "Live threads in this process", collect=threading.active_count
+    )
+    Gauge(
+        "vimeo_active_downloads",
+        "Downloads fetching segments in this process",
+        collect=lambda: scheduler.stats()["downloads"],
+    )
+    Gauge(
+        "vimeo_scheduler_in_flight",
+        "Segment fetches holding a scheduler slot",
+        collect=lambda: scheduler.in_flight,
+    )
+    Gauge(
+        "vimeo_scheduler_waiting",
+        "Segment fetches waiting for a scheduler slot",
+        collect=lambda: scheduler.stats()["waiting"],
+    )
+    Counter(
+        "vimeo_scheduler_throttled_seconds_total",
+        "Time segment fetches slept to keep within the bandwidth limits",
+        collect=lambda: scheduler.throttled_seconds,
+    )
+    Gauge(
+        "vimeo_job_queue_depth",
+        "Queued and running jobs",
+        labels=("kind", "status"),
+        collect=job_queue,
+    )
+    Counter(
+        "vimeo_segment_cache_hits_total",
+        "Segment cache hits",
+        collect=cache_stat("hits"),
+    )
+    Counter(
+        "vimeo_segment_cache_misses_total",
+        "Segment cache misses",
+        collect=cache_stat("misses"),
+    )
+    Gauge(
+        "vimeo_segment_cache_bytes",
+        "Bytes held in the segment cache",
+        collect=cache_stat("size_bytes"),
+    )
+    Gauge(
+        "vimeo_coalescer_in_flight",
+        "Upstream fetches shared by concurrent chunk requests",
+        collect=lambda: coalescer.stats()["in_flight"],
+    )
+
+
+def authorized(header, require_token=False):
+    """
+    Whether an Authorization header carries METRICS_TOKEN
+
+    Without a token set, scrapes are allowed unless `require_token`.
+    """
+    token = settings.METRICS_TOKEN
+    if not token:
+        return not require_token
+    return hmac.compare_digest(header or "", f"Bearer {token}")
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if not authorized(self.headers.get("Authorization")):
+            self.send_response(401)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = registry.exposition().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host=None):
+    """
+    Serve /metrics from a process without a web server, such as the
+    background workers
+
+    Listens on METRICS_HOST (localhost unless configured otherwise) and
+    checks METRICS_TOKEN like the web view does.
+    """
+    host = settings.METRICS_HOST if host is None else host
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
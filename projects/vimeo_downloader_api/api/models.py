@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 import uuid
 
 class VimeoVideo(models.Model):
@@ -8,9 +9,12 @@ class VimeoVideo(models.Model):
     original_url = models.URLField(max_length=500)
     video_id = models.CharField(max_length=100, blank=True)
     
-    # Playlist/master data
+    # Playlist/master data (raw manifests now live in VideoManifest; these
+    # inline copies are emptied by `manage.py split_manifests`)
     playlist_json = models.JSONField(null=True, blank=True)
     master_json = models.JSONField(null=True, blank=True)
+    playlist_index = models.JSONField(null=True, blank=True)  # see api.playlist
+    manifest = models.ForeignKey('VideoManifest', null=True, blank=True, on_delete=models.SET_NULL, related_name='videos')
     base_url = models.CharField(max_length=500, blank=True)
     
     # Video metadata
@@ -34,6 +38,23 @@ class VimeoVideo(models.Model):
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Keyset pagination of a user's videos (api.pagination)
+            models.Index(fields=['user', '-created_at', '-id']),
+        ]
+
+# Raw manifests, compressed, kept off the hot VimeoVideo row and shared by
+# every video submitted with the same (normalized) URL. Rows are never
+# rewritten: a new fetch gets a new row and takes over the URL key, so
+# videos keep the manifest they were processed from
+class VideoManifest(models.Model):
+    url_key = models.CharField(max_length=64, unique=True, null=True, blank=True)  # see api.manifests.manifest_key; None once superseded
+    source_url = models.URLField(max_length=2000)
+    encoding = models.CharField(max_length=10, default='gzip')  # 'zstd', 'gzip' or 'none'
+    playlist = models.BinaryField(default=b'')
+    master = models.BinaryField(default=b'')
+    fetched_at = models.DateTimeField(default=timezone.now)
+    expires_at = models.DateTimeField(null=True, blank=True)  # reuse until
 
 class VideoDownload(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -58,10 +79,16 @@ class VideoDownload(models.Model):
     progress = models.FloatField(default=0.0)  # 0.0 to 1.0
     downloaded_chunks = models.IntegerField(default=0)
     total_chunks = models.IntegerField(default=0)
+    video_segments = models.BinaryField(default=b'')  # bitmap of received segments
+    audio_segments = models.BinaryField(default=b'')
     
     # File info
     file_size = models.BigIntegerField(default=0)  # in bytes
+    output_path = models.CharField(max_length=500, blank=True)  # merged file
     estimated_duration = models.IntegerField(default=0)  # in seconds
+    downloaded_bytes = models.BigIntegerField(default=0)
+    bytes_per_second = models.FloatField(default=0.0)  # recent rate
+    stage_timings = models.JSONField(default=dict, blank=True)  # merge stages, s
     
     # Timing
     created_at = models.DateTimeField(auto_now_add=True)
@@ -69,4 +96,57 @@ class VideoDownload(models.Model):
     completed_at = models.DateTimeField(null=True, blank=True)
     
     class Meta:
-        ordering = ['-created_at']
\ No newline at end of file
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', '-created_at', '-id']),
+        ]
+
+# Measured download bandwidth, see api.throughput
+class ThroughputEstimate(models.Model):
+    HOST = 'host'
+    WORKER = 'worker'
+    SCOPE_CHOICES = [
+        (HOST, 'Host'),
+        (WORKER, 'Worker'),
+    ]
+    scope = models.CharField(max_length=10, choices=SCOPE_CHOICES)
+    key = models.CharField(max_length=255)  # CDN host or worker name
+    bytes_per_second = models.FloatField()
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['scope', 'key'], name='unique_throughput_scope_key'),
+        ]
+
+class Job(models.Model):
+    kind = models.CharField(max_length=50)
+    payload = models.JSONField(default=dict)
+    priority = models.IntegerField(default=0)  # higher runs first
+    owner = models.CharField(max_length=64, blank=True)  # user the job runs for
+    
+    # Status tracking
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField(default=3)
+    worker = models.CharField(max_length=255, blank=True)
+    error = models.TextField(blank=True)
+    
+    # Timing
+    created_at = models.DateTimeField(auto_now_add=True)
+    run_after = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['-priority', 'created_at']
+        indexes = [
+            models.Index(fields=['status', '-priority', 'created_at']),
+        ]
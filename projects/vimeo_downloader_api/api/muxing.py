@@ -0,0 +1,203 @@
+import logging
+import os
+import shutil
+import subprocess
+
+from django.conf import settings
+
+from .fmp4 import FragmentedMuxer, interleave_order
+from .pipeline import Pipeline
+from .relay import copy_stream
+from .segments import SegmentFetcher
+
+logger = logging.getLogger(__name__)
+
+
+class MuxError(Exception):
+    pass
+
+
+def remux(video_path, audio_path, output_path):
+    """
+    Mux the video and audio tracks into one MP4 without transcoding
+    """
+    ffmpeg = shutil.which(settings.FFMPEG_BINARY)
+    if not ffmpeg:
+        raise MuxError(f"{settings.FFMPEG_BINARY} not found")
+
+    command = [
+        ffmpeg,
+        "-y",
+        "-loglevel",
+        "error",
+        "-i",
+        video_path,
+        "-i",
+        audio_path,
+        "-map",
+        "0:v:0",
+        "-map",
+        "1:a:0",
+        "-c",
+        "copy",
+        "-movflags",
+        "+faststart",
+        output_path,
+    ]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise MuxError(f"ffmpeg exited with {result.returncode}: {result.stderr}")
+
+
+def reencode(video_path, audio_path, output_path):
+    """
+    Decode and re-encode both tracks with moviepy
+    """
+    from moviepy.editor import VideoFileClip, AudioFileClip
+
+    video_clip = VideoFileClip(video_path)
+    audio_clip = AudioFileClip(audio_path)
+    try:
+        video_clip_with_audio = video_clip.set_audio(audio_clip)
+        video_clip_with_audio.write_videofile(
+            output_path, codec="libx264", audio_codec="aac"
+        )
+    finally:
+        audio_clip.close()
+        video_clip.close()
+
+
+def merge(video_path, audio_path, output_path, mode=None):
+    """
+    Merge video and audio tracks, returning the mode that was used
+
+    "copy" remuxes the streams as delivered by Vimeo (H.264/AAC). The
+    re-encode path only runs when asked for explicitly, either as the
+    mode or through MERGE_REENCODE_FALLBACK when the remux fails.
+    """
+    mode = mode or settings.MERGE_MODE
+
+    if mode == "copy":
+        try:
+            remux(video_path, audio_path, output_path)
+            return "copy"
+        except MuxError as e:
+            if not settings.MERGE_REENCODE_FALLBACK:
+                raise
+            logger.warning("Stream copy failed, falling back to re-encode: %s", e)
+    elif mode != "reencode":
+        raise MuxError(f"Unknown merge mode: {mode}")
+
+    reencode(video_path, audio_path, output_path)
+    return "reencode"
+
+
+def merge_pipeline(
+    workspace, video_track, audio_track, output_path, reporter=None, flow=None
+):
+    """
+    Build the stage graph that downloads and merges a video's tracks
+
+    Video and audio segments are fetched concurrently, each by its own
+    stage, and handed on in playlist order through bounded queues. With
+    MERGE_MODE=fragmented a single mux stage interleaves them straight
+    into a fragmented MP4 as soon as the first segments of both tracks
+    are on disk. Otherwise each track is written out by an assemble stage
+    while it downloads, and the mux stage runs merge() once both are
+    complete.
+    """
+    tracks = {"video": video_track, "audio": audio_track}
+    pipeline = Pipeline()
+    fetcher = SegmentFetcher(flow=flow)
+    segments = {kind: pipeline.queue() for kind in tracks}
+
+    for kind, track in tracks.items():
+        pipeline.stage(
+            f"{kind}_fetch",
+            fetch_stage,
+            workspace,
+            kind,
+            track,
+            fetcher,
+            segments[kind],
+            reporter,
+        )
+
+    mode = settings.MERGE_MODE
+    if mode == "fragmented":
+        pipeline.stage(
+            "mux", fragmented_mux_stage, workspace, tracks, segments, output_path
+        )
+        return pipeline
+
+    assembled = pipeline.queue()
+    for kind, track in tracks.items():
+        pipeline.stage(
+            f"{kind}_assemble",
+            assemble_stage,
+            workspace,
+            kind,
+            track,
+            segments[kind],
+            assembled,
+        )
+    pipeline.stage("mux", merge_stage, assembled, output_path, mode)
+    return pipeline
+
+
+def fetch_stage(workspace, kind, track, fetcher, segments, reporter):
+    """
+    Pass on the index of each segment of a track once it is on disk
+    """
+    for index in workspace.iter_fetch(kind, track, fetcher):
+        if reporter is not None:
+            size = os.path.getsize(workspace.segment_path(kind, index))
+            reporter.mark_segment(kind, index, size)
+        segments.put(index)
+    segments.close()
+
+
+def assemble_stage(workspace, kind, track, segments, assembled):
+    """
+    Write a track out (init segment first) as its segments arrive
+    """
+    output_path = workspace.path(f"{kind}.mp4")
+    with open(output_path, "wb") as output:
+        output.write(track.init_segment)
+        for index in segments:
+            with open(workspace.segment_path(kind, index), "rb") as segment:
+                copy_stream(segment, output)
+    assembled.put((kind, output_path))
+
+
+def merge_stage(assembled, output_path, mode):
+    """
+    Merge the assembled tracks once both are complete
+    """
+    paths = dict(assembled.get() for _ in range(2))
+    merge(paths["video"], paths["audio"], output_path, mode)
+
+
+def fragmented_mux_stage(workspace, tracks, segments, output_path):
+    """
+    Interleave both tracks' segments into a fragmented MP4 as they arrive
+    """
+    video_track, audio_track = tracks["video"], tracks["audio"]
+    muxer = FragmentedMuxer(video_track.init_segment, audio_track.init_segment)
+    rewrite = {"video": muxer.video_fragment, "audio": muxer.audio_fragment}
+
+    # Written under a temporary name so a served output is always complete
+    part_path = output_path + ".part"
+    try:
+        with open(part_path, "wb") as output:
+            output.write(muxer.init_segment())
+            for kind, index in interleave_order(video_track.starts, audio_track.starts):
+                # Segments arrive in playlist order, so this is `index`
+                received = segments[kind].get()
+                with open(workspace.segment_path(kind, received), "rb") as segment:
+                    output.write(rewrite[kind](segment.read()))
+        os.replace(part_path, output_path)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
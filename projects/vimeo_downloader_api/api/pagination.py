@@ -0,0 +1,43 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class CreatedCursorPagination(CursorPagination):
+    """
+    Keyset pagination over a user's rows, newest first
+
+    Pages are fetched with `created_at < cursor` rather than an OFFSET, so
+    a page costs the same however deep it is. The cursor holds only
+    created_at: rows created in the same instant as the last one on a page
+    are stepped over with a small offset, and ordering on id as well keeps
+    their order the same from one request to the next. Backed by the
+    (user, created_at, id) indexes on the models.
+    """
+
+    ordering = ("-created_at", "-id")
+    page_size = settings.API_PAGE_SIZE
+    page_size_query_param = "page_size"
+    max_page_size = 500
+
+
+def requested_fields(request, serializer_class):
+    """
+    Fields named in ?fields=, limited to those the serializer offers
+    """
+    available = serializer_class.Meta.fields
+    names = request.query_params.get("fields")
+    if not names:
+        return list(available)
+    fields = [name.strip() for name in names.split(",") if name.strip() in available]
+    return fields or list(available)
+
+
+def model_fields(serializer_class, fields):
+    """
+    Model fields needed to serialize `fields`, for QuerySet.only()
+    """
+    sources = getattr(serializer_class.Meta, "field_sources", {})
+    names = []
+    for name in fields:
+        names.extend(sources.get(name, (name,)))
+    return names
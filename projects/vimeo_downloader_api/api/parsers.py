@@ -0,0 +1,26 @@
+import codecs
+
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+
+from . import fastjson
+
+
+class FastJSONParser(JSONParser):
+    """
+    JSONParser decoding with orjson or msgspec when installed
+
+    Bodies in encodings other than UTF-8 are left to JSONParser.
+    """
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get("encoding", settings.DEFAULT_CHARSET)
+        if fastjson.backend() == "stdlib" or codecs.lookup(encoding).name != "utf-8":
+            return super().parse(stream, media_type, parser_context)
+
+        try:
+            return fastjson.loads(stream.read())
+        except ValueError as exc:
+            raise ParseError(f"JSON parse error - {exc}")
@@ -0,0 +1,193 @@
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+# Marks the end of a StageQueue
+END = object()
+
+# How often a blocked stage checks whether the pipeline has failed (s)
+POLL_INTERVAL = 0.1
+
+
+class PipelineAborted(Exception):
+    pass
+
+
+class StageQueue:
+    """
+    Bounded queue between two pipeline stages
+
+    A producer that gets ahead blocks once `maxsize` items are waiting, so
+    a slow consumer holds back the stages feeding it. Time spent blocked
+    is charged to the calling stage, and either side gives up with
+    PipelineAborted as soon as any stage fails.
+    """
+
+    def __init__(self, pipeline, maxsize):
+        self.pipeline = pipeline
+        self._queue = queue.Queue(maxsize)
+
+    def put(self, item):
+        stage = self.pipeline.current_stage()
+        start = time.monotonic()
+        while True:
+            self.pipeline.check()
+            try:
+                self._queue.put(item, timeout=POLL_INTERVAL)
+                break
+            except queue.Full:
+                pass
+        if stage is not None:
+            stage.waited(time.monotonic() - start)
+            if item is not END:
+                stage.moved()
+
+    def get(self):
+        stage = self.pipeline.current_stage()
+        start = time.monotonic()
+        while True:
+            self.pipeline.check()
+            try:
+                item = self._queue.get(timeout=POLL_INTERVAL)
+                break
+            except queue.Empty:
+                pass
+        if stage is not None:
+            stage.waited(time.monotonic() - start)
+            if item is not END:
+                stage.moved()
+        return item
+
+    def close(self):
+        self.put(END)
+
+    def __iter__(self):
+        while True:
+            item = self.get()
+            if item is END:
+                return
+            yield item
+
+
+class Stage:
+    """
+    One step of a pipeline, run on its own thread
+    """
+
+    def __init__(self, pipeline, name, func, args):
+        self.pipeline = pipeline
+        self.name = name
+        self.func = func
+        self.args = args
+        self.started = None
+        self.finished = None
+        self.first_item = None
+        self.items = 0
+        self.waiting = 0.0
+        self.thread = threading.Thread(
+            target=self.run, name=f"stage-{name}", daemon=True
+        )
+
+    def run(self):
+        self.pipeline.local.stage = self
+        self.started = time.monotonic()
+        try:
+            self.func(*self.args)
+        except BaseException as e:
+            self.pipeline.fail(e)
+        finally:
+            self.finished = time.monotonic()
+            # Stages may have written progress from this thread
+            connection.close()
+
+    def waited(self, seconds):
+        self.waiting += seconds
+
+    def moved(self):
+        if self.first_item is None:
+            self.first_item = time.monotonic()
+        self.items += 1
+
+    def timings(self, origin):
+        """
+        Offsets from the start of the pipeline and time spent, in seconds
+
+        `first_item` is when the stage first received or emitted an item,
+        `waiting` the part of `seconds` spent blocked on its queues.
+        """
+        timings = {"items": self.items, "waiting": round(self.waiting, 3)}
+        if self.started is not None:
+            timings["start"] = round(self.started - origin, 3)
+        if self.first_item is not None:
+            timings["first_item"] = round(self.first_item - origin, 3)
+        if self.started is not None and self.finished is not None:
+            timings["seconds"] = round(self.finished - self.started, 3)
+        return timings
+
+
+class Pipeline:
+    """
+    Stages running concurrently, connected by bounded StageQueues
+
+    Each stage is a function called with its arguments on a thread of its
+    own; stages pass work along through the queues made by queue(). The
+    first stage to raise stops the others and its error is re-raised by
+    run().
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.local = threading.local()
+        self.started = None
+        self.finished = None
+        self.error = None
+        self._failed = threading.Event()
+        self._lock = threading.Lock()
+
+    def queue(self, maxsize=None):
+        return StageQueue(self, maxsize or settings.MERGE_QUEUE_SIZE)
+
+    def stage(self, name, func, *args):
+        self.stages.append(Stage(self, name, func, args))
+
+    def current_stage(self):
+        return getattr(self.local, "stage", None)
+
+    def fail(self, error):
+        with self._lock:
+            if self.error is None:
+                self.error = error
+        self._failed.set()
+
+    def check(self):
+        if self._failed.is_set():
+            raise PipelineAborted()
+
+    def run(self):
+        """
+        Run every stage to completion
+        """
+        self.started = time.monotonic()
+        try:
+            for stage in self.stages:
+                stage.thread.start()
+            for stage in self.stages:
+                stage.thread.join()
+        finally:
+            self.finished = time.monotonic()
+        if self.error is not None:
+            raise self.error
+
+    def timings(self):
+        """
+        Per-stage timings plus the total, for storing on the download
+        """
+        if self.started is None:
+            return {}
+        timings = {stage.name: stage.timings(self.started) for stage in self.stages}
+        if self.finished is not None:
+            timings["total"] = {"seconds": round(self.finished - self.started, 3)}
+        return timings
@@ -0,0 +1,253 @@
+import base64
+import threading
+from collections import OrderedDict
+from urllib.parse import urljoin
+
+from django.conf import settings
+
+from .db import database_sync_to_async
+from .manifests import load_manifest
+
+
+class TrackIndex:
+    """
+    One video resolution or audio track with its segments pre-resolved
+
+    Segment URLs are already joined against the playlist base URLs, and
+    offsets[n] is the byte offset of segment n in the concatenated track.
+    """
+
+    __slots__ = (
+        "height",
+        "bitrate",
+        "duration",
+        "init_segment_b64",
+        "urls",
+        "sizes",
+        "offsets",
+        "starts",
+        "durations",
+        "_init_segment",
+    )
+
+    def __init__(
+        self,
+        height,
+        bitrate,
+        duration,
+        init_segment_b64,
+        urls,
+        sizes,
+        starts,
+        durations,
+    ):
+        self.height = height
+        self.bitrate = bitrate
+        self.duration = duration
+        self.init_segment_b64 = init_segment_b64
+        self.urls = urls
+        self.sizes = sizes
+        self.starts = starts
+        self.durations = durations
+        self.offsets = []
+        offset = 0
+        for size in sizes:
+            self.offsets.append(offset)
+            offset += size
+        self._init_segment = None
+
+    @classmethod
+    def build(cls, media_data, base_url):
+        segment_base = base_url + media_data.get("base_url", "")
+        urls, sizes, starts, durations = [], [], [], []
+        elapsed = 0.0
+        for segment in media_data.get("segments", []):
+            urls.append(urljoin(segment_base, segment["url"]))
+            sizes.append(segment.get("size") or segment.get("length") or 0)
+            start = segment.get("start", elapsed)
+            if "end" in segment:
+                duration = segment["end"] - start
+            else:
+                duration = segment.get("duration", 0)
+            starts.append(start)
+            durations.append(duration)
+            elapsed = start + duration
+
+        return cls(
+            height=media_data.get("height"),
+            bitrate=media_data.get("bitrate", 0),
+            duration=media_data.get("duration", elapsed),
+            init_segment_b64=media_data.get("init_segment", ""),
+            urls=urls,
+            sizes=sizes,
+            starts=starts,
+            durations=durations,
+        )
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            height=data["height"],
+            bitrate=data["bitrate"],
+            duration=data["duration"],
+            init_segment_b64=data["init"],
+            urls=data["urls"],
+            sizes=data["sizes"],
+            starts=data["starts"],
+            durations=data["durations"],
+        )
+
+    def to_dict(self):
+        return {
+            "height": self.height,
+            "bitrate": self.bitrate,
+            "duration": self.duration,
+            "init": self.init_segment_b64,
+            "urls": self.urls,
+            "sizes": self.sizes,
+            "starts": self.starts,
+            "durations": self.durations,
+        }
+
+    @property
+    def init_segment(self):
+        if self._init_segment is None:
+            self._init_segment = base64.b64decode(self.init_segment_b64)
+        return self._init_segment
+
+    @property
+    def total_size(self):
+        return sum(self.sizes)
+
+    def __len__(self):
+        return len(self.urls)
+
+    def segment_url(self, number):
+        if 0 <= number < len(self.urls):
+            return self.urls[number]
+        return None
+
+
+class PlaylistIndex:
+    """
+    Precomputed lookup tables for a Vimeo playlist.json
+    """
+
+    version = 1
+
+    def __init__(self, video_tracks, audio):
+        self.video_tracks = video_tracks
+        self.audio = audio
+
+    @classmethod
+    def build(cls, playlist, base_url):
+        video_tracks = {}
+        for media_data in playlist.get("video", []):
+            if "height" in media_data:
+                video_tracks[media_data["height"]] = TrackIndex.build(
+                    media_data, base_url
+                )
+
+        audio = None
+        if playlist.get("audio"):
+            best = max(playlist["audio"], key=lambda x: x.get("bitrate", 0))
+            audio = TrackIndex.build(best, base_url)
+
+        return cls(video_tracks, audio)
+
+    @classmethod
+    def from_dict(cls, data):
+        video_tracks = {
+            int(height): TrackIndex.from_dict(track)
+            for height, track in data["video"].items()
+        }
+        audio = TrackIndex.from_dict(data["audio"]) if data.get("audio") else None
+        return cls(video_tracks, audio)
+
+    def to_dict(self):
+        return {
+            "version": self.version,
+            "video": {
+                str(height): track.to_dict()
+                for height, track in self.video_tracks.items()
+            },
+            "audio": self.audio.to_dict() if self.audio else None,
+        }
+
+    def video(self, resolution):
+        """
+        Get the video track for a resolution such as "1080p"
+        """
+        try:
+            height = int(str(resolution).replace("p", ""))
+        except ValueError:
+            return None
+        return self.video_tracks.get(height)
+
+    def track(self, chunk_type, resolution):
+        if chunk_type == "video":
+            return self.video(resolution)
+        return self.audio
+
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def get_playlist_index(video):
+    """
+    Get the parsed playlist index for a video, cached per process
+
+    The stored index is only loaded (and parsed) on a cache miss, so
+    callers should defer the playlist columns when fetching the video.
+    Videos processed before the index existed get one built and saved.
+    Returns None, saving and caching nothing, when the video has no
+    stored index and no manifest to build one from.
+    """
+    index = _cached_index(video)
+    if index is not None:
+        return index
+
+    data = video.playlist_index
+    if data and data.get("version") == PlaylistIndex.version:
+        index = PlaylistIndex.from_dict(data)
+    else:
+        manifest = load_manifest(video)
+        if manifest is None:
+            return None
+        index = PlaylistIndex.build(manifest, video.base_url)
+        type(video).objects.filter(pk=video.pk).update(playlist_index=index.to_dict())
+
+    cache_playlist_index(video, index)
+    return index
+
+
+async def aget_playlist_index(video):
+    """
+    Async counterpart of get_playlist_index
+
+    Cache hits stay on the event loop; only a miss, which has to load the
+    deferred column, is handed to a thread.
+    """
+    index = _cached_index(video)
+    if index is not None:
+        return index
+    return await database_sync_to_async(get_playlist_index)(video)
+
+
+def _cached_index(video):
+    key = (video.pk, video.processed_at)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is not None:
+            _indexes.move_to_end(key)
+        return index
+
+
+def cache_playlist_index(video, index):
+    key = (video.pk, video.processed_at)
+    with _indexes_lock:
+        _indexes[key] = index
+        _indexes.move_to_end(key)
+        while len(_indexes) > settings.PLAYLIST_INDEX_CACHE_SIZE:
+            _indexes.popitem(last=False)
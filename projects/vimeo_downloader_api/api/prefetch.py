@@ -0,0 +1,261 @@
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from .coalesce import coalescer
+from .scheduler import scheduler
+from .workspace import DownloadWorkspace
+
+logger = logging.getLogger(__name__)
+
+# Weight of the newest sample in the moving averages
+SMOOTHING = 0.3
+
+
+def ewma(average, sample):
+    return sample if average is None else average + SMOOTHING * (sample - average)
+
+
+class PrefetchBuffer:
+    """
+    Prefetched segments kept in memory when the segment cache is disabled
+
+    Bounded by max_bytes, evicting the oldest segments first. A segment is
+    removed once it has been served.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._segments = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def put(self, url, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._segments.pop(url, None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._segments[url] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, evicted = self._segments.popitem(last=False)
+                self._size -= len(evicted)
+
+    def take(self, url):
+        with self._lock:
+            data = self._segments.pop(url, None)
+            if data is not None:
+                self._size -= len(data)
+            return data
+
+    def __contains__(self, url):
+        with self._lock:
+            return url in self._segments
+
+
+class PrefetchedSegment:
+    """
+    A segment taken from the PrefetchBuffer, read like a SegmentReader
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.length = len(data)
+
+    def iter_chunks(self):
+        yield self.data
+
+    async def aiter_chunks(self):
+        yield self.data
+
+
+class ReadAhead:
+    """
+    Streaming position and pace of one download's track
+    """
+
+    def __init__(self):
+        self.position = None
+        self.ahead = -1
+        self.interval = None
+        self.last_seen = None
+        self.generation = 0
+
+
+class Prefetcher:
+    """
+    Read ahead of clients streaming chunks in order
+
+    When chunk N of a track is served, segments N+1..N+K are fetched in
+    the background into the segment cache (or a PrefetchBuffer when the
+    cache is disabled). The request for N+1 then finds the segment on
+    disk, or joins the fetch that is already under way.
+
+    K covers the upstream fetch time at the pace the client is consuming
+    chunks: ceil(fetch time / request interval) + 1, clamped to
+    PREFETCH_MAX_AHEAD. A request out of sequence (a seek) restarts the
+    read-ahead from the new position. Queued prefetches for a position
+    the client has left, or for a download nobody has requested for
+    PREFETCH_IDLE_TIMEOUT seconds, are dropped before they start.
+
+    Prefetches run under the FairScheduler as flows of the user streaming,
+    so they take that user's share of connections and bandwidth like the
+    download jobs do.
+    """
+
+    def __init__(self):
+        self._streams = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._buffer = None
+        self.fetch_seconds = None
+        self.scheduled = 0
+        self.fetched = 0
+        self.cancelled = 0
+
+    @property
+    def enabled(self):
+        return settings.PREFETCH_MAX_AHEAD > 0
+
+    def executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        settings.PREFETCH_WORKERS, thread_name_prefix="prefetch"
+                    )
+        return self._executor
+
+    def buffer(self):
+        if self._buffer is None:
+            with self._lock:
+                if self._buffer is None:
+                    self._buffer = PrefetchBuffer(settings.PREFETCH_BUFFER_BYTES)
+        return self._buffer
+
+    def take(self, url):
+        """
+        Pop a segment prefetched into memory, or return None
+        """
+        if self._buffer is None:
+            return None
+        return self._buffer.take(url)
+
+    def depth(self, state):
+        if state.interval is None or self.fetch_seconds is None:
+            return min(2, settings.PREFETCH_MAX_AHEAD)
+        ahead = math.ceil(self.fetch_seconds / max(state.interval, 0.001)) + 1
+        return max(1, min(ahead, settings.PREFETCH_MAX_AHEAD))
+
+    def advance(self, download, chunk_type, chunk_number, track, cache=None):
+        """
+        Record that a chunk of a download was requested and read ahead of it
+        """
+        if not self.enabled:
+            return
+
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            key = (download.id, chunk_type)
+            state = self._streams.get(key)
+            if state is None:
+                state = self._streams[key] = ReadAhead()
+
+            if state.position is not None and chunk_number == state.position + 1:
+                state.interval = ewma(state.interval, now - state.last_seen)
+            elif state.position is None or chunk_number != state.position:
+                # Seek: anything queued for the old position is stale
+                state.generation += 1
+                state.ahead = chunk_number
+            state.position = chunk_number
+            state.last_seen = now
+
+            start = max(chunk_number + 1, state.ahead + 1)
+            end = min(chunk_number + self.depth(state), len(track) - 1)
+            if start > end:
+                return
+            state.ahead = end
+            generation = state.generation
+
+        workspace = DownloadWorkspace(download.id)
+        for number in range(start, end + 1):
+            url = track.segment_url(number)
+            if workspace.has_segment(chunk_type, number):
+                continue
+            with self._lock:
+                self.scheduled += 1
+            self.executor().submit(
+                self._prefetch, key, generation, download.user_id, url, cache
+            ).add_done_callback(_log_error)
+
+    def _expire(self, now):
+        timeout = settings.PREFETCH_IDLE_TIMEOUT
+        for key, state in list(self._streams.items()):
+            if now - state.last_seen > timeout:
+                del self._streams[key]
+
+    def _current(self, key, generation):
+        with self._lock:
+            state = self._streams.get(key)
+            return state is not None and state.generation == generation
+
+    def _prefetch(self, key, generation, user_id, url, cache):
+        # One flow per segment; several may be in flight for a download
+        with scheduler.flow(user_id, ("prefetch", url)) as flow, flow.slot():
+            # Waiting for the slot may have taken a while
+            if not self._current(key, generation):
+                with self._lock:
+                    self.cancelled += 1
+                return
+            if cache is not None and cache.has(url):
+                return
+            if cache is None and url in self.buffer():
+                return
+
+            start = time.monotonic()
+            if cache is not None:
+                # Only wait for it to reach the cache, so that a client asking
+                # for it meanwhile can still join the fetch from the first byte
+                stream = coalescer.fetch(url, cache, flow)
+                if stream is None:
+                    return
+            else:
+                reader = coalescer.open(url, flow=flow)
+                if reader is None:
+                    return
+                # Nowhere on disk to keep it
+                self.buffer().put(url, b"".join(reader.iter_chunks()))
+            elapsed = time.monotonic() - start
+
+        with self._lock:
+            self.fetch_seconds = ewma(self.fetch_seconds, elapsed)
+            self.fetched += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "scheduled": self.scheduled,
+                "fetched": self.fetched,
+                "cancelled": self.cancelled,
+                "streams": len(self._streams),
+                "fetch_ms": (
+                    round(self.fetch_seconds * 1000) if self.fetch_seconds else None
+                ),
+            }
+
+
+def _log_error(future):
+    error = future.exception()
+    if error is not None:
+        logger.warning("Error prefetching chunk: %s", error)
+
+
+prefetcher = Prefetcher()
@@ -0,0 +1,377 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+from .db import database_sync_to_async
+from .events import hub
+from .models import VideoDownload
+from .throughput import eta_seconds, ewma
+
+logger = logging.getLogger(__name__)
+
+
+class SegmentBitmap:
+    """
+    One bit per segment, set once the segment has been received
+    """
+
+    def __init__(self, data=b""):
+        self.bits = bytearray(data or b"")
+
+    def __contains__(self, index):
+        byte = index >> 3
+        return byte < len(self.bits) and bool(self.bits[byte] & (1 << (index & 7)))
+
+    def add(self, index):
+        byte = index >> 3
+        if byte >= len(self.bits):
+            self.bits.extend(bytes(byte + 1 - len(self.bits)))
+        self.bits[byte] |= 1 << (index & 7)
+
+    def count(self):
+        return sum(bin(byte).count("1") for byte in self.bits)
+
+    def missing(self, total):
+        return [index for index in range(total) if index not in self]
+
+    def merge(self, data):
+        """
+        Set every bit that is set in another bitmap's bytes
+        """
+        if len(data) > len(self.bits):
+            self.bits.extend(bytes(len(data) - len(self.bits)))
+        for byte, value in enumerate(data):
+            self.bits[byte] |= value
+        return self
+
+    def to_bytes(self):
+        return bytes(self.bits)
+
+
+class ProgressReporter:
+    """
+    Coalesce per-chunk progress into occasional partial UPDATEs
+
+    Chunk progress is flushed at most every PROGRESS_FLUSH_INTERVAL_MS or
+    PROGRESS_FLUSH_CHUNKS chunks, whichever comes first, and only touches
+    the progress columns. Status transitions are written immediately.
+    Every change is also published to the progress hub right away.
+
+    Segment sizes passed to mark_segment() feed a moving average of the
+    download's rate, sampled at each flush, from which the ETA is derived.
+
+    Several processes can report on one download (the download job and
+    the web workers serving its chunks), so segment bitmaps are merged
+    into the stored ones rather than overwriting them; see save().
+    """
+
+    def __init__(self, download, flush_interval=None, flush_chunks=None):
+        self.pk = download.pk
+        self.status = download.status
+        self.total_chunks = download.total_chunks
+        self.downloaded_chunks = download.downloaded_chunks
+        self.file_size = download.file_size
+        self.downloaded_bytes = download.downloaded_bytes
+        self.bytes_per_second = 0.0
+        self.flush_interval = (
+            settings.PROGRESS_FLUSH_INTERVAL_MS / 1000
+            if flush_interval is None
+            else flush_interval
+        )
+        self.flush_chunks = flush_chunks or settings.PROGRESS_FLUSH_CHUNKS
+        self.bitmaps = {
+            "video": SegmentBitmap(download.video_segments),
+            "audio": SegmentBitmap(download.audio_segments),
+        }
+        self.writes = 0
+        self._dirty_bitmaps = set()
+        # Sizes of the segments marked since the last write, by kind
+        self._marks = {}
+        self._pending = 0
+        # Set when a pending change brought the count up to the total
+        self._reached_total = False
+        self._last_flush = time.monotonic()
+        self._rate_bytes = 0
+        self._rate_since = self._last_flush
+        self._lock = threading.Lock()
+
+    @property
+    def progress(self):
+        if not self.total_chunks:
+            return 0.0
+        return min(self.downloaded_chunks / self.total_chunks, 1.0)
+
+    def advance(self, chunks=1):
+        """
+        Record that more chunks have been downloaded
+        """
+        with self._lock:
+            self._count_chunks(self.downloaded_chunks + chunks)
+            self._pending += chunks
+        self.publish()
+        self._maybe_flush()
+
+    def set_chunks(self, downloaded_chunks):
+        """
+        Record an absolute chunk count
+        """
+        if self._record_chunks(downloaded_chunks):
+            self.publish()
+            self._maybe_flush()
+
+    def mark_segment(self, kind, index, size=0):
+        """
+        Record that one video or audio segment of `size` bytes has been
+        received
+        """
+        if self._record_segment(kind, index, size):
+            self.publish()
+            self._maybe_flush()
+
+    async def aset_chunks(self, downloaded_chunks):
+        if self._record_chunks(downloaded_chunks):
+            self.publish()
+            if self._flush_due():
+                await self.aflush()
+
+    async def amark_segment(self, kind, index, size=0):
+        if self._record_segment(kind, index, size):
+            self.publish()
+            if self._flush_due():
+                await self.aflush()
+
+    def snapshot(self):
+        return {
+            "status": self.status,
+            "progress": self.progress,
+            "downloaded_chunks": self.downloaded_chunks,
+            "total_chunks": self.total_chunks,
+            "downloaded_bytes": self.downloaded_bytes,
+            "bytes_per_second": self.bytes_per_second,
+            "eta_seconds": eta_seconds(
+                self.status,
+                self.file_size,
+                self.downloaded_bytes,
+                self.bytes_per_second,
+            ),
+        }
+
+    def publish(self):
+        hub.publish(self.pk, self.snapshot())
+
+    def _record_chunks(self, downloaded_chunks):
+        with self._lock:
+            if downloaded_chunks == self.downloaded_chunks:
+                return False
+            self._pending += abs(downloaded_chunks - self.downloaded_chunks)
+            self._count_chunks(downloaded_chunks)
+        return True
+
+    def _count_chunks(self, downloaded_chunks):
+        if self.downloaded_chunks < self.total_chunks <= downloaded_chunks:
+            self._reached_total = True
+        self.downloaded_chunks = downloaded_chunks
+
+    def _record_segment(self, kind, index, size=0):
+        with self._lock:
+            bitmap = self.bitmaps[kind]
+            if index in bitmap:
+                return False
+            bitmap.add(index)
+            self._dirty_bitmaps.add(kind)
+            self._marks.setdefault(kind, {})[index] = size
+            self._pending += 1
+            self.downloaded_bytes += size
+            self._rate_bytes += size
+        return True
+
+    def _sample_rate(self):
+        now = time.monotonic()
+        elapsed = now - self._rate_since
+        if elapsed > 0:
+            self.bytes_per_second = ewma(
+                self.bytes_per_second, self._rate_bytes / elapsed
+            )
+        self._rate_bytes = 0
+        self._rate_since = now
+
+    def _pending_fields(self):
+        self._sample_rate()
+        fields = {
+            "downloaded_chunks": self.downloaded_chunks,
+            "progress": self.progress,
+            "downloaded_bytes": self.downloaded_bytes,
+            "bytes_per_second": self.bytes_per_second,
+        }
+        for kind in self._dirty_bitmaps:
+            fields[f"{kind}_segments"] = self.bitmaps[kind].to_bytes()
+        self._dirty_bitmaps.clear()
+        self._pending = 0
+        self._reached_total = False
+        marks, self._marks = self._marks, {}
+        return fields, marks
+
+    def _flush_due(self):
+        # Completion flushes once, when it happens, so that segments
+        # reported after the count is full (the audio track, merges into a
+        # finished download) are batched like any others
+        return self._pending > 0 and (
+            self._pending >= self.flush_chunks
+            or self._reached_total
+            or time.monotonic() - self._last_flush >= self.flush_interval
+        )
+
+    def _maybe_flush(self):
+        if self._flush_due():
+            self.flush()
+
+    def _take_pending(self):
+        with self._lock:
+            if not self._pending:
+                return None
+            pending = self._pending_fields()
+            self._last_flush = time.monotonic()
+            self.writes += 1
+        return pending
+
+    def flush(self):
+        """
+        Write pending progress, if any
+        """
+        pending = self._take_pending()
+        if pending:
+            self.save(*pending)
+
+    async def aflush(self):
+        pending = self._take_pending()
+        if pending:
+            await database_sync_to_async(self.save)(*pending)
+
+    def save(self, fields, marks=None):
+        """
+        Write progress fields, merging segment bitmaps with the stored ones
+
+        The stored bitmaps are read under a row lock and OR-ed with this
+        reporter's, and only the segments `marks` adds to them count
+        towards downloaded_bytes, so progress reported by other processes
+        is kept. The merged state is taken back into this reporter.
+        """
+        if not marks:
+            VideoDownload.objects.filter(pk=self.pk).update(**fields)
+            return
+
+        kinds = [kind for kind in self.bitmaps if f"{kind}_segments" in fields]
+        with transaction.atomic():
+            stored = (
+                VideoDownload.objects.select_for_update()
+                .filter(pk=self.pk)
+                .values("downloaded_bytes", *(f"{kind}_segments" for kind in kinds))
+                .first()
+            )
+            if stored is None:
+                return
+
+            added = 0
+            merged = {}
+            for kind in kinds:
+                bitmap = SegmentBitmap(stored[f"{kind}_segments"])
+                for index, size in marks.get(kind, {}).items():
+                    if index not in bitmap:
+                        added += size
+                merged[kind] = bitmap.merge(fields[f"{kind}_segments"])
+                fields[f"{kind}_segments"] = merged[kind].to_bytes()
+
+            reported_bytes = fields.get("downloaded_bytes", self.downloaded_bytes)
+            fields["downloaded_bytes"] = stored["downloaded_bytes"] + added
+            if "video" in merged:
+                fields["downloaded_chunks"] = max(
+                    fields.get("downloaded_chunks", 0), merged["video"].count()
+                )
+                if self.total_chunks:
+                    fields["progress"] = min(
+                        fields["downloaded_chunks"] / self.total_chunks, 1.0
+                    )
+            VideoDownload.objects.filter(pk=self.pk).update(**fields)
+
+        with self._lock:
+            for kind, bitmap in merged.items():
+                self.bitmaps[kind].merge(bitmap.to_bytes())
+            self.downloaded_bytes += fields["downloaded_bytes"] - reported_bytes
+            self.downloaded_chunks = max(
+                self.downloaded_chunks, fields.get("downloaded_chunks", 0)
+            )
+
+    def transition(self, status, **fields):
+        """
+        Write a status change (and any pending progress) immediately
+        """
+        with self._lock:
+            self.status = status
+            if status == "downloading":
+                # Measure the rate from when fetching starts
+                self._rate_bytes = 0
+                self._rate_since = time.monotonic()
+            self.total_chunks = fields.get("total_chunks", self.total_chunks)
+            self.file_size = fields.get("file_size", self.file_size)
+            marks = None
+            if self._pending:
+                pending, marks = self._pending_fields()
+                fields = {**pending, **fields}
+            self._last_flush = time.monotonic()
+            self.writes += 1
+        self.save({"status": status, **fields}, marks)
+        self.publish()
+
+
+class ReporterRegistry:
+    """
+    Shared reporters for downloads whose progress arrives across requests
+
+    A background thread flushes reporters that have gone quiet, so the last
+    few chunks of an abandoned stream still reach the database.
+    """
+
+    def __init__(self):
+        self._reporters = {}
+        self._last_seen = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+
+    def get(self, download):
+        with self._lock:
+            reporter = self._reporters.get(download.pk)
+            if reporter is None:
+                reporter = ProgressReporter(download)
+                self._reporters[download.pk] = reporter
+            self._last_seen[download.pk] = time.monotonic()
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._run, daemon=True)
+                self._flusher.start()
+        return reporter
+
+    def _run(self):
+        interval = settings.PROGRESS_FLUSH_INTERVAL_MS / 1000
+        while True:
+            time.sleep(interval)
+            self.flush_idle(interval)
+
+    def flush_idle(self, idle_for):
+        now = time.monotonic()
+        with self._lock:
+            idle = [
+                pk for pk, seen in self._last_seen.items() if now - seen >= idle_for
+            ]
+            reporters = [self._reporters.pop(pk) for pk in idle]
+            for pk in idle:
+                del self._last_seen[pk]
+        for reporter in reporters:
+            try:
+                reporter.flush()
+            except Exception:
+                logger.exception("Error flushing download progress")
+
+
+reporters = ReporterRegistry()
@@ -0,0 +1,119 @@
+import re
+import threading
+
+from django.conf import settings
+
+CONTENT_RANGE = re.compile(r"^bytes (\d+)-(\d+)/(\d+|\*)$")
+
+
+class BufferPool:
+    """
+    Reusable bytearrays of one size
+
+    Relaying reads into a pooled buffer instead of allocating a new bytes
+    object per step. At most `limit` idle buffers are kept.
+    """
+
+    def __init__(self, size, limit):
+        self.size = size
+        self.limit = limit
+        self.allocated = 0
+        self._free = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+            self.allocated += 1
+        return bytearray(self.size)
+
+    def release(self, buffer):
+        with self._lock:
+            if len(self._free) < self.limit:
+                self._free.append(buffer)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def buffer_pool(size=None):
+    """
+    Get the process-wide pool for buffers of `size` (RELAY_CHUNK_SIZE)
+    """
+    size = size or settings.RELAY_CHUNK_SIZE
+    pool = _pools.get(size)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(size)
+            if pool is None:
+                pool = _pools[size] = BufferPool(size, settings.RELAY_BUFFER_POOL)
+    return pool
+
+
+def iter_readinto(source, length=None, size=None):
+    """
+    Read `source` (up to `length` bytes) into one pooled buffer, yielding
+    a memoryview of each read
+
+    A view is only valid until the next one is requested. That suits
+    StreamingHttpResponse, which turns each piece into bytes as it takes
+    it, and file writes; anything that keeps pieces needs its own copy.
+    """
+    pool = buffer_pool(size)
+    buffer = pool.acquire()
+    view = memoryview(buffer)
+    try:
+        while length is None or length > 0:
+            target = view if length is None or length >= len(view) else view[:length]
+            count = source.readinto(target)
+            if not count:
+                break
+            if length is not None:
+                length -= count
+            yield view[:count]
+    finally:
+        pool.release(buffer)
+
+
+def copy_stream(source, destination, length=None, size=None):
+    """
+    Copy `source` to `destination` through a pooled buffer, returning the
+    number of bytes copied
+    """
+    copied = 0
+    for piece in iter_readinto(source, length, size):
+        destination.write(piece)
+        copied += len(piece)
+    return copied
+
+
+def iter_response(response, length=None):
+    """
+    iter_readinto() over a streamed requests response, closing it at the end
+    """
+    try:
+        yield from iter_readinto(raw_body(response), length)
+    finally:
+        response.close()
+
+
+def content_range(header):
+    """
+    (start, end, size) of a Content-Range header, end inclusive and size
+    None when the server does not know it; None if it cannot be parsed
+    """
+    match = CONTENT_RANGE.match(header.strip()) if header else None
+    if match is None:
+        return None
+    start, end, size = match.groups()
+    return int(start), int(end), None if size == "*" else int(size)
+
+
+def raw_body(response):
+    """
+    The body of a streamed requests response as a readinto-capable stream
+    """
+    response.raw.decode_content = True
+    return response.raw
@@ -0,0 +1,246 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+
+class TokenBucket:
+    """
+    Limit a flow of bytes to `rate` per second, with bursts of up to
+    `burst` bytes
+
+    Callers take tokens up front and sleep off any debt, so concurrent
+    readers are served in the order they asked. A rate of 0 means no limit.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount):
+        """
+        Take `amount` tokens, returning how long to wait before using them
+        """
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.tokens + (now - self.updated) * self.rate, self.burst
+            )
+            self.updated = now
+            self.tokens -= amount
+            return max(-self.tokens / self.rate, 0.0)
+
+
+class ThrottledReader:
+    """
+    A readinto-capable stream that charges every read to a Flow
+    """
+
+    def __init__(self, source, flow):
+        self.source = source
+        self.flow = flow
+
+    def readinto(self, buffer):
+        count = self.source.readinto(buffer)
+        if count:
+            self.flow.throttle(count)
+        return count
+
+
+class Flow:
+    """
+    One download's share of the scheduler
+
+    Segment fetches take a slot() for as long as they hold an upstream
+    connection and pass the bytes they receive through throttle() or
+    reader().
+    """
+
+    def __init__(self, scheduler, user_id, download_id, weight=1.0):
+        self.scheduler = scheduler
+        self.user_id = user_id
+        self.download_id = download_id
+        self.weight = weight
+        # Virtual time at which this flow's last queued segment finishes
+        self.finish = 0.0
+        self.in_flight = 0
+        self.granted = 0
+        self.bytes = 0
+
+    def slot(self):
+        return self.scheduler.slot(self)
+
+    def throttle(self, size):
+        self.scheduler.throttle(self, size)
+
+    def reader(self, source):
+        return ThrottledReader(source, self)
+
+
+class FairScheduler:
+    """
+    Share upstream connections and bandwidth fairly between users
+
+    Every background download fetches through a Flow. A segment fetch
+    waits for a slot while SCHEDULER_MAX_IN_FLIGHT segments are in flight
+    in the process, or SCHEDULER_USER_MAX_IN_FLIGHT for the user. Free
+    slots go to waiting flows by start-time fair queuing: each request
+    moves its flow's virtual finish time on by the number of flows its
+    user has active, divided by the flow's weight, and the waiter with the
+    earliest virtual start goes next. A user running many downloads at once thus
+    gets the same share as a user with one.
+
+    Received bytes are charged to a global and a per-user token bucket
+    (SCHEDULER_RATE and SCHEDULER_USER_RATE bytes per second).
+    """
+
+    def __init__(self):
+        self.flows = {}
+        self.user_flows = {}
+        self.user_in_flight = {}
+        self.user_buckets = {}
+        self.in_flight = 0
+        self.virtual_time = 0.0
+        self.granted = 0
+        self.throttled_seconds = 0.0
+        self._bucket = None
+        self._waiting = []
+        self._sequence = 0
+        self._condition = threading.Condition()
+
+    def bucket(self):
+        if self._bucket is None:
+            with self._condition:
+                if self._bucket is None:
+                    self._bucket = self._new_bucket(settings.SCHEDULER_RATE)
+        return self._bucket
+
+    def user_bucket(self, user_id):
+        with self._condition:
+            bucket = self.user_buckets.get(user_id)
+            if bucket is None:
+                bucket = self.user_buckets[user_id] = self._new_bucket(
+                    settings.SCHEDULER_USER_RATE
+                )
+            return bucket
+
+    def _new_bucket(self, rate):
+        return TokenBucket(rate, rate * settings.SCHEDULER_BURST_SECONDS)
+
+    @contextmanager
+    def flow(self, user_id, download_id, weight=1.0):
+        """
+        Register a download for the duration of its fetching
+        """
+        flow = Flow(self, user_id, download_id, weight)
+        with self._condition:
+            self.flows[download_id] = flow
+            self.user_flows[user_id] = self.user_flows.get(user_id, 0) + 1
+            # Start level with the flows already running
+            flow.finish = self.virtual_time
+        try:
+            yield flow
+        finally:
+            with self._condition:
+                self.flows.pop(download_id, None)
+                self.user_flows[user_id] -= 1
+                if not self.user_flows[user_id]:
+                    del self.user_flows[user_id]
+                    if not self.user_in_flight.get(user_id):
+                        self.user_buckets.pop(user_id, None)
+                self._condition.notify_all()
+
+    @contextmanager
+    def slot(self, flow):
+        """
+        Hold one of the in-flight segment slots
+        """
+        with self._condition:
+            self._sequence += 1
+            start = max(flow.finish, self.virtual_time)
+            flow.finish = start + self.user_flows.get(flow.user_id, 1) / flow.weight
+            ticket = (start, self._sequence, flow)
+            self._waiting.append(ticket)
+            while self._next_ticket() is not ticket:
+                self._condition.wait()
+            self._waiting.remove(ticket)
+            self._grant(ticket)
+            # Let the next waiter in if there are slots left
+            self._condition.notify_all()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.in_flight -= 1
+                flow.in_flight -= 1
+                self.user_in_flight[flow.user_id] -= 1
+                if not self.user_in_flight[flow.user_id]:
+                    del self.user_in_flight[flow.user_id]
+                self._condition.notify_all()
+
+    def _next_ticket(self):
+        """
+        The waiter to grant a slot to next, or None if none can go now
+        """
+        if self.in_flight >= settings.SCHEDULER_MAX_IN_FLIGHT:
+            return None
+        best = None
+        for ticket in self._waiting:
+            user_id = ticket[2].user_id
+            if (
+                self.user_in_flight.get(user_id, 0)
+                >= settings.SCHEDULER_USER_MAX_IN_FLIGHT
+            ):
+                continue
+            if best is None or ticket[:2] < best[:2]:
+                best = ticket
+        return best
+
+    def _grant(self, ticket):
+        start, _, flow = ticket
+        flow.in_flight += 1
+        flow.granted += 1
+        self.virtual_time = max(self.virtual_time, start)
+        self.in_flight += 1
+        self.granted += 1
+        self.user_in_flight[flow.user_id] = self.user_in_flight.get(flow.user_id, 0) + 1
+
+    def throttle(self, flow, size):
+        flow.bytes += size
+        delay = max(
+            self.bucket().reserve(size), self.user_bucket(flow.user_id).reserve(size)
+        )
+        if delay > 0:
+            self.throttled_seconds += delay
+            time.sleep(delay)
+
+    def stats(self):
+        with self._condition:
+            users = {}
+            for flow in self.flows.values():
+                user = users.setdefault(
+                    str(flow.user_id),
+                    {"downloads": 0, "in_flight": 0, "waiting": 0, "bytes": 0},
+                )
+                user["downloads"] += 1
+                user["in_flight"] += flow.in_flight
+                user["bytes"] += flow.bytes
+            for _, _, flow in self._waiting:
+                users[str(flow.user_id)]["waiting"] += 1
+            return {
+                "downloads": len(self.flows),
+                "in_flight": self.in_flight,
+                "waiting": len(self._waiting),
+                "granted": self.granted,
+                "throttled_seconds": round(self.throttled_seconds, 3),
+                "users": users,
+            }
+
+
+scheduler = FairScheduler()
@@ -0,0 +1,377 @@
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+
+import requests
+import urllib3
+from django.conf import settings
+
+from . import metrics, upstream
+from .cache import segment_cache
+from .relay import content_range, copy_stream, raw_body
+from .throughput import throughput
+
+logger = logging.getLogger(__name__)
+
+
+class SegmentFetchError(Exception):
+    pass
+
+
+class RetryableError(Exception):
+    """
+    A response body broke off after the headers had arrived
+    """
+
+
+# Errors reading a streamed response body
+BODY_ERRORS = (requests.RequestException, urllib3.exceptions.HTTPError)
+
+
+class HostLimit:
+    """
+    Requests in flight to one host
+
+    Each caller passes the limit to wait for, so a changed
+    SEGMENT_FETCH_PER_HOST applies to the next request rather than being
+    fixed when the host was first seen.
+    """
+
+    def __init__(self):
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def hold(self, limit):
+        with self._condition:
+            self._condition.wait_for(lambda: self.in_flight < limit)
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.in_flight -= 1
+                self._condition.notify_all()
+
+
+# Per-host limits are shared by every fetcher in the process so that
+# concurrent downloads cannot multiply the load on a single CDN host
+_host_limits = {}
+_host_lock = threading.Lock()
+
+
+def host_limit(url, limit):
+    """
+    Hold one of the `limit` process-wide request slots for the URL's host
+    """
+    host = urlparse(url).netloc
+    with _host_lock:
+        state = _host_limits.get(host)
+        if state is None:
+            state = _host_limits[host] = HostLimit()
+    return state.hold(limit)
+
+
+class SegmentFetcher:
+    """
+    Fetch playlist segments with a bounded number of downloads in flight
+    """
+
+    def __init__(
+        self,
+        max_workers=None,
+        per_host=None,
+        retries=None,
+        backoff=None,
+        use_cache=True,
+        flow=None,
+    ):
+        self.max_workers = max_workers or settings.SEGMENT_FETCH_WORKERS
+        self.per_host = per_host or settings.SEGMENT_FETCH_PER_HOST
+        self.retries = settings.SEGMENT_FETCH_RETRIES if retries is None else retries
+        self.backoff = settings.SEGMENT_FETCH_BACKOFF if backoff is None else backoff
+        self.cache = segment_cache() if use_cache else None
+        # Scheduler share of a background download, if any
+        self.flow = flow
+
+    def fetch(self, url):
+        """
+        Fetch a single segment from the cache or upstream
+        """
+        if self.cache is not None:
+            data = self.cache.get(url)
+            if data is not None:
+                return data
+
+        data = self.fetch_upstream(url)
+        if self.cache is not None:
+            self.cache.put(url, data)
+        return data
+
+    def fetch_upstream(self, url):
+        """
+        Fetch a single segment, trying again if its body breaks off
+        """
+
+        def attempt():
+            with self.slot(), host_limit(url, self.per_host):
+                start = time.monotonic()
+                with upstream.get(url, stream=True) as response:
+                    self.check_status(url, response)
+                    try:
+                        content = response.content
+                    except BODY_ERRORS as e:
+                        raise RetryableError(e) from e
+                elapsed = time.monotonic() - start
+            if self.flow is not None:
+                self.flow.throttle(len(content))
+            throughput.record(url, len(content), elapsed)
+            return content
+
+        return self.with_retries(url, attempt)
+
+    def fetch_to_file(self, url, path):
+        """
+        Fetch a single segment into path
+
+        Bytes are streamed into path + ".part" first; if that file is left
+        over from an earlier attempt only the remainder is requested with an
+        HTTP Range header.
+        """
+        if os.path.exists(path):
+            return
+        if self.cache is not None and self.cache.copy_to(url, path):
+            return
+
+        part_path = path + ".part"
+
+        def attempt():
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            headers = {"Range": f"bytes={offset}-"} if offset else {}
+            with self.slot(), host_limit(url, self.per_host):
+                started = time.monotonic()
+                with upstream.get(url, stream=True, headers=headers) as response:
+                    if response.status_code == 416 and offset:
+                        # The partial file already holds the whole segment
+                        return
+                    self.check_status(url, response, ok=(200, 206))
+                    mode = "wb"
+                    if response.status_code == 206:
+                        byte_range = content_range(
+                            response.headers.get("Content-Range")
+                        )
+                        start = byte_range[0] if byte_range else None
+                        if start == offset:
+                            mode = "ab"
+                        elif start != 0:
+                            # Not the remainder we asked for: start over
+                            if offset:
+                                os.remove(part_path)
+                            raise RetryableError(
+                                f"Range at {start} does not resume at {offset}"
+                            )
+                    body = raw_body(response)
+                    if self.flow is not None:
+                        body = self.flow.reader(body)
+                    with open(part_path, mode) as file:
+                        try:
+                            size = copy_stream(body, file)
+                        except BODY_ERRORS as e:
+                            # What arrived stays in the .part file
+                            raise RetryableError(e) from e
+                throughput.record(url, size, time.monotonic() - started)
+
+        self.with_retries(url, attempt)
+        os.replace(part_path, path)
+        if self.cache is not None:
+            self.cache.put_file(url, path)
+
+    def slot(self):
+        """
+        Wait for the scheduler to let this download open another connection
+        """
+        if self.flow is None:
+            return nullcontext()
+        return self.flow.slot()
+
+    def probe_size(self, url):
+        """
+        Size of a segment from a HEAD request, or None if upstream won't say
+
+        Falls back to a one-byte ranged GET for servers that do not answer
+        HEAD with a Content-Length.
+        """
+        try:
+            with host_limit(url, self.per_host):
+                response = upstream.head(url)
+                length = response.headers.get("Content-Length")
+                if response.status_code == 200 and length:
+                    return int(length)
+
+                with upstream.get(
+                    url, stream=True, headers={"Range": "bytes=0-0"}
+                ) as response:
+                    content_range = response.headers.get("Content-Range", "")
+                    if response.status_code == 206 and "/" in content_range:
+                        total = content_range.rsplit("/", 1)[1]
+                        return int(total) if total.isdigit() else None
+        except (requests.RequestException, ValueError) as e:
+            logger.warning("Error probing segment size: %s", e)
+        return None
+
+    def probe_track_size(self, track, samples=None):
+        """
+        Total size of a track whose manifest lists no segment sizes
+
+        Up to `samples` (SIZE_PROBE_SAMPLES) evenly spaced segments are
+        probed and the result scaled by duration to the whole track. With
+        at least as many samples as segments the size is exact.
+        """
+        if track.total_size:
+            return track.total_size
+
+        count = len(track)
+        samples = min(
+            settings.SIZE_PROBE_SAMPLES if samples is None else samples, count
+        )
+        if samples <= 0:
+            return 0
+
+        indexes = sorted({int(i * count / samples) for i in range(samples)})
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            sizes = executor.map(self.probe_size, [track.urls[i] for i in indexes])
+            probed = [(i, size) for i, size in zip(indexes, sizes) if size]
+        if not probed:
+            return 0
+
+        probed_bytes = sum(size for _, size in probed)
+        if len(probed) == count:
+            return probed_bytes
+        probed_duration = sum(track.durations[i] for i, _ in probed)
+        total_duration = sum(track.durations)
+        if probed_duration > 0 and total_duration > 0:
+            return int(probed_bytes / probed_duration * total_duration)
+        return int(probed_bytes / len(probed) * count)
+
+    def fetch_to_files(self, jobs, on_complete=None):
+        """
+        Fetch (index, url, path) jobs concurrently, calling on_complete(index)
+        as each segment lands on disk
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(self.fetch_to_file, url, path): index
+                for index, url, path in jobs
+            }
+            try:
+                for future in as_completed(futures):
+                    future.result()
+                    if on_complete is not None:
+                        on_complete(futures[future])
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def iter_to_files(self, jobs):
+        """
+        Fetch (index, url, path) jobs concurrently, yielding each index in
+        job order once its segment is on disk
+
+        Like iter_ordered(), fetching runs at most a window ahead of the
+        consumer.
+        """
+        jobs = iter(jobs)
+        window = self.max_workers * 2
+        pending = deque()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            try:
+                for index, url, path in jobs:
+                    pending.append(
+                        (index, executor.submit(self.fetch_to_file, url, path))
+                    )
+                    if len(pending) >= window:
+                        break
+
+                while pending:
+                    index, future = pending.popleft()
+                    future.result()
+                    job = next(jobs, None)
+                    if job is not None:
+                        pending.append(
+                            (job[0], executor.submit(self.fetch_to_file, *job[1:]))
+                        )
+                    yield index
+            finally:
+                for _, future in pending:
+                    future.cancel()
+
+    def check_status(self, url, response, ok=(200,)):
+        if response.status_code in ok:
+            return
+        # 429 and 5xx answers have already been retried by the session
+        metrics.UPSTREAM_SEGMENT_ERRORS.labels("failed").inc()
+        raise SegmentFetchError(
+            f"Failed to fetch segment {url}: {response.status_code}"
+        )
+
+    def with_retries(self, url, attempt):
+        """
+        Run attempt(), again with backoff if a response body breaks off
+
+        Connection errors and 429/5xx answers are retried by the upstream
+        session (UPSTREAM_RETRIES) and fail the segment here. urllib3
+        cannot retry a body that breaks off part way, so that is left to
+        this layer, which resumes from the partial file where there is one.
+        """
+        tries = 0
+        while True:
+            try:
+                return attempt()
+            except RetryableError as e:
+                error = e
+            except requests.RequestException as e:
+                metrics.UPSTREAM_SEGMENT_ERRORS.labels("failed").inc()
+                raise SegmentFetchError(f"Failed to fetch segment {url}: {e}") from e
+
+            tries += 1
+            if tries > self.retries:
+                metrics.UPSTREAM_SEGMENT_ERRORS.labels("failed").inc()
+                raise SegmentFetchError(f"Failed to fetch segment {url}: {error}")
+            metrics.UPSTREAM_SEGMENT_ERRORS.labels("retried").inc()
+            delay = self.backoff * (2 ** (tries - 1))
+            time.sleep(delay + random.uniform(0, delay / 2))
+
+    def iter_ordered(self, urls):
+        """
+        Yield segment bytes in playlist order
+
+        Downloads run ahead of the consumer in a sliding window, so memory
+        is bounded by the window size rather than the number of segments.
+        """
+        urls = iter(urls)
+        window = self.max_workers * 2
+        pending = deque()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            try:
+                for url in urls:
+                    pending.append(executor.submit(self.fetch, url))
+                    if len(pending) >= window:
+                        break
+
+                while pending:
+                    data = pending.popleft().result()
+                    next_url = next(urls, None)
+                    if next_url is not None:
+                        pending.append(executor.submit(self.fetch, next_url))
+                    yield data
+            finally:
+                for future in pending:
+                    future.cancel()
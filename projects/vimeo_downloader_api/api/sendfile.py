@@ -0,0 +1,177 @@
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import (
+    FileResponse,
+    HttpResponse,
+    HttpResponseNotModified,
+    StreamingHttpResponse,
+)
+
+from .events import parse_etag
+from .relay import iter_readinto
+
+RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def file_etag(stat):
+    """
+    Strong ETag for a file that is never rewritten in place
+
+    Segments and merged outputs are written to a temporary name and
+    renamed, so a new version is a new inode. Modification times are no
+    use here: the segment cache bumps them on every hit.
+    """
+    return f"{stat.st_size:x}-{stat.st_ino:x}"
+
+
+def parse_range(header, size):
+    """
+    (start, end) of a single-range Range header, inclusive
+
+    Returns None when the whole file should be sent, which includes
+    multi-range requests. Raises RangeNotSatisfiable when the range lies
+    past the end of the file.
+    """
+    match = RANGE.match(header.replace(" ", "")) if header else None
+    if match is None:
+        return None
+
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if last and int(last) < start:
+            return None
+    elif last:
+        # Suffix range: the final `last` bytes
+        start = max(size - int(last), 0)
+        end = size - 1
+    else:
+        return None
+
+    if start >= size:
+        raise RangeNotSatisfiable()
+    return start, end
+
+
+def requested_range(request, etag, size):
+    """
+    The byte range to send, honouring If-Range
+    """
+    if_range = request.headers.get("If-Range")
+    if if_range and parse_etag(if_range) != etag:
+        return None
+    return parse_range(request.headers.get("Range"), size)
+
+
+def read_range(file, start, length):
+    try:
+        file.seek(start)
+        yield from iter_readinto(file, length)
+    finally:
+        file.close()
+
+
+def offload_location(path):
+    """
+    Where the fronting server should read a file from, or None to send it
+    from Django
+
+    X-Accel-Redirect needs an internal nginx location per directory (see
+    README_DEPLOYMENT.md); X-Sendfile takes the file path as is.
+    """
+    backend = settings.SENDFILE_BACKEND
+    if backend == "apache":
+        return os.path.abspath(path)
+    if backend != "nginx":
+        return None
+
+    path = os.path.realpath(path)
+    roots = {
+        "downloads": settings.DOWNLOAD_WORK_DIR,
+        "segment-cache": settings.SEGMENT_CACHE_DIR,
+    }
+    for name, root in roots.items():
+        root = os.path.realpath(root)
+        if path.startswith(root + os.sep):
+            relative = os.path.relpath(path, root).replace(os.sep, "/")
+            return (
+                f"{settings.SENDFILE_URL_PREFIX.rstrip('/')}/{name}/{quote(relative)}"
+            )
+    return None
+
+
+def serve_file(request, file, content_type, filename=None, reader=None):
+    """
+    Respond with an open local file, supporting ETag and Range requests
+
+    By default the file goes out through FileResponse, which WSGI servers
+    with a file wrapper (gunicorn) send with os.sendfile. With
+    SENDFILE_BACKEND=nginx or apache only the headers are built here and
+    the fronting server sends the bytes and handles Range itself.
+
+    `reader(file, start, length)` replaces FileResponse for servers that
+    cannot use it, such as async views under ASGI.
+    """
+    stat = os.fstat(file.fileno())
+    size = stat.st_size
+    etag = file_etag(stat)
+
+    location = offload_location(file.name)
+    if location is not None:
+        file.close()
+        response = HttpResponse(content_type=content_type)
+        if settings.SENDFILE_BACKEND == "nginx":
+            response["X-Accel-Redirect"] = location
+        else:
+            response["X-Sendfile"] = location
+        return _file_headers(response, etag, filename)
+
+    client_etag = parse_etag(request.headers.get("If-None-Match"))
+    if client_etag is not None and client_etag == etag:
+        file.close()
+        return _file_headers(HttpResponseNotModified(), etag, None)
+
+    try:
+        byte_range = requested_range(request, etag, size)
+    except RangeNotSatisfiable:
+        file.close()
+        response = HttpResponse(status=416)
+        response["Content-Range"] = f"bytes */{size}"
+        return response
+
+    start, end = byte_range or (0, size - 1)
+    length = end - start + 1 if size else 0
+    status = 206 if byte_range else 200
+
+    if reader is not None:
+        response = StreamingHttpResponse(
+            reader(file, start, length), content_type=content_type, status=status
+        )
+    elif end == size - 1:
+        # Sent from the current offset to the end of the file
+        file.seek(start)
+        response = FileResponse(file, content_type=content_type, status=status)
+    else:
+        response = StreamingHttpResponse(
+            read_range(file, start, length), content_type=content_type, status=status
+        )
+    response["Content-Length"] = str(length)
+    if byte_range:
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return _file_headers(response, etag, filename)
+
+
+def _file_headers(response, etag, filename):
+    response["ETag"] = f'"{etag}"'
+    response["Accept-Ranges"] = "bytes"
+    if filename:
+        response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
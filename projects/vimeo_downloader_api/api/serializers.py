@@ -0,0 +1,112 @@
+from rest_framework import serializers
+
+from .models import VimeoVideo, VideoDownload
+from .throughput import eta_seconds
+
+
+class FieldsMixin:
+    """
+    Let callers narrow a serializer to some of its fields, e.g. from ?fields=
+    """
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+
+class VimeoVideoSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = VimeoVideo
+        fields = [
+            "id",
+            "original_url",
+            "video_id",
+            "base_url",
+            "title",
+            "thumbnail_url",
+            "duration",
+            "available_resolutions",
+            "status",
+            "created_at",
+            "processed_at",
+        ]
+
+
+class VimeoVideoListSerializer(FieldsMixin, serializers.ModelSerializer):
+    """
+    Video summary for listings, without the playlist blobs
+    """
+
+    class Meta:
+        model = VimeoVideo
+        fields = [
+            "id",
+            "original_url",
+            "video_id",
+            "title",
+            "thumbnail_url",
+            "duration",
+            "available_resolutions",
+            "status",
+            "created_at",
+            "processed_at",
+        ]
+
+
+class VideoDownloadSerializer(serializers.ModelSerializer):
+    eta_seconds = serializers.SerializerMethodField()
+
+    class Meta:
+        model = VideoDownload
+        fields = [
+            "id",
+            "video",
+            "resolution",
+            "include_audio",
+            "status",
+            "progress",
+            "downloaded_chunks",
+            "total_chunks",
+            "file_size",
+            "downloaded_bytes",
+            "bytes_per_second",
+            "eta_seconds",
+            "estimated_duration",
+            "stage_timings",
+            "created_at",
+            "started_at",
+            "completed_at",
+        ]
+        # Model fields behind computed ones, for .only()
+        field_sources = {
+            "eta_seconds": (
+                "status",
+                "file_size",
+                "downloaded_bytes",
+                "bytes_per_second",
+            ),
+        }
+
+    def get_eta_seconds(self, download):
+        return eta_seconds(
+            download.status,
+            download.file_size,
+            download.downloaded_bytes,
+            download.bytes_per_second,
+        )
+
+
+class VideoDownloadListSerializer(FieldsMixin, VideoDownloadSerializer):
+    class Meta(VideoDownloadSerializer.Meta):
+        pass
+
+
+class CreateVideoRequestSerializer(serializers.Serializer):
+    url = serializers.URLField(max_length=500)
+
+
+class CreateDownloadRequestSerializer(serializers.Serializer):
+    video_id = serializers.UUIDField()
+    resolution = serializers.CharField(max_length=20)
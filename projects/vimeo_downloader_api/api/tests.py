@@ -1,3 +1,781 @@
-from django.test import TestCase
+import io
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+import requests
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from benchmarks.fake_cdn import FakeCDN, fragment, init_segment
+
+from . import metrics
+from .cache import SegmentCache
+from .coalesce import SegmentCoalescer, SegmentStream
+from .events import hub
+from .fmp4 import FragmentedMuxer, find_box, iter_boxes
+from .jobs import WorkerPool, _handlers, enqueue, recover_orphans
+from .manifests import load_manifest, manifest_key, save_manifest
+from .models import Job, VideoDownload, VideoManifest, VimeoVideo
+from .playlist import PlaylistIndex, get_playlist_index
+from .prefetch import Prefetcher
+from .progress import ProgressReporter, SegmentBitmap
+from .scheduler import FairScheduler, TokenBucket, scheduler
+from .segments import SegmentFetcher, SegmentFetchError, host_limit
+from .serializers import VimeoVideoListSerializer
+from .sendfile import file_etag, serve_file
+from .views import mark_when_served, merged_fragments, range_to_end
+
+
+def create_download(user, **fields):
+    video = VimeoVideo.objects.create(
+        user=user, original_url="https://vimeo.com/1", status="ready"
+    )
+    fields.setdefault("status", "downloading")
+    fields.setdefault("total_chunks", 4)
+    return VideoDownload.objects.create(
+        video=video, user=user, resolution="720p", **fields
+    )
+
+
+class StreamChunkViewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="viewer")
+        self.download = create_download(self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_rejects_unknown_chunk_type(self):
+        response = self.client.get(
+            reverse("stream-chunk", args=[self.download.id]),
+            {"chunk": 0, "type": "subtitles"},
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"error": "Invalid chunk type"})
+
+    def test_missing_manifest_is_not_indexed(self):
+        url = reverse("stream-chunk", args=[self.download.id])
+        for _ in range(2):
+            response = self.client.get(url, {"chunk": 0, "type": "video"})
+            self.assertEqual(response.status_code, 404)
+        video = VimeoVideo.objects.get(pk=self.download.video_id)
+        self.assertIsNone(video.playlist_index)
+        self.assertIsNone(get_playlist_index(video))
+
+
+class MarkWhenServedTests(TestCase):
+    def setUp(self):
+        user = User.objects.create(username="viewer")
+        self.download = create_download(user)
+        self.reporter = ProgressReporter(self.download, flush_chunks=100)
+        patcher = mock.patch("api.views.reporters.get", return_value=self.reporter)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_marks_segment_after_whole_body(self):
+        body = mark_when_served(iter([b"abc", b"de"]), self.download, "video", 2, 5)
+        self.assertEqual(next(body), b"abc")
+        self.assertNotIn(2, self.reporter.bitmaps["video"])
+        self.assertEqual(b"".join(body), b"de")
+        self.assertIn(2, self.reporter.bitmaps["video"])
+        self.assertEqual(self.reporter.downloaded_bytes, 5)
+        self.assertEqual(self.reporter.downloaded_chunks, 1)
+
+    def test_abandoned_body_is_not_marked(self):
+        body = mark_when_served(iter([b"abc", b"de"]), self.download, "audio", 0, 5)
+        next(body)
+        body.close()
+        self.assertNotIn(0, self.reporter.bitmaps["audio"])
+
+        # The job fetching the segment later still counts its bytes
+        self.reporter.mark_segment("audio", 0, 5)
+        self.assertEqual(self.reporter.downloaded_bytes, 5)
+
+    def test_resumed_range_marks_whole_segment(self):
+        resumed = range_to_end({"Content-Range": "bytes 2-4/5"})
+        self.assertEqual(resumed, (3, 5))
+        self.assertIsNone(range_to_end({"Content-Range": "bytes 0-1/5"}))
+        self.assertIsNone(range_to_end({"Content-Range": "bytes 2-4/*"}))
+
+        body = mark_when_served(iter([b"cde"]), self.download, "video", 3, *resumed)
+        self.assertEqual(b"".join(body), b"cde")
+        self.assertIn(3, self.reporter.bitmaps["video"])
+        self.assertEqual(self.reporter.downloaded_bytes, 5)
+
+    def test_short_body_is_not_marked(self):
+        body = mark_when_served(iter([b"abc"]), self.download, "video", 1, 5)
+        self.assertEqual(b"".join(body), b"abc")
+        self.assertNotIn(1, self.reporter.bitmaps["video"])
+        self.assertEqual(self.reporter.downloaded_bytes, 0)
+
+
+class DownloadProgressViewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="viewer")
+        self.download = create_download(self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = reverse("download-progress", args=[self.download.id])
+        # The hub's background poller would query outside the test's
+        # transaction
+        patcher = mock.patch.object(hub, "_start_poller")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @override_settings(PROGRESS_SYNC_LONG_POLLS=0, PROGRESS_LONG_POLL_TIMEOUT=30)
+    def test_long_poll_without_slot_answers_at_once(self):
+        etag = self.client.get(self.url)["ETag"]
+        started = time.monotonic()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertIn("Retry-After", response)
+        self.assertLess(time.monotonic() - started, 5)
+
+    @override_settings(PROGRESS_SYNC_LONG_POLLS=0)
+    def test_repeated_polls_are_answered_from_the_hub(self):
+        etag = self.client.get(self.url)["ETag"]
+        with CaptureQueriesContext(connection) as queries:
+            for _ in range(3):
+                response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(queries), 0)
+
+        # Other users still have to pass the ownership check
+        self.client.force_authenticate(User.objects.create(username="other"))
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 404)
+
+    def test_events_need_async_views(self):
+        response = self.client.get(
+            reverse("download-progress-events", args=[self.download.id])
+        )
+        self.assertEqual(response.status_code, 501)
+
+
+@mock.patch("api.jobs.connection")
+class WorkerPoolTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="owner")
+        self.pool = WorkerPool(size=1, limits={})
+
+    def run_next(self, fails=False):
+        job = self.pool.claim()
+        if fails:
+            with self.assertLogs("api", "ERROR"):
+                self.pool.execute(job)
+        else:
+            self.pool.execute(job)
+        job.refresh_from_db()
+        return job
+
+    def test_failed_task_is_retried_then_fails(self, connection):
+        video = VimeoVideo.objects.create(
+            user=self.user, original_url="not a vimeo url", status="pending"
+        )
+        job = enqueue("process_video", owner=self.user.pk, video_id=str(video.pk))
+        Job.objects.filter(pk=job.pk).update(max_attempts=2)
+
+        job = self.run_next(fails=True)
+        self.assertEqual(job.status, "queued")
+        self.assertEqual(job.attempts, 1)
+        self.assertTrue(job.error)
+        self.assertGreater(job.run_after, timezone.now())
+        video.refresh_from_db()
+        self.assertEqual(video.status, "error")
+
+        Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        job = self.run_next(fails=True)
+        self.assertEqual(job.status, "failed")
+        self.assertEqual(job.attempts, 2)
+        self.assertIsNotNone(job.finished_at)
+
+    def test_successful_job_is_done(self, connection):
+        with mock.patch.dict(_handlers, {"noop": lambda: None}):
+            job = enqueue("noop")
+            job = self.run_next()
+        self.assertEqual(job.status, "done")
+
+    def test_recover_orphans(self, connection):
+        create_download(self.user, status="downloading")
+        merging = create_download(self.user, status="processing")
+        create_download(self.user, status="completed")
+        enqueue("merge_video", download_id=str(merging.pk))
+
+        self.assertEqual(recover_orphans(), 1)
+        self.assertEqual(
+            Job.objects.filter(kind="download_video", owner=str(self.user.pk)).count(),
+            1,
+        )
+        # Rows that already have a job are left alone
+        self.assertEqual(recover_orphans(), 0)
+
+
+class SegmentCoalescerTests(TestCase):
+    def setUp(self):
+        self.cdn = FakeCDN(segment_size=64 * 1024, latency=0).start()
+        self.addCleanup(self.cdn.stop)
+        self.url = self.cdn.segment_urls(1)[0]
+        self.coalescer = SegmentCoalescer()
+
+    def test_drops_chunks_every_reader_has_passed(self):
+        stream = SegmentStream(self.url)
+        first, second = stream.subscribe(), stream.subscribe()
+        stream.start(200, None)
+        first_chunks, second_chunks = first.iter_chunks(), second.iter_chunks()
+
+        stream.feed(b"a")
+        self.assertEqual(next(first_chunks), b"a")
+        self.assertEqual(stream.chunks, [b"a"])
+        stream.feed(b"b")
+        self.assertEqual(next(second_chunks), b"a")
+        self.assertEqual(next(second_chunks), b"b")
+        self.assertEqual(stream.chunks, [b"b"])
+
+        # Too late to read from the first byte
+        self.assertIsNone(stream.subscribe())
+
+        second_chunks.close()
+        stream.feed(b"c")
+        stream.finish()
+        self.assertEqual(b"".join(first_chunks), b"bc")
+        self.assertEqual(stream.chunks, [])
+        self.assertEqual(stream.received, 3)
+
+    def test_concurrent_requests_share_one_fetch(self):
+        first = self.coalescer.open(self.url)
+        second = self.coalescer.open(self.url)
+        expected = self.cdn.segment(0)
+        self.assertEqual(b"".join(first.iter_chunks()), expected)
+        self.assertEqual(b"".join(second.iter_chunks()), expected)
+        self.assertEqual(self.cdn.requests, 1)
+
+    def test_late_request_starts_a_new_fetch(self):
+        stream, reader, _ = self.coalescer._join(self.url)
+        stream.start(200, None)
+        stream.feed(b"a")
+        next(reader.iter_chunks())
+        late = self.coalescer.open(self.url)
+        self.assertEqual(b"".join(late.iter_chunks()), self.cdn.segment(0))
+        self.assertEqual(self.cdn.requests, 1)
+
+
+def upstream_response(status, content=b"", headers=None, body=b""):
+    response = mock.MagicMock(status_code=status, headers=headers or {})
+    response.__enter__.return_value = response
+    type(response).content = mock.PropertyMock(side_effect=content)
+    response.raw = io.BytesIO(body)
+    return response
+
+
+@mock.patch("api.segments.upstream.get")
+class SegmentFetcherTests(TestCase):
+    url = "https://cdn.example/segment-0.m4s"
+
+    def setUp(self):
+        self.fetcher = SegmentFetcher(retries=2, backoff=0, use_cache=False)
+
+    def test_status_errors_are_left_to_the_session(self, get):
+        get.return_value = upstream_response(503)
+        with self.assertRaises(SegmentFetchError):
+            self.fetcher.fetch_upstream(self.url)
+        self.assertEqual(get.call_count, 1)
+
+    def test_broken_body_is_fetched_again(self, get):
+        get.side_effect = [
+            upstream_response(200, [requests.exceptions.ChunkedEncodingError()]),
+            upstream_response(200, [b"segment"]),
+        ]
+        self.assertEqual(self.fetcher.fetch_upstream(self.url), b"segment")
+        self.assertEqual(get.call_count, 2)
+
+    def test_resume_that_does_not_match_starts_over(self, get):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "segment.m4s")
+        with open(path + ".part", "wb") as file:
+            file.write(b"abc")
+        get.side_effect = [
+            upstream_response(
+                206, headers={"Content-Range": "bytes 2-5/6"}, body=b"cdef"
+            ),
+            upstream_response(200, body=b"abcdef"),
+        ]
+        self.fetcher.fetch_to_file(self.url, path)
+
+        with open(path, "rb") as file:
+            self.assertEqual(file.read(), b"abcdef")
+        self.assertEqual(get.call_args_list[0].kwargs["headers"], {"Range": "bytes=3-"})
+        self.assertEqual(get.call_args_list[1].kwargs["headers"], {})
+
+    def test_host_limit_follows_the_current_setting(self, get):
+        entered = threading.Event()
+
+        def request(limit):
+            with host_limit(self.url, limit):
+                entered.set()
+
+        with host_limit(self.url, 1):
+            thread = threading.Thread(target=request, args=(1,))
+            thread.start()
+            self.assertFalse(entered.wait(0.1))
+            # A raised limit lets the next request in straight away
+            request(2)
+            self.assertTrue(entered.is_set())
+            entered.clear()
+        thread.join(1)
+        self.assertTrue(entered.is_set())
+
+
+@override_settings(PREFETCH_MAX_AHEAD=2, PREFETCH_WORKERS=2)
+class PrefetcherTests(TestCase):
+    def setUp(self):
+        self.cdn = FakeCDN(segment_size=16 * 1024, latency=0, segment_count=4).start()
+        self.addCleanup(self.cdn.stop)
+        index = PlaylistIndex.build(
+            self.cdn.manifest("1"), f"{self.cdn.base_url}video/1/"
+        )
+        self.track = index.video("720p")
+        self.download = create_download(User.objects.create(username="viewer"))
+        self.prefetcher = Prefetcher()
+
+    def test_prefetches_under_the_users_flow(self):
+        granted = scheduler.granted
+        self.prefetcher.advance(self.download, "video", 0, self.track)
+        self.prefetcher.executor().shutdown(wait=True)
+
+        self.assertEqual(self.prefetcher.scheduled, 2)
+        self.assertEqual(self.prefetcher.fetched, 2)
+        self.assertEqual(scheduler.granted - granted, 2)
+        self.assertEqual(
+            self.prefetcher.take(self.track.segment_url(1)), self.cdn.segment(1)
+        )
+        self.assertEqual(scheduler.stats()["downloads"], 0)
+
+    @override_settings(RELAY_CHUNK_SIZE=4096)
+    def test_prefetch_transfer_is_paced_by_the_flow(self):
+        with mock.patch.object(
+            scheduler, "throttle", wraps=scheduler.throttle
+        ) as throttle:
+            self.prefetcher.advance(self.download, "video", 0, self.track)
+            self.prefetcher.executor().shutdown(wait=True)
+
+        # Charged read by read as the body arrives, not once at the end
+        sizes = [call.args[1] for call in throttle.call_args_list]
+        self.assertEqual(sum(sizes), 2 * 16 * 1024)
+        self.assertLessEqual(max(sizes), 4096)
+
+
+class SegmentBitmapTests(TestCase):
+    def test_add_and_lookup(self):
+        bitmap = SegmentBitmap()
+        for index in (0, 3, 9):
+            bitmap.add(index)
+        self.assertIn(9, bitmap)
+        self.assertNotIn(8, bitmap)
+        self.assertNotIn(100, bitmap)
+        self.assertEqual(bitmap.count(), 3)
+        self.assertEqual(bitmap.missing(5), [1, 2, 4])
+        self.assertEqual(
+            SegmentBitmap(bitmap.to_bytes()).missing(10), bitmap.missing(10)
+        )
+
+    def test_merge(self):
+        other = SegmentBitmap()
+        other.add(1)
+        other.add(12)
+        bitmap = SegmentBitmap()
+        bitmap.add(0)
+        bitmap.merge(other.to_bytes())
+        self.assertEqual(bitmap.missing(13), [2, 3, 4, 5, 6, 7, 8, 9, 10, 11])
+
+
+class ProgressReporterTests(TestCase):
+    def setUp(self):
+        self.download = create_download(User.objects.create(username="viewer"))
+
+    def stored(self):
+        return VideoDownload.objects.get(pk=self.download.pk)
+
+    def test_flushes_every_few_chunks(self):
+        reporter = ProgressReporter(self.download, flush_interval=60, flush_chunks=2)
+        reporter.mark_segment("video", 0, 100)
+        self.assertEqual(reporter.writes, 0)
+        reporter.mark_segment("video", 0, 100)
+        self.assertEqual(reporter.writes, 0)
+        reporter.mark_segment("audio", 0, 50)
+        self.assertEqual(reporter.writes, 1)
+
+        download = self.stored()
+        self.assertEqual(download.downloaded_bytes, 150)
+        self.assertIn(0, SegmentBitmap(download.audio_segments))
+
+    def test_finished_track_does_not_flush_every_segment(self):
+        download = create_download(self.download.user, total_chunks=100)
+        reporter = ProgressReporter(download, flush_interval=60, flush_chunks=10)
+
+        def updates(kind):
+            with CaptureQueriesContext(connection) as queries:
+                for index in range(100):
+                    reporter.mark_segment(kind, index, 10)
+            return sum(query["sql"].startswith("UPDATE") for query in queries)
+
+        self.assertEqual(updates("video"), 10)
+        self.assertEqual(updates("audio"), 10)
+        download.refresh_from_db()
+        self.assertEqual(download.downloaded_bytes, 2000)
+        self.assertEqual(download.downloaded_chunks, 100)
+
+    def test_reporters_in_different_processes_merge(self):
+        job = ProgressReporter(self.download, flush_interval=60, flush_chunks=100)
+        web = ProgressReporter(self.download, flush_interval=60, flush_chunks=100)
+        job.mark_segment("video", 0, 100)
+        job.mark_segment("video", 2, 100)
+        web.mark_segment("video", 0, 100)
+        web.mark_segment("video", 1, 100)
+        job.flush()
+        web.flush()
+
+        download = self.stored()
+        self.assertEqual(SegmentBitmap(download.video_segments).missing(4), [3])
+        # Segment 0 is only counted once
+        self.assertEqual(download.downloaded_bytes, 300)
+        self.assertEqual(download.downloaded_chunks, 3)
+        self.assertEqual(web.bitmaps["video"].missing(4), [3])
+        self.assertEqual(web.downloaded_bytes, 300)
+
+    def test_transition_writes_pending_progress(self):
+        reporter = ProgressReporter(self.download, flush_interval=60, flush_chunks=100)
+        reporter.mark_segment("audio", 1, 10)
+        reporter.transition("completed")
+        download = self.stored()
+        self.assertEqual(download.status, "completed")
+        self.assertIn(1, SegmentBitmap(download.audio_segments))
+        self.assertEqual(download.downloaded_bytes, 10)
+
+
+class ManifestStorageTests(TestCase):
+    url = "https://vod.example/exp=1700000000~hmac=ab/video/1/playlist.json"
+
+    def test_new_fetch_leaves_earlier_rows_alone(self):
+        video = VimeoVideo.objects.create(
+            user=User.objects.create(username="viewer"),
+            original_url=self.url,
+            manifest=save_manifest(self.url, playlist={"clip_id": "old"}),
+        )
+        resigned = self.url.replace("hmac=ab", "hmac=cd")
+        latest = save_manifest(resigned, playlist={"clip_id": "new"})
+
+        self.assertEqual(load_manifest(video), {"clip_id": "old"})
+        self.assertEqual(
+            VideoManifest.objects.get(url_key=manifest_key(self.url)), latest
+        )
+        video.manifest.refresh_from_db()
+        self.assertIsNone(video.manifest.url_key)
+
+
+class SplitManifestsTests(TestCase):
+    def test_videos_of_one_url_keep_their_own_manifest(self):
+        user = User.objects.create(username="viewer")
+        url = "https://vod.example/video/1/playlist.json"
+        videos = [
+            VimeoVideo.objects.create(
+                user=user, original_url=url, playlist_json={"clip_id": str(n)}
+            )
+            for n in range(2)
+        ]
+        call_command("split_manifests", stdout=io.StringIO())
+
+        for n, video in enumerate(videos):
+            video.refresh_from_db()
+            self.assertIsNone(video.playlist_json)
+            self.assertIsNone(video.manifest.url_key)
+            self.assertEqual(load_manifest(video), {"clip_id": str(n)})
+
+
+class CursorPaginationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="viewer")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        for n in range(5):
+            VimeoVideo.objects.create(
+                user=self.user, original_url=f"https://vimeo.com/{n}", title=str(n)
+            )
+        other = User.objects.create(username="other")
+        VimeoVideo.objects.create(user=other, original_url="https://vimeo.com/9")
+
+    def pages(self, url, **params):
+        ids = []
+        response = self.client.get(url, {"page_size": 2, **params})
+        while True:
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            self.assertLessEqual(len(data["results"]), 2)
+            ids.extend(row["id"] for row in data["results"])
+            if not data["next"]:
+                return ids, data["results"]
+            response = self.client.get(data["next"])
+
+    def test_walks_every_row_once_newest_first(self):
+        ids, _ = self.pages(reverse("user-videos"))
+        expected = VimeoVideo.objects.filter(user=self.user).order_by(
+            "-created_at", "-id"
+        )
+        self.assertEqual(ids, [str(pk) for pk in expected.values_list("pk", flat=True)])
+
+    def test_rows_created_in_the_same_instant(self):
+        VimeoVideo.objects.filter(user=self.user).update(created_at=timezone.now())
+        ids, _ = self.pages(reverse("user-videos"))
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(len(set(ids)), 5)
+
+    def test_fields_projection(self):
+        _, results = self.pages(reverse("user-videos"), fields="id,title,bogus")
+        self.assertEqual(set(results[0]), {"id", "title"})
+
+    def test_unknown_fields_fall_back_to_all(self):
+        _, results = self.pages(reverse("user-videos"), fields="bogus")
+        self.assertEqual(set(results[0]), set(VimeoVideoListSerializer.Meta.fields))
+
+    def test_download_fields_projection(self):
+        create_download(self.user)
+        response = self.client.get(
+            reverse("user-downloads"), {"fields": "id,progress,eta_seconds"}
+        )
+        row = response.json()["results"][0]
+        self.assertEqual(set(row), {"id", "progress", "eta_seconds"})
+
+
+class MetricsTokenTests(TestCase):
+    @override_settings(METRICS_TOKEN="s3cret")
+    def test_token_required_when_set(self):
+        self.assertFalse(metrics.authorized(None))
+        self.assertFalse(metrics.authorized("Bearer wrong"))
+        self.assertTrue(metrics.authorized("Bearer s3cret"))
+
+    @override_settings(METRICS_TOKEN="")
+    def test_open_without_token(self):
+        self.assertTrue(metrics.authorized(None))
+        self.assertFalse(metrics.authorized(None, require_token=True))
+
+    @override_settings(METRICS_TOKEN="", DEBUG=False)
+    def test_web_scrapes_need_a_token(self):
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 401)
+        with override_settings(METRICS_TOKEN="s3cret"):
+            response = self.client.get(
+                reverse("metrics"), HTTP_AUTHORIZATION="Bearer s3cret"
+            )
+        self.assertEqual(response.status_code, 200)
+
+
+def track_ids(data):
+    """
+    Track ids of the tkhd boxes in an init segment's moov
+    """
+    _, moov, moov_end = find_box(data, "moov")
+    ids = []
+    for box_type, _, payload, end in iter_boxes(data, moov, moov_end):
+        if box_type == "trak":
+            _, tkhd, _ = find_box(data, "tkhd", payload, end)
+            ids.append(struct.unpack_from(">I", data, tkhd + 12)[0])
+    return ids
+
+
+def fragment_ids(data):
+    """
+    (sequence number, track id) of each moof in a run of fragments
+    """
+    ids = []
+    for box_type, _, payload, end in iter_boxes(data):
+        if box_type == "moof":
+            _, mfhd, _ = find_box(data, "mfhd", payload, end)
+            _, traf, traf_end = find_box(data, "traf", payload, end)
+            _, tfhd, _ = find_box(data, "tfhd", traf, traf_end)
+            ids.append(
+                (
+                    struct.unpack_from(">I", data, mfhd + 4)[0],
+                    struct.unpack_from(">I", data, tfhd + 4)[0],
+                )
+            )
+    return ids
+
+
+class FragmentedMuxerTests(TestCase):
+    def test_init_segment_carries_both_tracks(self):
+        muxer = FragmentedMuxer(init_segment(), init_segment())
+        self.assertEqual(track_ids(muxer.init_segment()), [1, 2])
+        self.assertEqual(muxer.audio_track_ids, {1: 2})
+
+    def test_fragments_are_renumbered_and_remapped(self):
+        muxer = FragmentedMuxer(init_segment(), init_segment())
+        init = muxer.init_segment()
+        output = [
+            muxer.video_fragment(fragment(0, 1024, 4.0)),
+            muxer.audio_fragment(fragment(0, 512, 4.0)),
+            muxer.video_fragment(fragment(1, 1024, 4.0)),
+        ]
+        self.assertEqual([len(data) for data in output], [1024, 512, 1024])
+        self.assertEqual(fragment_ids(b"".join(output)), [(1, 1), (2, 2), (3, 1)])
+        self.assertEqual(muxer.position, len(init) + 2560)
+
+    def test_merges_fragments_from_the_cdn(self):
+        with FakeCDN(segment_size=4096, latency=0, segment_count=3, fmp4=True) as cdn:
+            index = PlaylistIndex.build(cdn.manifest("1"), f"{cdn.base_url}video/1/")
+            video, audio = index.video("720p"), index.audio
+            muxer = FragmentedMuxer(video.init_segment, audio.init_segment)
+            merged = b"".join(merged_fragments(muxer, video, audio))
+
+        init = muxer.init_segment()
+        self.assertTrue(merged.startswith(init))
+        self.assertEqual(len(merged), len(init) + 6 * 4096)
+        # Tracks alternate by start time
+        self.assertEqual(
+            fragment_ids(merged[len(init) :]),
+            [(1, 1), (2, 2), (3, 1), (4, 2), (5, 1), (6, 2)],
+        )
+
+
+class TokenBucketTests(TestCase):
+    def test_burst_then_wait(self):
+        bucket = TokenBucket(1000)
+        self.assertEqual(bucket.reserve(1000), 0.0)
+        self.assertAlmostEqual(bucket.reserve(500), 0.5, delta=0.05)
+
+    def test_zero_rate_is_unlimited(self):
+        self.assertEqual(TokenBucket(0).reserve(10**9), 0.0)
+
+
+@override_settings(SCHEDULER_MAX_IN_FLIGHT=1, SCHEDULER_USER_MAX_IN_FLIGHT=1)
+class FairSchedulerTests(TestCase):
+    def test_users_share_slots_regardless_of_download_count(self):
+        fair = FairScheduler()
+        granted = []
+
+        def fetch(flow):
+            with flow.slot():
+                granted.append(flow.user_id)
+
+        with fair.flow("a", 1) as a1, fair.flow("a", 2) as a2, fair.flow(
+            "b", 3
+        ) as b, fair.flow("c", 4) as blocker:
+            threads = []
+            with blocker.slot():
+                for flow in (a1, a1, a2, a2, b, b):
+                    thread = threading.Thread(target=fetch, args=(flow,))
+                    thread.start()
+                    threads.append(thread)
+                    # Queue in a known order
+                    while fair.stats()["waiting"] < len(threads):
+                        time.sleep(0.001)
+            for thread in threads:
+                thread.join(5)
+
+        # User "a" runs two downloads but gets no more of the first slots
+        self.assertEqual(sorted(granted[:4]), ["a", "a", "b", "b"])
+        self.assertEqual(granted[4:], ["a", "a"])
+        self.assertEqual(fair.stats()["in_flight"], 0)
+
+
+class SegmentCacheTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_evicts_least_recently_used(self):
+        cache = SegmentCache(self.directory, max_bytes=10)
+        cache.put("a", b"aaaa")
+        cache.put("b", b"bbbb")
+        self.assertEqual(cache.get("a"), b"aaaa")
+        cache.put("c", b"cccc")
+
+        self.assertTrue(cache.has("a"))
+        self.assertFalse(cache.has("b"))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), b"cccc")
+        stats = cache.stats()
+        self.assertEqual(stats["evictions"], 1)
+        self.assertEqual(stats["size_bytes"], 8)
+
+    def test_stale_temp_files_are_removed(self):
+        cache = SegmentCache(self.directory, max_bytes=10)
+        stale, fresh = cache.writer("a"), cache.writer("b")
+        stale.file.close()
+        fresh.file.close()
+        os.utime(stale.temp_path, (0, 0))
+
+        SegmentCache(self.directory, max_bytes=10)
+        self.assertFalse(os.path.exists(stale.temp_path))
+        self.assertTrue(os.path.exists(fresh.temp_path))
+
+    def test_reloads_entries_from_disk(self):
+        SegmentCache(self.directory, max_bytes=10).put("a", b"aaaa")
+        cache = SegmentCache(self.directory, max_bytes=10)
+        self.assertEqual(cache.stats()["size_bytes"], 4)
+        self.assertEqual(cache.get("a"), b"aaaa")
+
+
+@override_settings(SENDFILE_BACKEND="django")
+class ServeFileTests(TestCase):
+    content = bytes(range(256)) * 4
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "video.mp4")
+        with open(self.path, "wb") as file:
+            file.write(self.content)
+        self.etag = file_etag(os.stat(self.path))
+        self.factory = RequestFactory()
+
+    def serve(self, **headers):
+        headers = {name.replace("_", "-"): value for name, value in headers.items()}
+        request = self.factory.get("/", headers=headers)
+        response = serve_file(request, open(self.path, "rb"), "video/mp4")
+        body = b""
+        if response.streaming:
+            body = b"".join(response.streaming_content)
+            response.close()
+        return response, body
+
+    def test_whole_file(self):
+        response, body = self.serve()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.content)
+        self.assertEqual(response["ETag"], f'"{self.etag}"')
+        self.assertEqual(response["Content-Length"], str(len(self.content)))
+
+    def test_range(self):
+        response, body = self.serve(Range="bytes=10-19")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, self.content[10:20])
+        self.assertEqual(response["Content-Range"], "bytes 10-19/1024")
+
+    def test_suffix_range(self):
+        response, body = self.serve(Range="bytes=-5")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, self.content[-5:])
+
+    def test_unsatisfiable_range(self):
+        response, _ = self.serve(Range="bytes=2000-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], "bytes */1024")
+
+    def test_not_modified(self):
+        response, body = self.serve(If_None_Match=f'"{self.etag}"')
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(body, b"")
+
+    def test_stale_if_range_sends_whole_file(self):
+        response, body = self.serve(Range="bytes=10-19", If_Range='"other"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.content)
@@ -0,0 +1,151 @@
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import timedelta
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.db.models import Avg
+from django.utils import timezone
+
+from . import metrics
+from .models import ThroughputEstimate
+
+logger = logging.getLogger(__name__)
+
+# Weight of the newest sample in the moving averages
+SMOOTHING = 0.2
+
+
+def ewma(average, sample):
+    if not average:
+        return sample
+    return average + SMOOTHING * (sample - average)
+
+
+def eta_seconds(status, file_size, downloaded_bytes, bytes_per_second):
+    """
+    Seconds left for a download at its current rate, or None if unknown
+    """
+    if status == "completed":
+        return 0
+    if status == "error" or not file_size or not bytes_per_second:
+        return None
+    return int(max(file_size - downloaded_bytes, 0) / bytes_per_second)
+
+
+def worker_key():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class ThroughputEstimator:
+    """
+    Rolling bandwidth measurements from real segment fetches
+
+    Per host, the rate of single segment fetches. Per worker process, the
+    overall rate of whole download jobs, which accounts for concurrency,
+    throttling and retries. Both are moving averages, saved to the
+    database at most every THROUGHPUT_FLUSH_INTERVAL seconds so that web
+    processes, which mostly do not fetch, can estimate download times.
+    """
+
+    def __init__(self):
+        self.hosts = {}
+        self.worker = 0.0
+        self._dirty = set()
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, url, size, seconds, flush=True):
+        """
+        Record one upstream segment fetch of `size` bytes, also in the
+        segment metrics
+
+        With flush=False the rate is only saved by a later flush, for
+        callers that must not touch the database.
+        """
+        if size <= 0 or seconds <= 0:
+            return
+        metrics.UPSTREAM_SEGMENT_SECONDS.observe(seconds)
+        metrics.UPSTREAM_SEGMENT_RATE.observe(size / seconds)
+        metrics.UPSTREAM_SEGMENT_BYTES.inc(size)
+        host = urlparse(url).netloc
+        with self._lock:
+            self.hosts[host] = ewma(self.hosts.get(host), size / seconds)
+            self._dirty.add((ThroughputEstimate.HOST, host))
+            due = (
+                time.monotonic() - self._last_flush
+                >= settings.THROUGHPUT_FLUSH_INTERVAL
+            )
+        if due and flush:
+            self.flush()
+
+    def record_job(self, size, seconds):
+        """
+        Record the overall rate of a finished download job
+        """
+        if size <= 0 or seconds <= 0:
+            return
+        with self._lock:
+            self.worker = ewma(self.worker, size / seconds)
+            self._dirty.add((ThroughputEstimate.WORKER, worker_key()))
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            dirty = self._dirty
+            self._dirty = set()
+            self._last_flush = time.monotonic()
+            rates = {
+                (scope, key): (
+                    self.hosts[key] if scope == ThroughputEstimate.HOST else self.worker
+                )
+                for scope, key in dirty
+            }
+        for (scope, key), rate in rates.items():
+            try:
+                ThroughputEstimate.objects.update_or_create(
+                    scope=scope, key=key, defaults={"bytes_per_second": rate}
+                )
+            except Exception:
+                logger.exception("Error saving throughput estimate")
+
+    def expected_rate(self, url=None):
+        """
+        Bytes per second a new download can expect
+
+        The recent average of worker job rates when there are any;
+        otherwise the host's per-fetch rate times the concurrent fetches
+        allowed per host; otherwise DEFAULT_DOWNLOAD_RATE.
+        """
+        recent = ThroughputEstimate.objects.filter(
+            updated_at__gte=timezone.now()
+            - timedelta(seconds=settings.THROUGHPUT_MAX_AGE)
+        )
+        workers = recent.filter(scope=ThroughputEstimate.WORKER).aggregate(
+            rate=Avg("bytes_per_second")
+        )["rate"]
+        if workers:
+            return workers
+
+        host = urlparse(url).netloc if url else None
+        if host:
+            rate = self.hosts.get(host)
+            if rate is None:
+                rate = (
+                    recent.filter(scope=ThroughputEstimate.HOST, key=host)
+                    .values_list("bytes_per_second", flat=True)
+                    .first()
+                )
+            if rate:
+                concurrency = min(
+                    settings.SEGMENT_FETCH_WORKERS, settings.SEGMENT_FETCH_PER_HOST
+                )
+                return rate * concurrency
+
+        return settings.DEFAULT_DOWNLOAD_RATE
+
+
+throughput = ThroughputEstimator()
@@ -0,0 +1,185 @@
+import asyncio
+import os
+import threading
+import weakref
+
+import aiohttp
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+_session = None
+_session_pid = None
+_http2 = False
+_lock = threading.Lock()
+
+# aiohttp sessions for async views, one per event loop
+_async_sessions = weakref.WeakKeyDictionary()
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Counters carried over from connection pools urllib3 has evicted
+_evicted = {"connections": 0, "requests": 0}
+
+
+def _enable_http2():
+    """
+    Let urllib3 negotiate HTTP/2 over TLS when it and h2 support it
+
+    This is urllib3's experimental injection: it replaces HTTPSConnection
+    for everything in the process, not just the upstream session, and
+    only offers h2, so it is off unless UPSTREAM_HTTP2 is set and every
+    HTTPS host the process talks to speaks HTTP/2.
+    """
+    try:
+        import urllib3.http2
+
+        urllib3.http2.inject_into_urllib3()
+    except (ImportError, AttributeError):
+        return False
+    return True
+
+
+def _record_evicted(pool):
+    with _lock:
+        _evicted["connections"] += pool.num_connections
+        _evicted["requests"] += pool.num_requests
+    pool.close()
+
+
+def _build_session():
+    global _http2
+
+    if settings.UPSTREAM_HTTP2 and not _http2:
+        _http2 = _enable_http2()
+
+    retry = Retry(
+        total=settings.UPSTREAM_RETRIES,
+        backoff_factor=settings.UPSTREAM_BACKOFF,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=("GET", "HEAD"),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=settings.UPSTREAM_POOL_HOSTS,
+        pool_maxsize=settings.UPSTREAM_POOL_SIZE,
+        max_retries=retry,
+    )
+    adapter.poolmanager.pools.dispose_func = _record_evicted
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session():
+    """
+    Get the process-wide pooled session for upstream requests
+
+    The session is rebuilt after a fork so worker processes never share
+    sockets with their parent.
+    """
+    global _session, _session_pid
+
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _lock:
+            if _session is None or _session_pid != pid:
+                _session = _build_session()
+                _session_pid = pid
+    return _session
+
+
+def get(url, **kwargs):
+    """
+    GET an upstream URL through the shared connection pool
+    """
+    kwargs.setdefault(
+        "timeout", (settings.UPSTREAM_CONNECT_TIMEOUT, settings.UPSTREAM_READ_TIMEOUT)
+    )
+    return get_session().get(url, **kwargs)
+
+
+def head(url, **kwargs):
+    """
+    HEAD an upstream URL through the shared connection pool
+    """
+    kwargs.setdefault(
+        "timeout", (settings.UPSTREAM_CONNECT_TIMEOUT, settings.UPSTREAM_READ_TIMEOUT)
+    )
+    kwargs.setdefault("allow_redirects", True)
+    return get_session().head(url, **kwargs)
+
+
+def get_async_session():
+    """
+    Get the pooled aiohttp session for the running event loop
+    """
+    loop = asyncio.get_running_loop()
+    session = _async_sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=settings.UPSTREAM_ASYNC_POOL_SIZE, ttl_dns_cache=300
+        )
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=settings.UPSTREAM_CONNECT_TIMEOUT,
+            sock_read=settings.UPSTREAM_READ_TIMEOUT,
+        )
+        session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        _async_sessions[loop] = session
+    return session
+
+
+async def aget(url, headers=None):
+    """
+    GET an upstream URL from async code, retrying like the sync session
+
+    The caller must release the returned response.
+    """
+    session = get_async_session()
+    for attempt in range(settings.UPSTREAM_RETRIES + 1):
+        last_attempt = attempt == settings.UPSTREAM_RETRIES
+        try:
+            response = await session.get(url, headers=headers)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if last_attempt:
+                raise
+        else:
+            if response.status not in RETRY_STATUSES or last_attempt:
+                return response
+            response.release()
+        await asyncio.sleep(settings.UPSTREAM_BACKOFF * 2**attempt)
+
+
+def connection_stats():
+    """
+    Connection reuse statistics for the current process
+    """
+    connections = _evicted["connections"]
+    total_requests = _evicted["requests"]
+    pool_count = 0
+
+    if _session is not None and _session_pid == os.getpid():
+        adapter = _session.get_adapter("https://")
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            try:
+                pool = pools[key]
+            except KeyError:
+                continue
+            pool_count += 1
+            connections += pool.num_connections
+            total_requests += pool.num_requests
+
+    return {
+        "requests": total_requests,
+        "connections_opened": connections,
+        "handshakes_saved": max(total_requests - connections, 0),
+        "reuse_ratio": (
+            round(1 - connections / total_requests, 4) if total_requests else 0.0
+        ),
+        "open_pools": pool_count,
+        "http2": _http2,
+    }
@@ -1,19 +1,32 @@
+from django.conf import settings
 from django.urls import path
 from .views import (
     HealthView,
+    StatsView,
     SubmitVideoUrlView,
     GetVideoInfoView,
     StartDownloadView,
     StreamChunkView,
     DownloadProgressView,
     MergeVideoAudioView,
+    StreamMergedVideoView,
     UserVideosView,
-    UserDownloadsView
+    UserDownloadsView,
+    DownloadEventsView
 )
 
+if settings.ASYNC_VIEWS:
+    from .async_views import (
+        AsyncStreamChunkView as StreamChunkView,
+        AsyncDownloadProgressView as DownloadProgressView,
+        AsyncStreamMergedVideoView as StreamMergedVideoView,
+        DownloadEventsView,
+    )
+
 urlpatterns = [
     # Health check
     path('api/health/', HealthView.as_view(), name='health'),
+    path('api/stats/', StatsView.as_view(), name='stats'),
     
     # Video submission and info
     path('api/submit-url/', SubmitVideoUrlView.as_view(), name='submit-url'),
@@ -24,6 +37,8 @@ urlpatterns = [
     path('api/start-download/', StartDownloadView.as_view(), name='start-download'),
     path('api/stream-chunk/<uuid:download_id>/', StreamChunkView.as_view(), name='stream-chunk'),
     path('api/download-progress/<uuid:download_id>/', DownloadProgressView.as_view(), name='download-progress'),
+    path('api/download-progress/<uuid:download_id>/events/', DownloadEventsView.as_view(), name='download-progress-events'),
     path('api/merge-video-audio/<uuid:download_id>/', MergeVideoAudioView.as_view(), name='merge-video-audio'),
+    path('api/stream-video/<uuid:download_id>/', StreamMergedVideoView.as_view(), name='stream-video'),
     path('api/user-downloads/', UserDownloadsView.as_view(), name='user-downloads'),
 ]
\ No newline at end of file
@@ -1,29 +1,68 @@
 import os
 import json
+import logging
+import threading
+import time
 import base64
 import requests
 import asyncio
 import tempfile
 from urllib.parse import urlparse, urljoin
+from django.conf import settings
 from django.utils import timezone
-from django.http import StreamingHttpResponse, JsonResponse
+from django.http import HttpResponse, StreamingHttpResponse, JsonResponse
 from django.db import transaction
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
 from rest_framework import status
 from concurrent.futures import ThreadPoolExecutor
 import aiohttp
 from asgiref.sync import sync_to_async, async_to_sync
 
+from . import metrics, upstream
+from .cache import segment_cache
+from .coalesce import coalescer
+from .events import hub, parse_etag, progress_snapshot
+from .jobs import enqueue, job, queue_stats
+from .manifests import fetch_manifest, load_manifest
+from .fmp4 import FragmentedMuxer, Fmp4Error, interleave_order
 from .models import VimeoVideo, VideoDownload
+from .progress import ProgressReporter, SegmentBitmap, reporters
+from .prefetch import PrefetchedSegment, prefetcher
+from .playlist import PlaylistIndex, cache_playlist_index, get_playlist_index
+from .muxing import merge_pipeline
+from .relay import content_range, iter_response
+from .scheduler import scheduler
+from .segments import SegmentFetcher
+from .throughput import throughput
+from .sendfile import serve_file
+from .workspace import DownloadWorkspace
+from .pagination import CreatedCursorPagination, model_fields, requested_fields
 from .serializers import (
     VimeoVideoSerializer,
+    VimeoVideoListSerializer,
     VideoDownloadSerializer,
+    VideoDownloadListSerializer,
     CreateVideoRequestSerializer,
     CreateDownloadRequestSerializer,
 )
 
+logger = logging.getLogger(__name__)
+
+# Large playlist columns that most views never read directly
+VIDEO_BLOB_FIELDS = ("playlist_json", "master_json", "playlist_index")
+DEFERRED_VIDEO_FIELDS = tuple(f"video__{field}" for field in VIDEO_BLOB_FIELDS)
+
+# Values accepted for ?type= on chunk requests
+CHUNK_TYPES = ("video", "audio")
+
+
+# Metadata extraction is quick and a user is waiting on it; merges are the
+# most CPU-heavy work and can wait behind everything else
+JOB_PRIORITY_HIGH = 10
+JOB_PRIORITY_LOW = -10
+
 
 class HealthView(APIView):
     permission_classes = [AllowAny]
@@ -32,6 +71,47 @@ class HealthView(APIView):
         return Response({"status": "ok"})
 
 
+class MetricsView(APIView):
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    def get(self, request):
+        """
+        Metrics of this process in Prometheus text format
+        GET /metrics
+
+        Publicly reachable, so off unless METRICS_TOKEN is set (or DEBUG)
+        """
+        if not metrics.authorized(
+            request.headers.get("Authorization"), require_token=not settings.DEBUG
+        ):
+            return HttpResponse(status=status.HTTP_401_UNAUTHORIZED)
+        return HttpResponse(
+            metrics.registry.exposition(), content_type=metrics.CONTENT_TYPE
+        )
+
+
+class StatsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        """
+        Runtime statistics for this process
+        GET /api/stats/
+        """
+        cache = segment_cache()
+        return Response(
+            {
+                "upstream": upstream.connection_stats(),
+                "segment_cache": cache.stats() if cache else None,
+                "coalescer": coalescer.stats(),
+                "prefetch": prefetcher.stats(),
+                "scheduler": scheduler.stats(),
+                "jobs": queue_stats(),
+            }
+        )
+
+
 class SubmitVideoUrlView(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -47,9 +127,11 @@ class SubmitVideoUrlView(APIView):
         url = serializer.validated_data["url"]
 
         # Check if already exists
-        existing = VimeoVideo.objects.filter(
-            user=request.user, original_url=url
-        ).first()
+        existing = (
+            VimeoVideo.objects.defer(*VIDEO_BLOB_FIELDS)
+            .filter(user=request.user, original_url=url)
+            .first()
+        )
 
         if existing:
             return Response(
@@ -65,29 +147,31 @@ class SubmitVideoUrlView(APIView):
         )
 
         # Start background processing
-        self.process_vimeo_url_background(video.id)
+        self.process_vimeo_url_background(video.id, request.user.pk)
 
         return Response(
             {"message": "Video submitted for processing", "video_id": str(video.id)},
             status=status.HTTP_202_ACCEPTED,
         )
 
-    def process_vimeo_url_background(self, video_id):
+    def process_vimeo_url_background(self, video_id, user_id=None):
         """
-        Background task to process Vimeo URL
+        Queue background task to process Vimeo URL
         """
-        import threading
-
-        thread = threading.Thread(target=self.process_vimeo_url_task, args=(video_id,))
-        thread.daemon = True
-        thread.start()
+        enqueue(
+            "process_video",
+            priority=JOB_PRIORITY_HIGH,
+            owner=user_id,
+            video_id=str(video_id),
+        )
 
     def process_vimeo_url_task(self, video_id):
         """
         Process Vimeo URL to extract playlist/master.json
         """
+        started = time.perf_counter()
         try:
-            video = VimeoVideo.objects.get(id=video_id)
+            video = VimeoVideo.objects.defer(*VIDEO_BLOB_FIELDS).get(id=video_id)
             video.status = "processing"
             video.save()
 
@@ -105,13 +189,10 @@ class SubmitVideoUrlView(APIView):
                 # For now, we'll assume the provided URL is the final one
                 pass
 
-            # Fetch playlist/master.json
-            response = requests.get(url)
-            if response.status_code != 200:
-                raise Exception(f"Failed to fetch playlist: {response.status_code}")
-
-            data = response.json()
-            video.playlist_json = data
+            # Fetch playlist/master.json, shared with other submissions of it
+            with metrics.MANIFEST_FETCH_SECONDS.time():
+                manifest, data = fetch_manifest(url)
+            video.manifest = manifest
 
             # Extract base URL
             if "base_url" in data:
@@ -155,18 +236,28 @@ class SubmitVideoUrlView(APIView):
                 f"https://vimeo.com/{video_id_str}" if video_id_str else ""
             )
 
+            # Precompute track and segment lookups for the download views
+            index = PlaylistIndex.build(data, video.base_url)
+            video.playlist_index = index.to_dict()
+
             video.status = "ready"
             video.processed_at = timezone.now()
             video.save()
+            cache_playlist_index(video, index)
 
+            metrics.TASK_SECONDS.labels("process_video", "ok").observe(
+                time.perf_counter() - started
+            )
             return True
 
-        except Exception as e:
-            video = VimeoVideo.objects.get(id=video_id)
-            video.status = "error"
-            video.save()
-            print(f"Error processing video: {e}")
-            return False
+        except Exception:
+            VimeoVideo.objects.filter(id=video_id).update(status="error")
+            logger.exception("Error processing video %s", video_id)
+            metrics.TASK_SECONDS.labels("process_video", "error").observe(
+                time.perf_counter() - started
+            )
+            # Let the job queue retry it
+            raise
 
 
 class GetVideoInfoView(APIView):
@@ -175,10 +266,15 @@ class GetVideoInfoView(APIView):
     def get(self, request, video_id):
         """
         Get video information including available resolutions
-        GET /api/video-info/{video_id}/
+        GET /api/video-info/{video_id}/?manifest=true
+
+        The raw playlist/master manifests are only loaded and included when
+        asked for with ?manifest=true.
         """
         try:
-            video = VimeoVideo.objects.get(id=video_id, user=request.user)
+            video = VimeoVideo.objects.defer(*VIDEO_BLOB_FIELDS).get(
+                id=video_id, user=request.user
+            )
         except VimeoVideo.DoesNotExist:
             return Response(
                 {"error": "Video not found or access denied"},
@@ -191,8 +287,11 @@ class GetVideoInfoView(APIView):
                 status=status.HTTP_202_ACCEPTED,
             )
 
-        serializer = VimeoVideoSerializer(video)
-        return Response(serializer.data)
+        data = VimeoVideoSerializer(video).data
+        if request.query_params.get("manifest") == "true":
+            data["playlist_json"] = load_manifest(video, "playlist")
+            data["master_json"] = load_manifest(video, "master")
+        return Response(data)
 
 
 class StartDownloadView(APIView):
@@ -211,7 +310,9 @@ class StartDownloadView(APIView):
         resolution = serializer.validated_data["resolution"]
 
         try:
-            video = VimeoVideo.objects.get(id=video_id, user=request.user)
+            video = VimeoVideo.objects.defer(*VIDEO_BLOB_FIELDS).get(
+                id=video_id, user=request.user
+            )
         except VimeoVideo.DoesNotExist:
             return Response(
                 {"error": "Video not found or access denied"},
@@ -240,7 +341,7 @@ class StartDownloadView(APIView):
         self.calculate_download_info(download)
 
         # Start download in background
-        self.start_video_download_background(download.id)
+        self.start_video_download_background(download.id, request.user.pk)
 
         return Response(
             {"message": "Download started", "download_id": str(download.id)},
@@ -252,87 +353,113 @@ class StartDownloadView(APIView):
         Calculate download information (size, duration, chunks)
         """
         video = download.video
-        playlist = video.playlist_json
 
         # Find the selected resolution
-        selected_res = int(download.resolution.replace("p", ""))
-
-        video_data = None
-        for v in playlist.get("video", []):
-            if v.get("height") == selected_res:
-                video_data = v
-                break
+        index = get_playlist_index(video)
+        track = index.video(download.resolution) if index else None
 
-        if not video_data:
+        if not track:
             download.status = "error"
             download.save()
             return
 
         # Calculate total chunks
-        total_chunks = len(video_data.get("segments", []))
-        download.total_chunks = total_chunks
+        download.total_chunks = len(track)
 
         # Estimate file size from segments
-        total_size = 0
-        if "segments" in video_data:
-            for segment in video_data["segments"]:
-                if "size" in segment:
-                    total_size += segment["size"]
-                elif "length" in segment:
-                    total_size += segment["length"]
+        total_size = track.total_size
 
         # If no size in segments, estimate from bitrate
-        if total_size == 0 and "bitrate" in video_data:
-            bitrate = video_data["bitrate"]  # bits per second
-            total_size = (bitrate * video.duration) / 8  # Convert to bytes
+        if total_size == 0 and track.bitrate:
+            total_size = (track.bitrate * video.duration) / 8  # Convert to bytes
 
         download.file_size = total_size
 
-        # Calculate estimated download time (assuming 5 Mbps download speed)
-        estimated_time = total_size / (5 * 125000)  # 5 Mbps in bytes per second
-        download.estimated_duration = int(estimated_time)
+        # Estimated download time at the bandwidth recently measured by the
+        # workers; the download job refines the size once it starts
+        rate = throughput.expected_rate(track.urls[0] if len(track) else None)
+        download.estimated_duration = int(total_size / rate)
 
         download.save()
 
-    def start_video_download_background(self, download_id):
+    def start_video_download_background(self, download_id, user_id=None):
         """
-        Start background download task
+        Queue background download task
         """
-        import threading
-
-        thread = threading.Thread(target=self.download_video_task, args=(download_id,))
-        thread.daemon = True
-        thread.start()
+        enqueue("download_video", owner=user_id, download_id=str(download_id))
 
     def download_video_task(self, download_id):
         """
         Download video chunks task
         """
+        started = time.perf_counter()
+        reporter = None
         try:
-            download = VideoDownload.objects.get(id=download_id)
-            download.status = "downloading"
-            download.started_at = timezone.now()
-            download.save()
-
-            # This is where you would implement the actual chunk downloading
-            # For now, we'll just simulate completion
-            import time
-
-            for i in range(download.total_chunks):
-                time.sleep(0.5)  # Simulate download time
-                download.downloaded_chunks = i + 1
-                download.progress = (i + 1) / download.total_chunks
-                download.save()
-
-            download.status = "completed"
-            download.completed_at = timezone.now()
-            download.save()
+            download = (
+                VideoDownload.objects.select_related("video")
+                .defer(*DEFERRED_VIDEO_FIELDS)
+                .get(id=download_id)
+            )
+            reporter = ProgressReporter(download)
+
+            index = get_playlist_index(download.video)
+            workspace = DownloadWorkspace(download.id)
+            fetcher = SegmentFetcher()
+
+            # Fetch only the segments not already on disk from an earlier run
+            video_track = index.video(download.resolution) if index else None
+            if not video_track:
+                raise Exception(f"No video data found for {download.resolution}")
+
+            # Exact sizes from the manifest, or probed from the CDN
+            tracks = [("video", video_track)]
+            if download.include_audio and index.audio:
+                tracks.append(("audio", index.audio))
+            file_size = sum(fetcher.probe_track_size(track) for _, track in tracks)
+
+            reporter.transition(
+                "downloading",
+                started_at=timezone.now(),
+                file_size=file_size or download.file_size,
+            )
+            fetch_started = time.monotonic()
+            downloaded_before = reporter.downloaded_bytes
+
+            def segment_done(kind):
+                def done(i):
+                    path = workspace.segment_path(kind, i)
+                    reporter.mark_segment(kind, i, os.path.getsize(path))
+                    if kind == "video":
+                        reporter.set_chunks(reporter.bitmaps["video"].count())
+
+                return done
+
+            # Fetch under this user's share of the connections and bandwidth
+            with scheduler.flow(download.user_id, download.id) as flow:
+                fetcher.flow = flow
+                for kind, track in tracks:
+                    workspace.fetch(kind, track, fetcher, segment_done(kind))
+
+            throughput.record_job(
+                reporter.downloaded_bytes - downloaded_before,
+                time.monotonic() - fetch_started,
+            )
+            reporter.transition("completed", completed_at=timezone.now())
+            metrics.TASK_SECONDS.labels("download_video", "ok").observe(
+                time.perf_counter() - started
+            )
 
-        except Exception as e:
-            download = VideoDownload.objects.get(id=download_id)
-            download.status = "error"
-            download.save()
-            print(f"Error downloading video: {e}")
+        except Exception:
+            # Keep the segments received so far for the next attempt
+            if reporter is not None:
+                reporter.transition("error")
+            else:
+                VideoDownload.objects.filter(id=download_id).update(status="error")
+            logger.exception("Error downloading video %s", download_id)
+            metrics.TASK_SECONDS.labels("download_video", "error").observe(
+                time.perf_counter() - started
+            )
+            raise
 
 
 class StreamChunkView(APIView):
@@ -344,7 +471,11 @@ class StreamChunkView(APIView):
         GET /api/stream-chunk/{download_id}/?chunk=0&type=video
         """
         try:
-            download = VideoDownload.objects.get(id=download_id, user=request.user)
+            download = (
+                VideoDownload.objects.select_related("video")
+                .defer(*DEFERRED_VIDEO_FIELDS)
+                .get(id=download_id, user=request.user)
+            )
         except VideoDownload.DoesNotExist:
             return Response(
                 {"error": "Download not found or access denied"},
@@ -366,114 +497,292 @@ class StreamChunkView(APIView):
             return Response(
                 {"error": "Invalid chunk number"}, status=status.HTTP_400_BAD_REQUEST
             )
+        if chunk_type not in CHUNK_TYPES:
+            return Response(
+                {"error": "Invalid chunk type"}, status=status.HTTP_400_BAD_REQUEST
+            )
 
-        # Get chunk data
-        chunk_data = self.get_chunk_data(download, chunk_number, chunk_type)
-
-        if chunk_data is None:
+        # Video track for the selected resolution, or the best audio track
+        index = get_playlist_index(download.video)
+        track = index.track(chunk_type, download.resolution) if index else None
+        segment_url = track.segment_url(chunk_number) if track else None
+        if segment_url is None:
             return Response(
                 {"error": "Chunk not found"}, status=status.HTTP_404_NOT_FOUND
             )
 
-        # Stream the chunk
-        response = StreamingHttpResponse(
-            chunk_data,
-            content_type="video/mp4" if chunk_type == "video" else "audio/mp4",
-            status=200,
-        )
+        cache = segment_cache()
+        prefetcher.advance(download, chunk_type, chunk_number, track, cache)
+
+        content_type = "video/mp4" if chunk_type == "video" else "audio/mp4"
+        byte_range = request.META.get("HTTP_RANGE")
+        local = open_local_chunk(download, segment_url, chunk_number, chunk_type, cache)
+
+        if local is not None:
+            # Sent straight from disk (or by the fronting server), with
+            # Range and conditional requests answered locally
+            metrics.CHUNK_REQUESTS.labels("local").inc()
+            response = serve_file(request, local, content_type)
+            response["Cache-Control"] = "private, max-age=86400, immutable"
+        elif byte_range:
+            metrics.CHUNK_REQUESTS.labels("range").inc()
+            # Resume a partially received chunk with a ranged upstream request
+            upstream_response = self.get_chunk_range(segment_url, byte_range)
+            if upstream_response is None:
+                return Response(
+                    {"error": "Chunk not found"}, status=status.HTTP_404_NOT_FOUND
+                )
+            body = iter_response(upstream_response)
+            if upstream_response.status_code == 200:
+                # Range ignored upstream: this is the whole chunk
+                body = mark_when_served(body, download, chunk_type, chunk_number)
+            else:
+                resumed = range_to_end(upstream_response.headers)
+                if resumed is not None:
+                    body = mark_when_served(
+                        body, download, chunk_type, chunk_number, *resumed
+                    )
+            response = StreamingHttpResponse(
+                body, content_type=content_type, status=upstream_response.status_code
+            )
+            if "Content-Range" in upstream_response.headers:
+                response["Content-Range"] = upstream_response.headers["Content-Range"]
+        else:
+            # Get chunk data
+            stream = self.get_chunk_data(segment_url, cache)
+
+            if stream is None:
+                return Response(
+                    {"error": "Chunk not found"}, status=status.HTTP_404_NOT_FOUND
+                )
+
+            response = StreamingHttpResponse(
+                mark_when_served(
+                    stream.iter_chunks(),
+                    download,
+                    chunk_type,
+                    chunk_number,
+                    stream.length,
+                ),
+                content_type=content_type,
+                status=200,
+            )
+            if stream.length is not None:
+                response["Content-Length"] = str(stream.length)
         response["Content-Disposition"] = (
             f'attachment; filename="chunk_{chunk_number}.mp4"'
         )
         response["X-Chunk-Number"] = str(chunk_number)
         response["X-Total-Chunks"] = str(download.total_chunks)
-
-        # Update progress
-        download.downloaded_chunks = chunk_number + 1
-        download.progress = download.downloaded_chunks / download.total_chunks
-        download.save()
-
         return response
 
-    def get_chunk_data(self, download, chunk_number, chunk_type):
+    def get_chunk_data(self, segment_url, cache):
         """
         Fetch chunk data from Vimeo
         """
-        video = download.video
-        playlist = video.playlist_json
-
-        if chunk_type == "video":
-            # Find video data for selected resolution
-            selected_res = int(download.resolution.replace("p", ""))
-            video_data = None
-            for v in playlist.get("video", []):
-                if v.get("height") == selected_res:
-                    video_data = v
-                    break
-
-            if not video_data:
-                return None
+        with metrics.CHUNK_OPEN_SECONDS.time():
+            prefetched = prefetcher.take(segment_url)
+            if prefetched is not None:
+                metrics.CHUNK_REQUESTS.labels("prefetch").inc()
+                return PrefetchedSegment(prefetched)
 
-            segments = video_data.get("segments", [])
-            if chunk_number >= len(segments):
-                return None
-
-            segment = segments[chunk_number]
-            segment_url = urljoin(
-                video.base_url + video_data.get("base_url", ""), segment["url"]
-            )
+            # Download chunk, sharing the fetch with concurrent requests for it
+            metrics.CHUNK_REQUESTS.labels("upstream").inc()
+            return coalescer.open(segment_url, cache)
 
-        else:  # audio
-            # Get best audio quality
-            if not playlist.get("audio"):
-                return None
-
-            audio_data = max(
-                playlist.get("audio", []), key=lambda x: x.get("bitrate", 0)
+    def get_chunk_range(self, segment_url, byte_range):
+        """
+        Fetch part of a chunk from Vimeo for a client resuming a download
+        """
+        try:
+            response = upstream.get(
+                segment_url, stream=True, headers={"Range": byte_range}
             )
-            segments = audio_data.get("segments", [])
+            if response.status_code in (200, 206):
+                return response
+        except Exception as e:
+            logger.warning("Error downloading chunk range: %s", e)
 
-            if chunk_number >= len(segments):
-                return None
+        return None
 
-            segment = segments[chunk_number]
-            segment_url = urljoin(
-                video.base_url + audio_data.get("base_url", ""), segment["url"]
-            )
 
-        # Download chunk
+def open_local_chunk(download, segment_url, chunk_number, chunk_type, cache):
+    """
+    Open a chunk already on local disk, or return None
+    """
+    # Segments already fetched by the server-side download job
+    workspace = DownloadWorkspace(download.id)
+    if workspace.has_segment(chunk_type, chunk_number):
         try:
-            response = requests.get(segment_url, stream=True, timeout=30)
-            if response.status_code == 200:
-                # Return generator for streaming
-                def generate():
-                    for chunk in response.iter_content(chunk_size=8192):
-                        yield chunk
-
-                return generate()
-        except Exception as e:
-            print(f"Error downloading chunk: {e}")
-
+            return open(workspace.segment_path(chunk_type, chunk_number), "rb")
+        except FileNotFoundError:
+            pass
+
+    if cache is not None:
+        return cache.open(segment_url)
+    return None
+
+
+def range_to_end(headers):
+    """
+    (length, segment size) of a 206 response running to the end of the
+    segment, which completes a client's resumed chunk, or None
+    """
+    byte_range = content_range(headers.get("Content-Range"))
+    if byte_range is None:
+        return None
+    start, end, size = byte_range
+    if size is None or end != size - 1:
         return None
+    return end - start + 1, size
+
+
+def mark_when_served(chunks, download, kind, index, length=None, size=None):
+    """
+    Pass a chunk's body through, recording the segment as received once
+    all of it has been sent
+
+    `length` is the body's expected length and `size` the segment's, when
+    the body is the rest of a chunk a client is resuming. Progress is
+    coalesced across chunk requests by the shared reporter. Nothing is
+    recorded for a body cut short by the client or upstream. Chunks served
+    from local disk are not recorded here: the download job records each
+    segment it writes.
+    """
+    sent = 0
+    for chunk in chunks:
+        sent += len(chunk)
+        yield chunk
+    if length is not None and sent != length:
+        return
+    reporter = reporters.get(download)
+    reporter.mark_segment(kind, index, sent if size is None else size)
+    if kind == "video":
+        reporter.set_chunks(reporter.bitmaps["video"].count())
+
+
+def download_progress_data(download, index):
+    """
+    Serialized progress for a download, with the segments still missing
+    """
+    data = dict(VideoDownloadSerializer(download).data)
+
+    # Segments a resuming client still has to fetch
+    video_track = index.video(download.resolution) if index else None
+    audio_track = index.audio if index else None
+    data["missing_chunks"] = {
+        "video": SegmentBitmap(download.video_segments).missing(
+            len(video_track) if video_track else 0
+        ),
+        "audio": SegmentBitmap(download.audio_segments).missing(
+            len(audio_track) if audio_track else 0
+        ),
+    }
+    return data
 
 
 class DownloadProgressView(APIView):
     permission_classes = [IsAuthenticated]
 
+    # Long-polls blocked in this process, each holding a worker thread
+    long_polls = 0
+    long_polls_lock = threading.Lock()
+
     def get(self, request, download_id):
         """
         Get download progress
         GET /api/download-progress/{download_id}/
+
+        Sending the previous response's ETag as If-None-Match long-polls:
+        the request waits up to PROGRESS_LONG_POLL_TIMEOUT seconds for the
+        progress to change and returns 304 if it does not. At most
+        PROGRESS_SYNC_LONG_POLLS requests per process wait; others get an
+        immediate 304 with Retry-After. A poll the progress hub can answer
+        is answered without reading the download.
+        """
+        client_etag = parse_etag(request.META.get("HTTP_IF_NONE_MATCH"))
+        entry = hub.current(download_id, request.user.pk)
+        download = None
+        if entry is None:
+            download = self.get_download(request, download_id)
+            if download is None:
+                return Response(
+                    {"error": "Download not found or access denied"},
+                    status=status.HTTP_404_NOT_FOUND,
+                )
+            entry = hub.seed(
+                download.pk, progress_snapshot(download), owner=download.user_id
+            )
+
+        if client_etag is not None and client_etag == entry.etag:
+            entry, waited = self.wait_for_change(download_id, client_etag)
+            if entry is not None and entry.etag == client_etag:
+                response = Response(status=status.HTTP_304_NOT_MODIFIED)
+                response["ETag"] = f'W/"{entry.etag}"'
+                if not waited:
+                    response["Retry-After"] = str(
+                        max(1, round(settings.PROGRESS_POLL_INTERVAL_MS / 1000))
+                    )
+                return response
+            download = None
+
+        if download is None:
+            download = self.get_download(request, download_id)
+            if download is None:
+                return Response(
+                    {"error": "Download not found or access denied"},
+                    status=status.HTTP_404_NOT_FOUND,
+                )
+            entry = hub.seed(download.pk, progress_snapshot(download))
+
+        data = download_progress_data(download, get_playlist_index(download.video))
+        data.update(entry.snapshot)
+        response = Response(data)
+        response["ETag"] = f'W/"{entry.etag}"'
+        return response
+
+    def wait_for_change(self, pk, etag):
         """
+        The hub entry once it changes, or as it is if no long-poll slot is
+        free, and whether the request waited
+        """
+        cls = DownloadProgressView
+        with cls.long_polls_lock:
+            waited = cls.long_polls < settings.PROGRESS_SYNC_LONG_POLLS
+            if waited:
+                cls.long_polls += 1
+        if not waited:
+            return hub.wait(pk, etag, 0), False
         try:
-            download = VideoDownload.objects.get(id=download_id, user=request.user)
-        except VideoDownload.DoesNotExist:
-            return Response(
-                {"error": "Download not found or access denied"},
-                status=status.HTTP_404_NOT_FOUND,
+            return hub.wait(pk, etag, settings.PROGRESS_LONG_POLL_TIMEOUT), True
+        finally:
+            with cls.long_polls_lock:
+                cls.long_polls -= 1
+
+    def get_download(self, request, download_id):
+        try:
+            return (
+                VideoDownload.objects.select_related("video")
+                .defer(*DEFERRED_VIDEO_FIELDS)
+                .get(id=download_id, user=request.user)
             )
+        except VideoDownload.DoesNotExist:
+            return None
+
 
-        serializer = VideoDownloadSerializer(download)
-        return Response(serializer.data)
+class DownloadEventsView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, download_id):
+        """
+        Server-sent progress events need the async views (ASYNC_VIEWS=True
+        under ASGI), where a connected client holds no thread
+        GET /api/download-progress/{download_id}/events/
+        """
+        return Response(
+            {"error": "Progress events need ASYNC_VIEWS under an ASGI server"},
+            status=status.HTTP_501_NOT_IMPLEMENTED,
+        )
 
 
 class MergeVideoAudioView(APIView):
@@ -492,124 +801,200 @@ class MergeVideoAudioView(APIView):
                 status=status.HTTP_404_NOT_FOUND,
             )
 
-        if download.status != "completed":
+        # A failed merge can be retried; it resumes from the segments on disk
+        if download.status not in ["completed", "error"]:
             return Response(
                 {"error": "Download not completed"}, status=status.HTTP_400_BAD_REQUEST
             )
 
         # Update status to processing
         download.status = "processing"
-        download.save()
+        download.save(update_fields=["status"])
 
         # Start merging process in background
-        self.merge_video_audio_background(download_id)
+        self.merge_video_audio_background(download_id, request.user.pk)
 
         return Response(
             {"message": "Video and audio merging started"},
             status=status.HTTP_202_ACCEPTED,
         )
 
-    def merge_video_audio_background(self, download_id):
+    def merge_video_audio_background(self, download_id, user_id=None):
         """
-        Start background task to merge video and audio
+        Queue background task to merge video and audio
         """
-        import threading
-
-        thread = threading.Thread(
-            target=self.merge_video_audio_task, args=(download_id,)
+        enqueue(
+            "merge_video",
+            priority=JOB_PRIORITY_LOW,
+            owner=user_id,
+            download_id=str(download_id),
         )
-        thread.daemon = True
-        thread.start()
 
     def merge_video_audio_task(self, download_id):
         """
-        Task to merge video and audio using moviepy
+        Task to merge video and audio tracks
         """
+        started = time.perf_counter()
+        reporter = None
+        pipeline = None
+        outcome = "error"
         try:
-            download = VideoDownload.objects.get(id=download_id)
-
-            # Create temporary directory
-            import tempfile
+            download = (
+                VideoDownload.objects.select_related("video")
+                .defer(*DEFERRED_VIDEO_FIELDS)
+                .get(id=download_id)
+            )
 
-            temp_dir = tempfile.mkdtemp()
+            index = get_playlist_index(download.video)
+            if index is None:
+                raise Exception("No playlist stored for this video")
+            video_track = index.video(download.resolution)
+            audio_track = index.audio
+            if not video_track or not audio_track:
+                raise Exception("No video or audio data found")
+
+            # Work in the download's workspace so that a retry after a crash
+            # only fetches the segments that are still missing
+            workspace = DownloadWorkspace(download.id)
+            reporter = ProgressReporter(download)
+            output_path = workspace.path("output.mp4")
+
+            # Fetch both tracks and mux them concurrently
+            with scheduler.flow(download.user_id, download.id) as flow:
+                pipeline = merge_pipeline(
+                    workspace, video_track, audio_track, output_path, reporter, flow
+                )
+                pipeline.run()
 
-            # Download video and audio files
-            video_path = os.path.join(temp_dir, "video.mp4")
-            audio_path = os.path.join(temp_dir, "audio.mp4")
-            output_path = os.path.join(temp_dir, "output.mp4")
+            # Clean up work files
+            for name in ("video.mp4", "audio.mp4"):
+                if os.path.exists(workspace.path(name)):
+                    os.remove(workspace.path(name))
+            workspace.clear_segments()
 
-            # Download all video chunks
-            self.download_all_chunks(download, "video", video_path)
+            # Update download status
+            reporter.transition(
+                "completed",
+                output_path=output_path,
+                stage_timings=pipeline.timings(),
+            )
 
-            # Download all audio chunks
-            self.download_all_chunks(download, "audio", audio_path)
+            # Return the merged file path (in production, you'd upload this to storage)
+            logger.info("Merged video saved to: %s", output_path)
+            outcome = "ok"
 
-            # Merge using moviepy
-            from moviepy.editor import VideoFileClip, AudioFileClip
+        except Exception:
+            if reporter is not None:
+                fields = {"stage_timings": pipeline.timings()} if pipeline else {}
+                reporter.transition("error", **fields)
+            else:
+                VideoDownload.objects.filter(id=download_id).update(status="error")
+            logger.exception("Error merging video and audio for %s", download_id)
+            raise
 
-            video_clip = VideoFileClip(video_path)
-            audio_clip = AudioFileClip(audio_path)
-            video_clip_with_audio = video_clip.set_audio(audio_clip)
+        finally:
+            metrics.TASK_SECONDS.labels("merge_video", outcome).observe(
+                time.perf_counter() - started
+            )
+            if pipeline is not None:
+                for stage, timings in pipeline.timings().items():
+                    if "seconds" in timings:
+                        metrics.MERGE_STAGE_SECONDS.labels(stage).observe(
+                            timings["seconds"]
+                        )
+                    if "waiting" in timings:
+                        metrics.MERGE_STAGE_WAITING_SECONDS.labels(stage).observe(
+                            timings["waiting"]
+                        )
+
+
+class StreamMergedVideoView(APIView):
+    permission_classes = [IsAuthenticated]
 
-            # Write merged video
-            video_clip_with_audio.write_videofile(
-                output_path, codec="libx264", audio_codec="aac"
+    def get(self, request, download_id):
+        """
+        Stream the merged video as a fragmented MP4 while segments arrive,
+        or the merged file once the download has completed
+        GET /api/stream-video/{download_id}/
+        """
+        try:
+            download = (
+                VideoDownload.objects.select_related("video")
+                .defer(*DEFERRED_VIDEO_FIELDS)
+                .get(id=download_id, user=request.user)
+            )
+        except VideoDownload.DoesNotExist:
+            return Response(
+                {"error": "Download not found or access denied"},
+                status=status.HTTP_404_NOT_FOUND,
             )
 
-            # Clean up temp files
-            os.remove(video_path)
-            os.remove(audio_path)
+        if download.status == "error":
+            return Response(
+                {"error": "Download failed"}, status=status.HTTP_400_BAD_REQUEST
+            )
 
-            # Update download status
-            download.status = "completed"
-            download.save()
+        # A finished merge is served from disk, with Range and ETag support
+        if download.status == "completed" and download.output_path:
+            try:
+                output = open(download.output_path, "rb")
+            except FileNotFoundError:
+                pass
+            else:
+                return serve_file(
+                    request,
+                    output,
+                    "video/mp4",
+                    filename=f"video_{download.resolution}.mp4",
+                )
 
-            # Return the merged file path (in production, you'd upload this to storage)
-            print(f"Merged video saved to: {output_path}")
+        index = get_playlist_index(download.video)
+        video_track = index.video(download.resolution) if index else None
+        audio_track = index.audio if index else None
 
-        except Exception as e:
-            download = VideoDownload.objects.get(id=download_id)
-            download.status = "error"
-            download.save()
-            print(f"Error merging video and audio: {e}")
+        if not video_track or not audio_track:
+            return Response(
+                {"error": "Video or audio track not found"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
 
-    def download_all_chunks(self, download, chunk_type, output_path):
-        """
-        Download all chunks of a specific type
-        """
-        video = download.video
-        playlist = video.playlist_json
-
-        if chunk_type == "video":
-            selected_res = int(download.resolution.replace("p", ""))
-            media_data = None
-            for v in playlist.get("video", []):
-                if v.get("height") == selected_res:
-                    media_data = v
-                    break
-        else:
-            media_data = max(
-                playlist.get("audio", []), key=lambda x: x.get("bitrate", 0)
+        try:
+            muxer = FragmentedMuxer(video_track.init_segment, audio_track.init_segment)
+        except (ValueError, Fmp4Error) as e:
+            return Response(
+                {"error": f"Unsupported init segment: {e}"},
+                status=status.HTTP_502_BAD_GATEWAY,
             )
 
-        if not media_data:
-            raise Exception(f"No {chunk_type} data found")
+        response = StreamingHttpResponse(
+            merged_fragments(muxer, video_track, audio_track),
+            content_type="video/mp4",
+        )
+        response["Content-Disposition"] = (
+            f'attachment; filename="video_{download.resolution}.mp4"'
+        )
+        return response
 
-        # Download init segment
-        init_segment = base64.b64decode(media_data["init_segment"])
 
-        with open(output_path, "wb") as file:
-            file.write(init_segment)
+def merged_fragments(muxer, video_track, audio_track):
+    """
+    Interleave both tracks' fragments by start time as they download
+    """
+    fetcher = SegmentFetcher()
+    tracks = {
+        "video": (fetcher.iter_ordered(video_track.urls), muxer.video_fragment),
+        "audio": (fetcher.iter_ordered(audio_track.urls), muxer.audio_fragment),
+    }
 
-            # Download all segments
-            for segment in media_data.get("segments", []):
-                segment_url = urljoin(
-                    video.base_url + media_data.get("base_url", ""), segment["url"]
-                )
-                response = requests.get(segment_url, stream=True)
-                if response.status_code == 200:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        file.write(chunk)
+    try:
+        yield muxer.init_segment()
+        for track, _ in interleave_order(video_track.starts, audio_track.starts):
+            segments, rewrite = tracks[track]
+            yield rewrite(next(segments))
+    finally:
+        # Stop in-flight fetches when the client goes away
+        for segments, _ in tracks.values():
+            segments.close()
 
 
 class UserVideosView(APIView):
@@ -617,12 +1002,17 @@ class UserVideosView(APIView):
 
     def get(self, request):
         """
-        Get all videos for the current user
-        GET /api/user-videos/
+        Get the current user's videos, newest first, a page at a time
+        GET /api/user-videos/?cursor=...&page_size=50&fields=id,title,status
         """
-        videos = VimeoVideo.objects.filter(user=request.user)
-        serializer = VimeoVideoSerializer(videos, many=True)
-        return Response(serializer.data)
+        fields = requested_fields(request, VimeoVideoListSerializer)
+        videos = VimeoVideo.objects.filter(user=request.user).only(
+            "id", "created_at", *fields
+        )
+        paginator = CreatedCursorPagination()
+        page = paginator.paginate_queryset(videos, request, view=self)
+        serializer = VimeoVideoListSerializer(page, many=True, fields=fields)
+        return paginator.get_paginated_response(serializer.data)
 
 
 class UserDownloadsView(APIView):
@@ -630,9 +1020,32 @@ class UserDownloadsView(APIView):
 
     def get(self, request):
         """
-        Get all downloads for the current user
-        GET /api/user-downloads/
+        Get the current user's downloads, newest first, a page at a time
+        GET /api/user-downloads/?cursor=...&page_size=50&fields=id,status,progress
         """
-        downloads = VideoDownload.objects.filter(user=request.user)
-        serializer = VideoDownloadSerializer(downloads, many=True)
-        return Response(serializer.data)
+        fields = requested_fields(request, VideoDownloadListSerializer)
+        downloads = VideoDownload.objects.filter(user=request.user).only(
+            "id", "created_at", *model_fields(VideoDownloadListSerializer, fields)
+        )
+        paginator = CreatedCursorPagination()
+        page = paginator.paginate_queryset(downloads, request, view=self)
+        serializer = VideoDownloadListSerializer(page, many=True, fields=fields)
+        return paginator.get_paginated_response(serializer.data)
+
+
+# Background job handlers, run by `manage.py run_workers`
+
+
+@job("process_video")
+def process_video_job(video_id):
+    SubmitVideoUrlView().process_vimeo_url_task(video_id)
+
+
+@job("download_video")
+def download_video_job(download_id):
+    StartDownloadView().download_video_task(download_id)
+
+
+@job("merge_video")
+def merge_video_job(download_id):
+    MergeVideoAudioView().merge_video_audio_task(download_id)
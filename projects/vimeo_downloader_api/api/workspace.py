@@ -0,0 +1,60 @@
+import os
+import shutil
+
+from django.conf import settings
+
+
+class DownloadWorkspace:
+    """
+    Per-download directory holding the segments received so far
+
+    Each segment is its own file, so a job that dies halfway leaves every
+    finished segment (and at most a few .part files) behind for the next
+    attempt to pick up.
+    """
+
+    def __init__(self, download_id):
+        self.root = os.path.join(settings.DOWNLOAD_WORK_DIR, str(download_id))
+
+    def path(self, name):
+        os.makedirs(self.root, exist_ok=True)
+        return os.path.join(self.root, name)
+
+    def segment_path(self, kind, index):
+        return os.path.join(self.root, kind, f"{index:06d}.m4s")
+
+    def has_segment(self, kind, index):
+        return os.path.exists(self.segment_path(kind, index))
+
+    def fetch(self, kind, track, fetcher, on_complete=None):
+        """
+        Fetch the segments of a track that are not on disk yet
+        """
+        os.makedirs(os.path.join(self.root, kind), exist_ok=True)
+        jobs = []
+        for index, url in enumerate(track.urls):
+            if self.has_segment(kind, index):
+                if on_complete is not None:
+                    on_complete(index)
+            else:
+                jobs.append((index, url, self.segment_path(kind, index)))
+        fetcher.fetch_to_files(jobs, on_complete)
+
+    def iter_fetch(self, kind, track, fetcher):
+        """
+        Yield the segment indexes of a track in playlist order as each
+        segment is on disk, fetching the ones that are missing
+        """
+        os.makedirs(os.path.join(self.root, kind), exist_ok=True)
+        jobs = (
+            (index, url, self.segment_path(kind, index))
+            for index, url in enumerate(track.urls)
+        )
+        yield from fetcher.iter_to_files(jobs)
+
+    def clear_segments(self):
+        for kind in ("video", "audio"):
+            shutil.rmtree(os.path.join(self.root, kind), ignore_errors=True)
+
+    def remove(self):
+        shutil.rmtree(self.root, ignore_errors=True)
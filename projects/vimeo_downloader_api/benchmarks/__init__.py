@@ -0,0 +1,32 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+PROJECT_DIR = Path(__file__).resolve().parent.parent
+
+
+def setup_django(database=False):
+    """
+    Configure Django for a benchmark run from the project directory
+
+    With database=True the run gets a fresh throwaway SQLite database.
+    """
+    if str(PROJECT_DIR) not in sys.path:
+        sys.path.insert(0, str(PROJECT_DIR))
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "vimeo_downloader_api.settings")
+    os.environ.setdefault("SECRET_KEY", "benchmark-only-secret-key-do-not-deploy")
+
+    import django
+    from django.conf import settings
+
+    if database:
+        directory = tempfile.mkdtemp(prefix="vimeo-bench-")
+        settings.DATABASES["default"]["NAME"] = os.path.join(directory, "db.sqlite3")
+
+    django.setup()
+
+    if database:
+        from django.core.management import call_command
+
+        call_command("migrate", run_syncdb=True, verbosity=0)
@@ -0,0 +1,82 @@
+"""
+Compare JWT authentication with and without the user cache
+
+Authenticates a stream of requests from a number of users, as chunk
+streaming clients send them, and reports requests per second and
+database queries per request. For the effect on whole scenarios, run
+bench_scenarios with AUTH_USER_CACHE_SIZE=0 and compare the results.
+
+Run from the project directory:
+    python -m benchmarks.bench_auth --users 50 --requests 20000
+"""
+
+import argparse
+import random
+import time
+
+from benchmarks import setup_django
+
+
+class QueryCounter:
+    def __init__(self):
+        self.queries = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+
+def run(authentication, tokens, requests):
+    from django.db import connection
+    from django.test import RequestFactory
+
+    factory = RequestFactory()
+    picks = random.Random(0).choices(tokens, k=requests)
+    built = [
+        factory.get("/api/stream-chunk/", HTTP_AUTHORIZATION=f"Bearer {token}")
+        for token in picks
+    ]
+    counter = QueryCounter()
+    with connection.execute_wrapper(counter):
+        start = time.perf_counter()
+        for request in built:
+            authentication.authenticate(request)
+        elapsed = time.perf_counter() - start
+    return elapsed, counter.queries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=20000)
+    args = parser.parse_args()
+
+    setup_django(database=True)
+
+    from django.contrib.auth.models import User
+    from rest_framework_simplejwt.authentication import JWTAuthentication
+    from rest_framework_simplejwt.tokens import AccessToken
+
+    from api.authentication import CachedJWTAuthentication, user_cache
+
+    tokens = [
+        str(AccessToken.for_user(User.objects.create(username=f"bench-{n}")))
+        for n in range(args.users)
+    ]
+
+    print(f"{'backend':>10} {'req/s':>10} {'us/req':>8} {'queries/req':>12}")
+    for name, authentication in (
+        ("uncached", JWTAuthentication()),
+        ("cached", CachedJWTAuthentication()),
+    ):
+        user_cache.clear()
+        elapsed, queries = run(authentication, tokens, args.requests)
+        print(
+            f"{name:>10} {args.requests / elapsed:>10.0f} "
+            f"{elapsed / args.requests * 1e6:>8.1f} "
+            f"{queries / args.requests:>12.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+"""
+Load-test chunk streaming under WSGI (sync views) and ASGI (async views)
+
+Each client streams a run of chunks through the stream-chunk view from a
+fake CDN, so every request is proxied upstream. Needs gunicorn and
+uvicorn installed.
+
+Run from the project directory:
+    python -m benchmarks.bench_concurrent_streams --clients 50 200 1000
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import aiohttp
+
+from benchmarks import PROJECT_DIR, setup_django
+from benchmarks.fake_cdn import FakeCDN
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def server_command(mode, port, threads):
+    if mode == "wsgi":
+        return [
+            sys.executable, "-m", "gunicorn", "vimeo_downloader_api.wsgi",
+            "--bind", f"127.0.0.1:{port}", "--workers", "1",
+            "--worker-class", "gthread", "--threads", str(threads),
+            "--backlog", "4096", "--log-level", "warning",
+        ]  # fmt: skip
+    return [
+        sys.executable, "-m", "uvicorn", "vimeo_downloader_api.asgi:application",
+        "--host", "127.0.0.1", "--port", str(port), "--workers", "1",
+        "--backlog", "4096", "--log-level", "warning", "--no-access-log",
+    ]  # fmt: skip
+
+
+class ProcessSampler:
+    """
+    Track peak thread count and RSS, and CPU time, of a process tree
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.threads = 0
+        self.rss_kb = 0
+        # Last CPU time seen per process, so exited children still count
+        self.cpu = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def pids(self):
+        pids = [self.pid]
+        try:
+            with open(f"/proc/{self.pid}/task/{self.pid}/children") as f:
+                pids += [int(pid) for pid in f.read().split()]
+        except OSError:
+            pass
+        return pids
+
+    def sample(self):
+        threads = rss_kb = 0
+        for pid in self.pids():
+            try:
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith("Threads:"):
+                            threads += int(line.split()[1])
+                        elif line.startswith("VmRSS:"):
+                            rss_kb += int(line.split()[1])
+                with open(f"/proc/{pid}/stat") as f:
+                    # Fields after the parenthesised command name
+                    fields = f.read().rsplit(")", 1)[1].split()
+                self.cpu[pid] = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+            except OSError:
+                continue
+        self.threads = max(self.threads, threads)
+        self.rss_kb = max(self.rss_kb, rss_kb)
+
+    @property
+    def cpu_seconds(self):
+        return sum(self.cpu.values())
+
+    def _run(self):
+        while not self._stop.wait(0.1):
+            self.sample()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+
+def wait_until_up(base_url, process, timeout=30):
+    import requests
+    from django.urls import reverse
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("server exited during start-up")
+        try:
+            requests.get(base_url + reverse("health"), timeout=1)
+            return
+        except (requests.ConnectionError, requests.Timeout):
+            time.sleep(0.2)
+    raise RuntimeError("server did not start")
+
+
+async def run_clients(base_url, downloads, token, clients, chunks):
+    """
+    Start all clients at once; each streams `chunks` chunks in turn
+    """
+    from django.urls import reverse
+
+    latencies = []
+    errors = 0
+    received = 0
+    headers = {"Authorization": f"Bearer {token}"}
+    connector = aiohttp.TCPConnector(limit=0)
+    timeout = aiohttp.ClientTimeout(total=300)
+
+    async with aiohttp.ClientSession(
+        connector=connector, timeout=timeout, headers=headers
+    ) as session:
+
+        async def client(n):
+            nonlocal errors, received
+            path = reverse("stream-chunk", args=[downloads[n % len(downloads)]])
+            for i in range(chunks):
+                url = f"{base_url}{path}?chunk={(n + i) % 100}"
+                start = time.perf_counter()
+                try:
+                    async with session.get(url) as response:
+                        body = await response.read()
+                        if response.status != 200:
+                            errors += 1
+                            continue
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    errors += 1
+                    continue
+                latencies.append(time.perf_counter() - start)
+                received += len(body)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client(n) for n in range(clients)))
+        wall = time.perf_counter() - start
+
+    return latencies, errors, received, wall
+
+
+def run_mode(mode, clients, args, database, downloads, token):
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    env = {
+        **os.environ,
+        "DJANGO_SETTINGS_MODULE": "benchmarks.settings",
+        "BENCHMARK_DATABASE": database,
+        "ASYNC_VIEWS": "True" if mode == "asgi" else "False",
+        "SEGMENT_CACHE_MAX_BYTES": "0",
+        "ALLOWED_HOSTS": "127.0.0.1",
+    }
+    process = subprocess.Popen(
+        server_command(mode, port, args.threads), cwd=PROJECT_DIR, env=env
+    )
+    try:
+        wait_until_up(base_url, process)
+        with ProcessSampler(process.pid) as sampler:
+            latencies, errors, received, wall = asyncio.run(
+                run_clients(base_url, downloads, token, clients, args.chunks)
+            )
+    finally:
+        process.terminate()
+        process.wait()
+
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1] if latencies else 0
+    print(
+        f"{mode:>5} {clients:>8} {len(latencies) / wall:>9.1f} "
+        f"{received / wall / 1024**2:>8.1f} "
+        f"{statistics.median(latencies) * 1000 if latencies else 0:>8.0f} "
+        f"{p99 * 1000:>8.0f} {errors:>7} {sampler.threads:>8} "
+        f"{sampler.rss_kb / 1024:>7.0f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, nargs="+", default=[50, 200, 1000])
+    parser.add_argument("--chunks", type=int, default=5)
+    parser.add_argument("--segment-size", type=int, default=256 * 1024)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--modes", nargs="+", default=["wsgi", "asgi"])
+    args = parser.parse_args()
+
+    setup_django(database=True)
+
+    from django.conf import settings
+    from django.contrib.auth.models import User
+    from rest_framework_simplejwt.tokens import AccessToken
+
+    from api.models import VimeoVideo, VideoDownload
+    from api.playlist import PlaylistIndex
+
+    with FakeCDN(segment_size=args.segment_size, latency=args.latency) as cdn:
+        segments = [{"url": f"segment-{i}.m4s"} for i in range(100)]
+        playlist = {
+            "video": [{"height": 720, "base_url": "segments/", "segments": segments}],
+            "audio": [],
+        }
+        user = User.objects.create(username="bench")
+        video = VimeoVideo.objects.create(
+            user=user,
+            original_url="https://vimeo.com/1",
+            status="ready",
+            playlist_json=playlist,
+            playlist_index=PlaylistIndex.build(playlist, cdn.base_url).to_dict(),
+        )
+        downloads = [
+            str(
+                VideoDownload.objects.create(
+                    video=video,
+                    user=user,
+                    resolution="720p",
+                    status="downloading",
+                    total_chunks=len(segments),
+                ).pk
+            )
+            for _ in range(10)
+        ]
+        token = str(AccessToken.for_user(user))
+        database = str(settings.DATABASES["default"]["NAME"])
+
+        print(
+            f"{'mode':>5} {'clients':>8} {'req/s':>9} {'MiB/s':>8} {'p50 ms':>8} "
+            f"{'p99 ms':>8} {'errors':>7} {'threads':>8} {'RSS MiB':>7}"
+        )
+        for clients in args.clients:
+            for mode in args.modes:
+                run_mode(mode, clients, args, database, downloads, token)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Compare JSON backends on manifests and API responses
+
+For each installed library, times decoding a large playlist.json in full
+and with the playlist fast path, building its index, and rendering and
+parsing a page of the downloads list through the DRF renderer and parser.
+
+Run from the project directory:
+    python -m benchmarks.bench_json --segments 600 --page 50
+"""
+
+import argparse
+import io
+import time
+
+from benchmarks import setup_django
+from benchmarks.bench_manifest_storage import fake_playlist
+
+
+def best_of(func, repeat):
+    """
+    Fastest of `repeat` runs of func(), in microseconds
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--segments", type=int, default=600)
+    parser.add_argument("--page", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    setup_django(database=True)
+
+    from django.conf import settings
+    from django.contrib.auth.models import User
+    from rest_framework.parsers import JSONParser
+    from rest_framework.renderers import JSONRenderer
+
+    from api import fastjson
+    from api.models import VideoDownload, VimeoVideo
+    from api.parsers import FastJSONParser
+    from api.playlist import PlaylistIndex
+    from api.renderers import FastJSONRenderer
+    from api.serializers import VideoDownloadSerializer
+
+    raw_manifest = fastjson.dumps(fake_playlist(args.segments))
+
+    user = User.objects.create(username="bench")
+    video = VimeoVideo.objects.create(
+        user=user, original_url="https://vimeo.com/1", status="ready"
+    )
+    VideoDownload.objects.bulk_create(
+        VideoDownload(video=video, user=user, resolution="720p", status="completed")
+        for _ in range(args.page)
+    )
+    page = VideoDownloadSerializer(VideoDownload.objects.all(), many=True).data
+    rendered = JSONRenderer().render(page)
+
+    backends = ["stdlib"]
+    if fastjson.orjson is not None:
+        backends.append("orjson")
+    if fastjson.msgspec is not None:
+        backends.append("msgspec")
+
+    print(
+        f"manifest {len(raw_manifest) // 1024} KiB, "
+        f"page of {args.page} downloads {len(rendered) // 1024} KiB"
+    )
+    print(
+        f"{'backend':>8} {'decode us':>10} {'playlist us':>12} {'index us':>10} "
+        f"{'render us':>10} {'parse us':>9}"
+    )
+    for backend in backends:
+        settings.JSON_BACKEND = backend
+        if backend == "stdlib":
+            renderer, json_parser = JSONRenderer(), JSONParser()
+        else:
+            renderer, json_parser = FastJSONRenderer(), FastJSONParser()
+        assert renderer.render(page) == rendered
+
+        decode = best_of(lambda: fastjson.loads(raw_manifest), args.repeat)
+        playlist = best_of(lambda: fastjson.loads_playlist(raw_manifest), args.repeat)
+        index = best_of(
+            lambda: PlaylistIndex.build(
+                fastjson.loads_playlist(raw_manifest), "https://cdn.example/"
+            ),
+            args.repeat,
+        )
+        render = best_of(lambda: renderer.render(page), args.repeat)
+        parse = best_of(
+            lambda: json_parser.parse(io.BytesIO(rendered), "application/json"),
+            args.repeat,
+        )
+        print(
+            f"{backend:>8} {decode:>10.0f} {playlist:>12.0f} {index:>10.0f} "
+            f"{render:>10.0f} {parse:>9.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Compare VimeoVideo row fetches and database size with manifests stored
+inline and split out into the compressed VideoManifest table
+
+Run from the project directory:
+    python -m benchmarks.bench_manifest_storage --videos 500 --segments 600
+"""
+
+import argparse
+import os
+import random
+import time
+
+from benchmarks import setup_django
+
+
+def fake_playlist(segments, tracks=5):
+    """
+    A playlist.json shaped like Vimeo's, with `segments` per track
+    """
+    rng = random.Random(0)
+    init = "".join(rng.choice("ABCDEFGHabcdefgh0123456789+/") for _ in range(1500))
+
+    def track(height):
+        return {
+            "id": f"{height}-{rng.getrandbits(32):08x}",
+            "base_url": f"{height}/chunk/",
+            "height": height,
+            "bitrate": height * 3000,
+            "init_segment": init,
+            "segments": [
+                {
+                    "start": i * 6.0,
+                    "end": (i + 1) * 6.0,
+                    "url": f"segment-{i}.m4s?r={rng.getrandbits(64):016x}",
+                    "size": rng.randint(200_000, 2_000_000),
+                }
+                for i in range(segments)
+            ],
+        }
+
+    heights = [240, 360, 540, 720, 1080][:tracks]
+    return {
+        "clip_id": "1",
+        "base_url": "../",
+        "video": [track(h) for h in heights],
+        "audio": [track(0) for _ in range(2)],
+    }
+
+
+def database_size():
+    from django.conf import settings
+    from django.db import connection
+
+    with connection.cursor() as cursor:
+        cursor.execute("VACUUM")
+    return os.path.getsize(settings.DATABASES["default"]["NAME"])
+
+
+def time_fetches(items, fetch, rounds=3):
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for item in items:
+            fetch(item)
+        best = min(best, time.perf_counter() - start)
+    return best / len(items)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--videos", type=int, default=500)
+    parser.add_argument("--segments", type=int, default=600)
+    args = parser.parse_args()
+
+    setup_django(database=True)
+
+    from django.contrib.auth.models import User
+    from django.core.management import call_command
+
+    from api.manifests import compression, load_manifest
+    from api.models import VimeoVideo
+
+    user = User.objects.create(username="bench")
+    playlist = fake_playlist(args.segments)
+    VimeoVideo.objects.bulk_create(
+        VimeoVideo(
+            user=user,
+            original_url=f"https://vimeo.com/{i}",
+            status="ready",
+            playlist_json=playlist,
+        )
+        for i in range(args.videos)
+    )
+    pks = list(VimeoVideo.objects.values_list("pk", flat=True))
+
+    def fetch_row(pk):
+        VimeoVideo.objects.get(pk=pk)
+
+    def fetch_manifest(video):
+        load_manifest(video)
+
+    inline_fetch = time_fetches(pks, fetch_row)
+    inline_size = database_size()
+
+    call_command("split_manifests", verbosity=0, stdout=open(os.devnull, "w"))
+    split_fetch = time_fetches(pks, fetch_row)
+    split_size = database_size()
+    videos = [
+        VimeoVideo(pk=pk, manifest_id=manifest_id)
+        for pk, manifest_id in VimeoVideo.objects.values_list("pk", "manifest")
+    ]
+    manifest_fetch = time_fetches(videos, fetch_manifest)
+
+    print(f"{args.videos} videos, manifest ~{len(str(playlist)) // 1024} KiB each")
+    print(f"{'layout':>22} {'row fetch':>10} {'db size':>10}")
+    print(
+        f"{'inline':>22} {inline_fetch * 1e6:>8.0f}us {inline_size / 1024**2:>8.1f}MB"
+    )
+    print(
+        f"{'split (' + compression() + ')':>22} {split_fetch * 1e6:>8.0f}us "
+        f"{split_size / 1024**2:>8.1f}MB"
+    )
+    print(f"{'lazy manifest load':>22} {manifest_fetch * 1e6:>8.0f}us")
+
+
+if __name__ == "__main__":
+    main()
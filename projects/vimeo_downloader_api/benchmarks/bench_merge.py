@@ -0,0 +1,88 @@
+"""
+Compare stream-copy remuxing with moviepy re-encoding on a generated clip
+
+Requires ffmpeg on PATH (and moviepy for the re-encode path). Run from the
+project directory:
+    python -m benchmarks.bench_merge --duration 60
+"""
+
+import argparse
+import os
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+
+from benchmarks import setup_django
+
+
+def generate_clip(directory, duration):
+    """
+    Write fragmented H.264 video and AAC audio tracks like Vimeo serves
+    """
+    video_path = os.path.join(directory, "video.mp4")
+    audio_path = os.path.join(directory, "audio.mp4")
+    fragmented = ["-movflags", "frag_keyframe+empty_moov"]
+    subprocess.run(
+        ["ffmpeg", "-y", "-loglevel", "error", "-f", "lavfi"]
+        + ["-i", f"testsrc2=size=1280x720:rate=30:duration={duration}"]
+        + ["-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p"]
+        + fragmented
+        + [video_path],
+        check=True,
+    )
+    subprocess.run(
+        ["ffmpeg", "-y", "-loglevel", "error", "-f", "lavfi"]
+        + ["-i", f"sine=frequency=440:duration={duration}"]
+        + ["-c:a", "aac"]
+        + fragmented
+        + [audio_path],
+        check=True,
+    )
+    return video_path, audio_path
+
+
+def cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def measure(mode, video_path, audio_path, directory):
+    from api.muxing import merge
+
+    output_path = os.path.join(directory, f"output-{mode}.mp4")
+    cpu_start = cpu_seconds()
+    wall_start = time.perf_counter()
+    merge(video_path, audio_path, output_path, mode=mode)
+    return (
+        time.perf_counter() - wall_start,
+        cpu_seconds() - cpu_start,
+        os.path.getsize(output_path),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--duration", type=int, default=60)
+    parser.add_argument("--skip-reencode", action="store_true")
+    args = parser.parse_args()
+
+    if not shutil.which("ffmpeg"):
+        parser.error("ffmpeg is required to generate the test clip")
+
+    setup_django()
+
+    with tempfile.TemporaryDirectory() as directory:
+        video_path, audio_path = generate_clip(directory, args.duration)
+        modes = ["copy"] if args.skip_reencode else ["copy", "reencode"]
+
+        print(f"{'mode':>9} {'wall':>9} {'cpu':>9} {'size':>12}")
+        for mode in modes:
+            wall, cpu, size = measure(mode, video_path, audio_path, directory)
+            print(f"{mode:>9} {wall:>8.2f}s {cpu:>8.2f}s {size:>12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Count database writes per download with and without coalesced progress
+
+Run from the project directory:
+    python -m benchmarks.bench_progress_writes --downloads 20 --chunks 300
+"""
+
+import argparse
+import threading
+import time
+
+from benchmarks import setup_django
+
+
+class WriteCounter:
+    """
+    Count UPDATE statements issued on a connection
+    """
+
+    def __init__(self):
+        self.writes = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        if sql.lstrip().upper().startswith("UPDATE"):
+            with self.lock:
+                self.writes += 1
+        return execute(sql, params, many, context)
+
+
+def per_chunk_save(download, chunk_delay):
+    """
+    The original loop: a full-row save after every chunk
+    """
+    download.status = "downloading"
+    download.save()
+    for i in range(download.total_chunks):
+        time.sleep(chunk_delay)
+        download.downloaded_chunks = i + 1
+        download.progress = (i + 1) / download.total_chunks
+        download.save()
+    download.status = "completed"
+    download.save()
+
+
+def coalesced(download, chunk_delay):
+    from api.progress import ProgressReporter
+
+    reporter = ProgressReporter(download)
+    reporter.transition("downloading")
+    for _ in range(download.total_chunks):
+        time.sleep(chunk_delay)
+        reporter.advance()
+    reporter.transition("completed")
+
+
+def run(strategy, downloads, chunk_delay):
+    from django.db import connection
+
+    counter = WriteCounter()
+
+    def worker(download):
+        with connection.execute_wrapper(counter):
+            strategy(download, chunk_delay)
+        connection.close()
+
+    threads = [threading.Thread(target=worker, args=(d,)) for d in downloads]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counter.writes, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--downloads", type=int, default=20)
+    parser.add_argument("--chunks", type=int, default=300)
+    parser.add_argument("--chunk-delay", type=float, default=0.005)
+    args = parser.parse_args()
+
+    setup_django(database=True)
+
+    from django.contrib.auth.models import User
+    from api.models import VimeoVideo, VideoDownload
+
+    user = User.objects.create(username="bench")
+    video = VimeoVideo.objects.create(
+        user=user, original_url="https://vimeo.com/1", status="ready"
+    )
+
+    def make_downloads():
+        return [
+            VideoDownload.objects.create(
+                video=video, user=user, resolution="720p", total_chunks=args.chunks
+            )
+            for _ in range(args.downloads)
+        ]
+
+    print(f"{'strategy':>15} {'writes':>8} {'per download':>13} {'wall':>8}")
+    for name, strategy in (
+        ("per-chunk save", per_chunk_save),
+        ("coalesced", coalesced),
+    ):
+        writes, wall = run(strategy, make_downloads(), args.chunk_delay)
+        print(f"{name:>15} {writes:>8} {writes / args.downloads:>13.1f} {wall:>7.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Measure relay throughput and CPU cost for different chunk sizes
+
+Each run moves the same payload to /dev/null, once with a fresh bytes
+object per read (read / iter_content) and once through a pooled buffer
+(readinto), both from a local file and from the fake CDN over HTTP.
+CPU time is that of the relaying thread only, so the in-process fake CDN
+does not count against it.
+Pick RELAY_CHUNK_SIZE from the sizes where MB/s levels off and CPU per
+GB stops falling.
+
+Run from the project directory:
+    python -m benchmarks.bench_relay --sizes 8 64 256 1024 4096 --megabytes 256
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import requests
+
+from benchmarks import setup_django
+from benchmarks.fake_cdn import FakeCDN, segment_bytes
+
+
+def file_read(path, size, sink):
+    with open(path, "rb", buffering=0) as file:
+        while True:
+            chunk = file.read(size)
+            if not chunk:
+                break
+            os.write(sink, chunk)
+
+
+def file_readinto(path, size, sink):
+    from api.relay import iter_readinto
+
+    with open(path, "rb", buffering=0) as file:
+        for piece in iter_readinto(file, size=size):
+            os.write(sink, piece)
+
+
+def http_iter_content(url, size, sink):
+    with requests.get(url, stream=True) as response:
+        for chunk in response.iter_content(chunk_size=size):
+            os.write(sink, chunk)
+
+
+def http_readinto(url, size, sink):
+    from api.relay import iter_readinto, raw_body
+
+    with requests.get(url, stream=True) as response:
+        for piece in iter_readinto(raw_body(response), size=size):
+            os.write(sink, piece)
+
+
+def measure(func, source, size, total_bytes, sink):
+    """
+    (MB/s, CPU seconds per GB) for one relay of `source`
+    """
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    func(source, size, sink)
+    cpu = time.thread_time() - cpu
+    wall = time.perf_counter() - wall
+    return total_bytes / wall / 1024**2, cpu / (total_bytes / 1024**3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[8, 64, 256, 1024, 4096]
+    )  # KiB
+    parser.add_argument("--megabytes", type=int, default=256)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    setup_django()
+
+    total_bytes = args.megabytes * 1024**2
+    payload = segment_bytes(0, total_bytes)
+    with tempfile.NamedTemporaryFile() as source:
+        source.write(payload)
+        source.flush()
+
+        sink = os.open(os.devnull, os.O_WRONLY)
+        with FakeCDN(segment_size=total_bytes, latency=0) as cdn:
+            url = cdn.segment_urls(1)[0]
+            runs = [
+                ("file", "read", file_read, source.name),
+                ("file", "readinto", file_readinto, source.name),
+                ("http", "iter_content", http_iter_content, url),
+                ("http", "readinto", http_readinto, url),
+            ]
+
+            print(
+                f"{'source':>6} {'method':>12} {'chunk KiB':>10} "
+                f"{'MB/s':>9} {'CPU s/GB':>9}"
+            )
+            for size_kib in args.sizes:
+                for source_name, method, func, target in runs:
+                    best = None
+                    for _ in range(args.repeat):
+                        result = measure(
+                            func, target, size_kib * 1024, total_bytes, sink
+                        )
+                        if best is None or result[0] > best[0]:
+                            best = result
+                    print(
+                        f"{source_name:>6} {method:>12} {size_kib:>10} "
+                        f"{best[0]:>9.0f} {best[1]:>9.3f}"
+                    )
+        os.close(sink)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,512 @@
+"""
+End-to-end load test of whole user scenarios against a fake CDN
+
+Every user submits a manifest URL served by the fake CDN, waits for the
+video to be processed, starts a download, streams chunks while it runs,
+waits for it to finish, merges video and audio and streams the result.
+All users of a run start together. The API server and a worker pool run
+as subprocesses, with fragmented merges so that no ffmpeg is needed.
+
+Per request and per scenario phase it reports p50/p95/p99 latency, along
+with throughput, errors, and the threads, memory and CPU time used by
+the server and the workers. Results are saved as JSON so runs can be
+compared across commits. Needs gunicorn (WSGI) or uvicorn (ASGI).
+
+Run from the project directory:
+    python -m benchmarks.bench_scenarios --users 10 50 --modes wsgi asgi
+    python -m benchmarks.bench_scenarios --compare old.json new.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import aiohttp
+
+from benchmarks import PROJECT_DIR, setup_django
+from benchmarks.bench_concurrent_streams import (
+    ProcessSampler,
+    free_port,
+    server_command,
+    wait_until_up,
+)
+from benchmarks.fake_cdn import FakeCDN
+
+RESULTS_DIR = PROJECT_DIR / "benchmarks" / "results"
+
+# Request steps and scenario phases, in the order they are reported
+STEPS = (
+    "submit-url",
+    "video-info",
+    "start-download",
+    "stream-chunk",
+    "download-progress",
+    "merge-video-audio",
+    "stream-video",
+)
+PHASES = ("process", "download", "merge", "stream", "total")
+
+
+class ScenarioFailed(Exception):
+    pass
+
+
+def percentile(values, q):
+    """
+    Nearest-rank percentile of sorted `values`
+    """
+    if not values:
+        return None
+    rank = max(int(len(values) * q / 100 + 0.5), 1)
+    return values[min(rank, len(values)) - 1]
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    summary = {"count": len(samples)}
+    if samples:
+        summary["mean"] = round(sum(samples) / len(samples), 4)
+        for q in (50, 95, 99):
+            summary[f"p{q}"] = round(percentile(samples, q), 4)
+        summary["max"] = round(samples[-1], 4)
+    return summary
+
+
+class Recorder:
+    """
+    Latencies, errors and bytes received during a run
+    """
+
+    def __init__(self):
+        self.latencies = {step: [] for step in STEPS}
+        self.errors = {step: {} for step in STEPS}
+        self.phases = {phase: [] for phase in PHASES}
+        self.failures = {}
+        self.chunk_bytes = 0
+        self.video_bytes = 0
+        self.skipped_chunks = 0
+
+    def error(self, step, reason):
+        errors = self.errors[step]
+        errors[reason] = errors.get(reason, 0) + 1
+
+    def results(self):
+        return {
+            "steps": {
+                step: {**summarize(self.latencies[step]), "errors": self.errors[step]}
+                for step in STEPS
+            },
+            "phases": {phase: summarize(self.phases[phase]) for phase in PHASES},
+        }
+
+
+class Client:
+    """
+    One user running the scenario through the API
+    """
+
+    def __init__(self, session, base_url, token, recorder, args):
+        from django.urls import reverse
+
+        self.session = session
+        self.base_url = base_url
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.recorder = recorder
+        self.args = args
+        self.reverse = reverse
+        self.deadline = None
+
+    async def request(self, method, step, *url_args, params=None, json=None):
+        """
+        Send one timed request, returning (status, body)
+
+        Bodies are decoded as JSON except for the binary streams.
+        """
+        url = self.base_url + self.reverse(step, args=url_args)
+        start = time.perf_counter()
+        try:
+            async with self.session.request(
+                method, url, params=params, json=json, headers=self.headers
+            ) as response:
+                if step in ("stream-chunk", "stream-video"):
+                    body = 0
+                    async for block in response.content.iter_chunked(256 * 1024):
+                        body += len(block)
+                else:
+                    body = await response.json(content_type=None)
+                status = response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            self.recorder.error(step, type(e).__name__)
+            raise ScenarioFailed(f"{step}: {type(e).__name__}")
+        self.recorder.latencies[step].append(time.perf_counter() - start)
+        if status >= 500:
+            self.recorder.error(step, str(status))
+        return status, body
+
+    async def poll(self, step, *url_args, until):
+        """
+        Poll a status view until `until(status, body)` is true
+        """
+        while True:
+            status, body = await self.request("GET", step, *url_args)
+            if until(status, body):
+                return body
+            if status >= 400 or body.get("status") == "error":
+                self.recorder.error(step, body.get("status") or str(status))
+                raise ScenarioFailed(f"{step}: {body.get('status') or status}")
+            if time.monotonic() > self.deadline:
+                self.recorder.error(step, "timeout")
+                raise ScenarioFailed(f"{step}: timeout")
+            await asyncio.sleep(self.args.poll_interval)
+
+    async def run(self, manifest_url):
+        self.deadline = time.monotonic() + self.args.timeout
+        started = time.perf_counter()
+
+        status, body = await self.request(
+            "POST", "submit-url", json={"url": manifest_url}
+        )
+        if status != 202:
+            self.recorder.error("submit-url", str(status))
+            raise ScenarioFailed(f"submit-url: {status}")
+        video_id = body["video_id"]
+        await self.poll("video-info", video_id, until=lambda s, b: s == 200)
+        processed = time.perf_counter()
+        self.recorder.phases["process"].append(processed - started)
+
+        status, body = await self.request(
+            "POST",
+            "start-download",
+            json={"video_id": video_id, "resolution": self.args.resolution},
+        )
+        if status != 202:
+            self.recorder.error("start-download", str(status))
+            raise ScenarioFailed(f"start-download: {status}")
+        download_id = body["download_id"]
+
+        # Stream chunks as a player would while the download runs
+        await self.poll(
+            "download-progress",
+            download_id,
+            until=lambda s, b: b.get("status") in ("downloading", "completed"),
+        )
+        for chunk in range(self.args.chunks):
+            status, size = await self.request(
+                "GET", "stream-chunk", download_id, params={"chunk": chunk}
+            )
+            if status == 400:
+                # The download finished first
+                self.recorder.skipped_chunks += self.args.chunks - chunk
+                break
+            if status != 200:
+                self.recorder.error("stream-chunk", str(status))
+                continue
+            self.recorder.chunk_bytes += size
+
+        await self.poll(
+            "download-progress",
+            download_id,
+            until=lambda s, b: b.get("status") == "completed",
+        )
+        downloaded = time.perf_counter()
+        self.recorder.phases["download"].append(downloaded - processed)
+
+        status, _ = await self.request("POST", "merge-video-audio", download_id)
+        if status != 202:
+            self.recorder.error("merge-video-audio", str(status))
+            raise ScenarioFailed(f"merge-video-audio: {status}")
+        await self.poll(
+            "download-progress",
+            download_id,
+            until=lambda s, b: b.get("status") == "completed",
+        )
+        merged = time.perf_counter()
+        self.recorder.phases["merge"].append(merged - downloaded)
+
+        status, size = await self.request("GET", "stream-video", download_id)
+        if status != 200:
+            self.recorder.error("stream-video", str(status))
+            raise ScenarioFailed(f"stream-video: {status}")
+        self.recorder.video_bytes += size
+        finished = time.perf_counter()
+        self.recorder.phases["stream"].append(finished - merged)
+        self.recorder.phases["total"].append(finished - started)
+
+
+async def run_users(base_url, tokens, cdn, args, label):
+    recorder = Recorder()
+    connector = aiohttp.TCPConnector(limit=0)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+
+        async def user(n, token):
+            if args.ramp:
+                await asyncio.sleep(args.ramp * n / len(tokens))
+            client = Client(session, base_url, token, recorder, args)
+            try:
+                await client.run(cdn.manifest_url(f"{label}-{n}"))
+            except ScenarioFailed as e:
+                reason = str(e)
+                recorder.failures[reason] = recorder.failures.get(reason, 0) + 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(user(n, token) for n, token in enumerate(tokens)))
+        wall = time.perf_counter() - start
+
+    return recorder, wall
+
+
+def create_tokens(count, label):
+    from django.contrib.auth.models import User
+    from rest_framework_simplejwt.tokens import AccessToken
+
+    return [
+        str(AccessToken.for_user(User.objects.create(username=f"bench-{label}-{n}")))
+        for n in range(count)
+    ]
+
+
+def sampled(sampler):
+    return {
+        "peak_threads": sampler.threads,
+        "peak_rss_mb": round(sampler.rss_kb / 1024, 1),
+        "cpu_seconds": round(sampler.cpu_seconds, 2),
+    }
+
+
+def run_mode(mode, users, args, database, cdn):
+    label = f"{mode}-{users}-{int(time.time())}"
+    tokens = create_tokens(users, label)
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    workdir = tempfile.mkdtemp(prefix="vimeo-bench-work-")
+    env = {
+        **os.environ,
+        "DJANGO_SETTINGS_MODULE": "benchmarks.settings",
+        "BENCHMARK_DATABASE": database,
+        "ASYNC_VIEWS": "True" if mode == "asgi" else "False",
+        "ALLOWED_HOSTS": "127.0.0.1",
+        "MERGE_MODE": "fragmented",
+        "DOWNLOAD_WORK_DIR": os.path.join(workdir, "downloads"),
+        "SEGMENT_CACHE_DIR": os.path.join(workdir, "segment_cache"),
+        "JOB_POLL_INTERVAL": "0.2",
+        "LOG_LEVEL": "WARNING",
+    }
+    server = subprocess.Popen(
+        server_command(mode, port, args.threads), cwd=PROJECT_DIR, env=env
+    )
+    workers = subprocess.Popen(
+        [sys.executable, "manage.py", "run_workers", "--workers", str(args.workers)],
+        cwd=PROJECT_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+    requests_before, errors_before = cdn.requests, cdn.errors
+    try:
+        wait_until_up(base_url, server)
+        with ProcessSampler(server.pid) as server_sampler, ProcessSampler(
+            workers.pid
+        ) as worker_sampler:
+            recorder, wall = asyncio.run(run_users(base_url, tokens, cdn, args, label))
+    finally:
+        for process in (server, workers):
+            process.terminate()
+        for process in (server, workers):
+            process.wait()
+
+    completed = len(recorder.phases["total"])
+    return {
+        "mode": mode,
+        "users": users,
+        "wall_seconds": round(wall, 3),
+        "scenarios": {
+            "completed": completed,
+            "failed": users - completed,
+            "per_minute": round(completed / wall * 60, 2),
+            "failures": recorder.failures,
+        },
+        **recorder.results(),
+        "throughput": {
+            "chunk_mb_per_second": round(recorder.chunk_bytes / wall / 1024**2, 2),
+            "video_mb_per_second": round(recorder.video_bytes / wall / 1024**2, 2),
+            "chunks_skipped": recorder.skipped_chunks,
+        },
+        "resources": {
+            "server": sampled(server_sampler),
+            "workers": sampled(worker_sampler),
+        },
+        "cdn": {
+            "requests": cdn.requests - requests_before,
+            "errors": cdn.errors - errors_before,
+        },
+    }
+
+
+def print_run(run):
+    scenarios = run["scenarios"]
+    print(
+        f"\n{run['mode']} with {run['users']} users: "
+        f"{scenarios['completed']} completed, {scenarios['failed']} failed "
+        f"in {run['wall_seconds']:.1f}s"
+    )
+    for reason, count in scenarios["failures"].items():
+        print(f"  failed {count}x: {reason}")
+    print(
+        f"  {'':<18} {'count':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+        f"{'errors':>6}"
+    )
+    rows = [(step, run["steps"][step]) for step in STEPS]
+    rows += [(f"phase {phase}", run["phases"][phase]) for phase in PHASES]
+    for name, summary in rows:
+        if not summary["count"]:
+            continue
+        print(
+            f"  {name:<18} {summary['count']:>6} {summary['p50'] * 1000:>8.0f} "
+            f"{summary['p95'] * 1000:>8.0f} {summary['p99'] * 1000:>8.0f} "
+            f"{sum(summary.get('errors', {}).values()):>6}"
+        )
+    for name, used in run["resources"].items():
+        print(
+            f"  {name}: {used['peak_threads']} threads, "
+            f"{used['peak_rss_mb']:.0f} MiB RSS, {used['cpu_seconds']:.1f}s CPU"
+        )
+
+
+def git_commit():
+    def git(*args):
+        return subprocess.run(
+            ["git", *args], cwd=PROJECT_DIR, capture_output=True, text=True
+        ).stdout.strip()
+
+    return git("rev-parse", "--short", "HEAD") or "unknown", bool(
+        git("status", "--porcelain", "--untracked-files=no")
+    )
+
+
+def flatten(run):
+    """
+    The comparable numbers of a run as {name: value}
+    """
+    values = {
+        "scenarios/per_minute": run["scenarios"]["per_minute"],
+        "scenarios/failed": run["scenarios"]["failed"],
+    }
+    for group in ("steps", "phases"):
+        for name, summary in run[group].items():
+            for q in ("p50", "p95", "p99"):
+                if q in summary:
+                    values[f"{name}/{q}"] = summary[q]
+    for name, value in run["throughput"].items():
+        values[name] = value
+    for process, used in run["resources"].items():
+        for name, value in used.items():
+            values[f"{process}/{name}"] = value
+    return values
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{old['commit']} -> {new['commit']}")
+    old_runs = {(run["mode"], run["users"]): run for run in old["runs"]}
+    for run in new["runs"]:
+        key = (run["mode"], run["users"])
+        if key not in old_runs:
+            continue
+        print(f"\n{run['mode']} with {run['users']} users")
+        before = flatten(old_runs[key])
+        for name, value in flatten(run).items():
+            previous = before.get(name)
+            if previous is None:
+                continue
+            change = f"{(value - previous) / previous:+.1%}" if previous else ""
+            print(f"  {name:<32} {previous:>10} {value:>10} {change:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--users", type=int, nargs="+", default=[10, 50])
+    parser.add_argument("--modes", nargs="+", default=["wsgi", "asgi"])
+    parser.add_argument(
+        "--chunks", type=int, default=10, help="Chunks streamed per user"
+    )
+    parser.add_argument("--resolution", default="720p")
+    parser.add_argument("--segment-size", type=int, default=256 * 1024)
+    parser.add_argument("--segments", type=int, default=50, help="Segments per track")
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--threads", type=int, default=32, help="Server threads")
+    parser.add_argument("--workers", type=int, default=8, help="Background workers")
+    parser.add_argument(
+        "--ramp", type=float, default=0, help="Seconds to start users over"
+    )
+    parser.add_argument("--poll-interval", type=float, default=0.25)
+    parser.add_argument("--timeout", type=float, default=600, help="Per scenario")
+    parser.add_argument("--output", help="Results file (default benchmarks/results/)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    setup_django(database=True)
+
+    from django.conf import settings
+
+    database = str(settings.DATABASES["default"]["NAME"])
+    commit, dirty = git_commit()
+    created = datetime.now(timezone.utc)
+    runs = []
+
+    with FakeCDN(
+        segment_size=args.segment_size,
+        latency=args.latency,
+        segment_count=args.segments,
+        error_rate=args.error_rate,
+        seed=args.seed,
+        fmp4=True,
+    ) as cdn:
+        for users in args.users:
+            for mode in args.modes:
+                run = run_mode(mode, users, args, database, cdn)
+                print_run(run)
+                runs.append(run)
+
+    results = {
+        "commit": commit,
+        "dirty": dirty,
+        "created": created.isoformat(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "args": {
+            name: value
+            for name, value in vars(args).items()
+            if name not in ("output", "compare")
+        },
+        "runs": runs,
+    }
+    output = args.output
+    if output is None:
+        RESULTS_DIR.mkdir(exist_ok=True)
+        output = RESULTS_DIR / f"{created:%Y%m%d-%H%M%S}-{commit}.json"
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Compare sequential segment downloads with the concurrent SegmentFetcher
+
+Run from the project directory:
+    python -m benchmarks.bench_segment_fetch --latency 0.05 --counts 10 50 200
+"""
+
+import argparse
+import io
+import time
+
+import requests
+
+from benchmarks import setup_django
+from benchmarks.fake_cdn import FakeCDN
+
+
+def sequential(urls):
+    """
+    The original download_all_chunks loop: one request after another
+    """
+    file = io.BytesIO()
+    for url in urls:
+        response = requests.get(url, stream=True)
+        for chunk in response.iter_content(chunk_size=8192):
+            file.write(chunk)
+    return file.tell()
+
+
+def concurrent(urls, workers):
+    from api.segments import SegmentFetcher
+
+    file = io.BytesIO()
+    fetcher = SegmentFetcher(max_workers=workers, per_host=workers, use_cache=False)
+    for data in fetcher.iter_ordered(urls):
+        file.write(data)
+    return file.tell()
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    size = func(*args)
+    return time.perf_counter() - start, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--counts", type=int, nargs="+", default=[10, 50, 200])
+    parser.add_argument("--segment-size", type=int, default=256 * 1024)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    setup_django()
+
+    with FakeCDN(segment_size=args.segment_size, latency=args.latency) as cdn:
+        print(f"{'segments':>8} {'sequential':>12} {'concurrent':>12} {'speedup':>8}")
+        for count in args.counts:
+            urls = cdn.segment_urls(count)
+            seq_time, seq_size = timed(sequential, urls)
+            con_time, con_size = timed(concurrent, urls, args.workers)
+            assert seq_size == con_size, "concurrent download lost bytes"
+            print(
+                f"{count:>8} {seq_time:>11.2f}s {con_time:>11.2f}s "
+                f"{seq_time / con_time:>7.1f}x"
+            )
+
+    from api.upstream import connection_stats
+
+    print(f"upstream connections: {connection_stats()}")
+
+
+if __name__ == "__main__":
+    main()
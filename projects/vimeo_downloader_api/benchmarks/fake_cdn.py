@@ -0,0 +1,263 @@
+import base64
+import json
+import random
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Media timescale of the synthetic fMP4 tracks
+TIMESCALE = 1000
+
+
+def segment_bytes(index, size):
+    """
+    Deterministic payload for a synthetic segment
+    """
+    pattern = f"segment-{index:06d}|".encode()
+    return (pattern * (size // len(pattern) + 1))[:size]
+
+
+def box(box_type, payload):
+    return struct.pack(">I4s", 8 + len(payload), box_type.encode()) + payload
+
+
+def full_box(box_type, payload, version=0, flags=0):
+    return box(box_type, struct.pack(">I", (version << 24) | flags) + payload)
+
+
+def init_segment(track_id=1):
+    """
+    Minimal single-track fMP4 init segment (ftyp + moov)
+
+    Structurally what Vimeo serves, enough for FragmentedMuxer; there is no
+    real codec configuration, so players will not decode it.
+    """
+    ftyp = box("ftyp", b"iso6" + struct.pack(">I", 0) + b"iso6dash")
+    mvhd = full_box(
+        "mvhd",
+        struct.pack(">IIII", 0, 0, TIMESCALE, 0)
+        + bytes(76)
+        + struct.pack(">I", track_id + 1),
+    )
+    tkhd = full_box(
+        "tkhd",
+        struct.pack(">IIIII", 0, 0, track_id, 0, 0) + bytes(60),
+        flags=3,
+    )
+    trak = box("trak", tkhd)
+    trex = full_box("trex", struct.pack(">IIIII", track_id, 1, 0, 0, 0))
+    mvex = box("mvex", trex)
+    return ftyp + box("moov", mvhd + trak + mvex)
+
+
+def fragment(index, size, duration, track_id=1):
+    """
+    A moof + mdat media segment of exactly `size` bytes
+    """
+    mfhd = full_box("mfhd", struct.pack(">I", index + 1))
+    tfhd = full_box("tfhd", struct.pack(">I", track_id), flags=0x020000)
+    tfdt = full_box(
+        "tfdt", struct.pack(">Q", int(index * duration * TIMESCALE)), version=1
+    )
+    moof = box("moof", mfhd + box("traf", tfhd + tfdt))
+    payload = max(size - len(moof) - 8, 0)
+    return moof + box("mdat", segment_bytes(index, payload))
+
+
+class FakeCDNHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.respond(head=False)
+
+    def do_HEAD(self):
+        self.respond(head=True)
+
+    def respond(self, head):
+        cdn = self.server.cdn
+        name = self.path.split("?", 1)[0].rsplit("/", 1)[-1]
+        if name in ("playlist.json", "master.json"):
+            video_id = self.path.split("?", 1)[0].rsplit("/", 2)[-2]
+            with cdn.lock:
+                cdn.manifest_requests += 1
+            self.send_body(
+                200,
+                json.dumps(cdn.manifest(video_id)).encode(),
+                "application/json",
+                head,
+            )
+            return
+        if not name.startswith("segment-"):
+            self.send_error(404)
+            return
+
+        index = int(name[len("segment-") :].split(".")[0])
+        with cdn.lock:
+            cdn.requests += 1
+            failed = cdn.error_rate and cdn.random.random() < cdn.error_rate
+            if failed:
+                cdn.errors += 1
+        time.sleep(cdn.latency)
+        if failed:
+            self.send_body(503, b"", "text/plain", head)
+            return
+        body = cdn.segment(index)
+
+        status = 200
+        byte_range = self.headers.get("Range", "")
+        if byte_range.startswith("bytes="):
+            start, _, end = byte_range[len("bytes=") :].partition("-")
+            start = int(start)
+            end = int(end) if end else len(body) - 1
+            if start >= len(body):
+                self.send_body(416, b"", "video/mp4", head)
+                return
+            status = 206
+            content_range = f"bytes {start}-{end}/{len(body)}"
+            body = body[start : end + 1]
+
+        self.send_response(status)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Length", str(len(body)))
+        if status == 206:
+            self.send_header("Content-Range", content_range)
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def send_body(self, status, body, content_type, head):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeCDNServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 4096
+
+
+class FakeCDN:
+    """
+    Local stand-in for the Vimeo CDN serving synthetic manifests and segments
+
+    Any path ending in segment-<n>.m4s is a segment of `segment_size`
+    bytes, answered after `latency` seconds; a fraction `error_rate` of
+    segment requests fail with 503, drawn from a generator seeded with
+    `seed` so runs are repeatable. With fmp4=True segments are moof + mdat
+    fragments that FragmentedMuxer accepts, so merges work without ffmpeg.
+
+    /video/<id>/playlist.json (and master.json) is a manifest with one
+    video track per entry of `heights` and an audio track, each of
+    `segment_count` segments of `segment_duration` seconds.
+
+    Usage:
+        with FakeCDN(segment_size=256 * 1024, latency=0.05) as cdn:
+            urls = cdn.segment_urls(100)
+            manifest_url = cdn.manifest_url("1")
+    """
+
+    def __init__(
+        self,
+        segment_size=256 * 1024,
+        latency=0.05,
+        host="127.0.0.1",
+        segment_count=100,
+        segment_duration=4.0,
+        heights=(360, 720),
+        error_rate=0.0,
+        seed=0,
+        fmp4=False,
+        sizes_in_manifest=True,
+    ):
+        self.segment_size = segment_size
+        self.latency = latency
+        self.segment_count = segment_count
+        self.segment_duration = segment_duration
+        self.heights = tuple(heights)
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.fmp4 = fmp4
+        self.sizes_in_manifest = sizes_in_manifest
+        self.requests = 0
+        self.errors = 0
+        self.manifest_requests = 0
+        self.lock = threading.Lock()
+        self.server = FakeCDNServer((host, 0), FakeCDNHandler)
+        self.server.cdn = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def segment_urls(self, count):
+        return [f"{self.base_url}segments/segment-{i}.m4s" for i in range(count)]
+
+    def manifest_url(self, video_id):
+        return f"{self.base_url}video/{video_id}/playlist.json"
+
+    def segment(self, index):
+        if self.fmp4:
+            return fragment(index, self.segment_size, self.segment_duration)
+        return segment_bytes(index, self.segment_size)
+
+    def manifest(self, video_id):
+        """
+        playlist.json in the shape Vimeo serves it
+        """
+        init = base64.b64encode(init_segment()).decode() if self.fmp4 else ""
+        duration = self.segment_count * self.segment_duration
+        bitrate = int(self.segment_size * 8 / self.segment_duration)
+
+        def track(track_id, base_url, **fields):
+            segments = []
+            for i in range(self.segment_count):
+                segment = {
+                    "url": f"segment-{i}.m4s",
+                    "start": i * self.segment_duration,
+                    "end": (i + 1) * self.segment_duration,
+                }
+                if self.sizes_in_manifest:
+                    segment["size"] = self.segment_size
+                segments.append(segment)
+            return {
+                "id": track_id,
+                "base_url": base_url,
+                "bitrate": bitrate,
+                "duration": duration,
+                "init_segment": init,
+                "segments": segments,
+                **fields,
+            }
+
+        return {
+            "clip_id": video_id,
+            "base_url": f"{self.base_url}video/{video_id}/",
+            "video": [
+                track(f"video-{height}", f"{height}p/", height=height)
+                for height in self.heights
+            ],
+            "audio": [track("audio", "audio/")],
+        }
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,21 @@
+"""
+Settings for API servers started by the benchmarks
+
+Points the project at the benchmark's throwaway database.
+"""
+
+import os
+
+from vimeo_downloader_api.settings import *  # noqa: F401,F403
+from vimeo_downloader_api.settings import DATABASES
+
+DATABASES["default"]["NAME"] = os.environ["BENCHMARK_DATABASE"]
+# The server and the worker pool write to the same SQLite file: wait for
+# locks, and take the write lock up front so that waiting works
+DATABASES["default"].setdefault("OPTIONS", {}).update(
+    {
+        "timeout": 30,
+        "transaction_mode": "IMMEDIATE",
+        "init_command": "PRAGMA journal_mode=WAL;",
+    }
+)
@@ -25,9 +25,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "api.middleware.MetricsMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     "django.middleware.security.SecurityMiddleware",
-    "whitenoise.middleware.WhiteNoiseMiddleware",
+    "api.middleware.AsyncWhiteNoiseMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -83,15 +84,178 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": [
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
+        "api.authentication.CachedJWTAuthentication",
     ],
     "DEFAULT_PERMISSION_CLASSES": [
         "rest_framework.permissions.IsAuthenticated",
     ],
+    "DEFAULT_RENDERER_CLASSES": [
+        "api.renderers.FastJSONRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ],
+    "DEFAULT_PARSER_CLASSES": [
+        "api.parsers.FastJSONParser",
+        "rest_framework.parsers.FormParser",
+        "rest_framework.parsers.MultiPartParser",
+    ],
 }
 
+# Rows per page of the user-videos and user-downloads lists
+API_PAGE_SIZE = int(os.getenv("API_PAGE_SIZE", "50"))
+
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(minutes=15),
     "REFRESH_TOKEN_LIFETIME": timedelta(days=1),
     "AUTH_HEADER_TYPES": ("Bearer",),
 }
+
+# Users loaded by JWT authentication are kept per process for
+# AUTH_USER_CACHE_TTL seconds (0 size disables caching), and optionally in
+# the CACHES alias named by AUTH_USER_SHARED_CACHE for all processes
+AUTH_USER_CACHE_SIZE = int(os.getenv("AUTH_USER_CACHE_SIZE", "4096"))
+AUTH_USER_CACHE_TTL = float(os.getenv("AUTH_USER_CACHE_TTL", "30"))
+AUTH_USER_SHARED_CACHE = os.getenv("AUTH_USER_SHARED_CACHE", "")
+AUTH_USER_SHARED_CACHE_TTL = int(os.getenv("AUTH_USER_SHARED_CACHE_TTL", "300"))
+
+# Segment downloads
+SEGMENT_FETCH_WORKERS = int(os.getenv("SEGMENT_FETCH_WORKERS", "8"))
+SEGMENT_FETCH_PER_HOST = int(os.getenv("SEGMENT_FETCH_PER_HOST", "6"))
+# Retries of a segment whose body breaks off part way; failed connections
+# and 429/5xx answers are retried by the session (UPSTREAM_RETRIES)
+SEGMENT_FETCH_RETRIES = int(os.getenv("SEGMENT_FETCH_RETRIES", "3"))
+SEGMENT_FETCH_BACKOFF = float(os.getenv("SEGMENT_FETCH_BACKOFF", "0.5"))
+# Segments probed (HEAD) for the size of a track whose manifest lists none
+SIZE_PROBE_SAMPLES = int(os.getenv("SIZE_PROBE_SAMPLES", "16"))
+
+# Download rate assumed until one has been measured, in bytes per second
+DEFAULT_DOWNLOAD_RATE = float(os.getenv("DEFAULT_DOWNLOAD_RATE", str(5 * 125000)))
+# Measured rates are saved at most this often and trusted for this long (s)
+THROUGHPUT_FLUSH_INTERVAL = float(os.getenv("THROUGHPUT_FLUSH_INTERVAL", "10"))
+THROUGHPUT_MAX_AGE = int(os.getenv("THROUGHPUT_MAX_AGE", str(24 * 3600)))
+
+# Fair sharing of upstream fetches between background downloads, per
+# worker process: segments in flight overall and per user, and bandwidth
+# overall and per user in bytes per second (0 for no limit), with bursts
+# of SCHEDULER_BURST_SECONDS at the full rate
+SCHEDULER_MAX_IN_FLIGHT = int(os.getenv("SCHEDULER_MAX_IN_FLIGHT", "64"))
+SCHEDULER_USER_MAX_IN_FLIGHT = int(os.getenv("SCHEDULER_USER_MAX_IN_FLIGHT", "8"))
+SCHEDULER_RATE = int(os.getenv("SCHEDULER_RATE", "0"))
+SCHEDULER_USER_RATE = int(os.getenv("SCHEDULER_USER_RATE", "0"))
+SCHEDULER_BURST_SECONDS = float(os.getenv("SCHEDULER_BURST_SECONDS", "1"))
+
+# Upstream HTTP client
+UPSTREAM_POOL_SIZE = int(os.getenv("UPSTREAM_POOL_SIZE", "32"))
+UPSTREAM_POOL_HOSTS = int(os.getenv("UPSTREAM_POOL_HOSTS", "10"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "30"))
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", "2"))
+UPSTREAM_BACKOFF = float(os.getenv("UPSTREAM_BACKOFF", "0.3"))
+# Opt-in: urllib3's HTTP/2 support is experimental and patched in for the
+# whole process, every library's HTTPS included, and offers only h2
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2") == "True"
+UPSTREAM_ASYNC_POOL_SIZE = int(os.getenv("UPSTREAM_ASYNC_POOL_SIZE", "512"))
+
+# Merging: "copy" remuxes with ffmpeg, "reencode" transcodes with moviepy,
+# "fragmented" interleaves the segments into a fragmented MP4 as they arrive
+MERGE_MODE = os.getenv("MERGE_MODE", "copy")
+# Segments a merge stage may get ahead of the stage consuming them
+MERGE_QUEUE_SIZE = int(os.getenv("MERGE_QUEUE_SIZE", "16"))
+MERGE_REENCODE_FALLBACK = os.getenv("MERGE_REENCODE_FALLBACK") == "True"
+FFMPEG_BINARY = os.getenv("FFMPEG_BINARY", "ffmpeg")
+
+# Bytes moved per read when relaying segments and copying files
+RELAY_CHUNK_SIZE = int(os.getenv("RELAY_CHUNK_SIZE", str(256 * 1024)))
+# Idle relay buffers kept for reuse per process
+RELAY_BUFFER_POOL = int(os.getenv("RELAY_BUFFER_POOL", "64"))
+
+# Segment cache (set SEGMENT_CACHE_MAX_BYTES=0 to disable)
+SEGMENT_CACHE_DIR = os.getenv("SEGMENT_CACHE_DIR", str(BASE_DIR / "segment_cache"))
+SEGMENT_CACHE_MAX_BYTES = int(os.getenv("SEGMENT_CACHE_MAX_BYTES", str(2 * 1024**3)))
+
+# How chunks and merged videos on local disk are sent: "django"
+# (FileResponse, using sendfile where the server supports it), "nginx"
+# (X-Accel-Redirect) or "apache" (X-Sendfile)
+SENDFILE_BACKEND = os.getenv("SENDFILE_BACKEND", "django")
+# Internal nginx location with downloads/ and segment-cache/ under it
+SENDFILE_URL_PREFIX = os.getenv("SENDFILE_URL_PREFIX", "/protected/")
+
+# Threads fetching segments for chunk requests under WSGI, shared by all
+# the requests for a segment
+COALESCE_FETCH_WORKERS = int(os.getenv("COALESCE_FETCH_WORKERS", "32"))
+
+# Read-ahead for clients streaming chunks in order (0 disables it)
+PREFETCH_MAX_AHEAD = int(os.getenv("PREFETCH_MAX_AHEAD", "8"))
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", "8"))
+# Memory for prefetched segments when the segment cache is disabled
+PREFETCH_BUFFER_BYTES = int(os.getenv("PREFETCH_BUFFER_BYTES", str(64 * 1024**2)))
+# Seconds without a request after which a download's read-ahead is dropped
+PREFETCH_IDLE_TIMEOUT = float(os.getenv("PREFETCH_IDLE_TIMEOUT", "30"))
+
+# JSON library for API responses, request bodies and manifests: "auto"
+# (orjson, then msgspec, if installed), "orjson", "msgspec" or "stdlib"
+JSON_BACKEND = os.getenv("JSON_BACKEND", "auto")
+
+# Raw playlist/master manifests: "zstd" (needs zstandard), "gzip" or "none"
+MANIFEST_COMPRESSION = os.getenv("MANIFEST_COMPRESSION", "gzip")
+# How long a fetched manifest is shared with later submissions of the same
+# URL (never beyond the expiry of a signed URL)
+MANIFEST_CACHE_TTL = int(os.getenv("MANIFEST_CACHE_TTL", "3600"))
+
+# Parsed playlist indexes kept in memory per process
+PLAYLIST_INDEX_CACHE_SIZE = int(os.getenv("PLAYLIST_INDEX_CACHE_SIZE", "256"))
+
+# Download progress is flushed to the database at most this often
+PROGRESS_FLUSH_INTERVAL_MS = int(os.getenv("PROGRESS_FLUSH_INTERVAL_MS", "1000"))
+PROGRESS_FLUSH_CHUNKS = int(os.getenv("PROGRESS_FLUSH_CHUNKS", "25"))
+
+# Progress push (SSE and long-poll): how often each process reads progress
+# written elsewhere for the downloads it has subscribers for
+PROGRESS_POLL_INTERVAL_MS = int(os.getenv("PROGRESS_POLL_INTERVAL_MS", "1000"))
+PROGRESS_LONG_POLL_TIMEOUT = float(os.getenv("PROGRESS_LONG_POLL_TIMEOUT", "25"))
+# Long-polls a WSGI process lets wait at once, each holding a worker thread;
+# keep it below gunicorn's --threads. Others are answered at once.
+PROGRESS_SYNC_LONG_POLLS = int(os.getenv("PROGRESS_SYNC_LONG_POLLS", "0"))
+PROGRESS_SSE_KEEPALIVE = float(os.getenv("PROGRESS_SSE_KEEPALIVE", "15"))
+
+# Background jobs (run with `python manage.py run_workers`)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "8"))
+JOB_CONCURRENCY = {
+    "process_video": int(os.getenv("JOB_CONCURRENCY_PROCESS", "4")),
+    "download_video": int(os.getenv("JOB_CONCURRENCY_DOWNLOAD", "8")),
+    "merge_video": int(os.getenv("JOB_CONCURRENCY_MERGE", "2")),
+}
+# Jobs of one user a worker process runs at once, whatever their kind
+JOB_CONCURRENCY_PER_USER = int(os.getenv("JOB_CONCURRENCY_PER_USER", "2"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1"))
+JOB_HEARTBEAT_INTERVAL = float(os.getenv("JOB_HEARTBEAT_INTERVAL", "15"))
+JOB_STALE_AFTER = float(os.getenv("JOB_STALE_AFTER", "60"))
+JOB_RETRY_DELAY = float(os.getenv("JOB_RETRY_DELAY", "5"))
+
+# Prometheus metrics: GET /metrics needs "Authorization: Bearer <token>",
+# and answers 401 to everyone while METRICS_TOKEN is unset (unless DEBUG);
+# workers serve theirs on METRICS_HOST:METRICS_PORT (port 0: off)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        "default": {"format": "%(asctime)s %(levelname)s %(name)s: %(message)s"},
+    },
+    "handlers": {
+        "console": {"class": "logging.StreamHandler", "formatter": "default"},
+    },
+    "loggers": {
+        "api": {"handlers": ["console"], "level": os.getenv("LOG_LEVEL", "INFO")},
+    },
+}
+
+# Per-download work files (fetched segments, merged output)
+DOWNLOAD_WORK_DIR = os.getenv("DOWNLOAD_WORK_DIR", str(BASE_DIR / "downloads"))
+
+# Serve chunk streaming and progress from async views; enable when running
+# under an ASGI server (see README_DEPLOYMENT.md)
+ASYNC_VIEWS = os.getenv("ASYNC_VIEWS") == "True"
+ASYNC_DB_THREADS = int(os.getenv("ASYNC_DB_THREADS", "8"))
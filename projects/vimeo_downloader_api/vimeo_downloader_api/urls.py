@@ -5,6 +5,8 @@ from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
 from rest_framework import permissions
 
+from api.views import MetricsView
+
 schema_view = get_schema_view(
     openapi.Info(
         title="API Service",
@@ -19,6 +21,7 @@ urlpatterns = [
     path("jet/", include("jet.urls", "jet")),
     path("admin/", admin.site.urls),
     path("api/", include("api.urls")),
+    path("metrics", MetricsView.as_view(), name="metrics"),
     path("api/auth/token/", TokenObtainPairView.as_view(), name="token_obtain_pair"),
     path("api/auth/token/refresh/", TokenRefreshView.as_view(), name="token_refresh"),
     path("swagger/", schema_view.with_ui("swagger", cache_timeout=0), name="schema-swagger-ui"),